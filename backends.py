@@ -0,0 +1,238 @@
+"""
+Pool of Forge backends.
+
+FORGE_URLS may list several Forge nodes. Each one gets its own keep-alive
+client, a circuit breaker that takes it out of rotation after repeated
+connection failures, and a periodic health probe of /sdapi/v1/progress that
+records queue depth, probe latency and the loaded checkpoint. Generation jobs
+(dispatched by scheduler.py) are pinned to the node they run on, so
+get_progress and interrupt_generation can address it by job ID.
+"""
+
+import asyncio
+import functools
+import importlib.util
+import logging
+import ssl
+import time
+
+import httpx
+
+from config import (
+    BACKEND_COOLDOWN,
+    BACKEND_FAILURE_THRESHOLD,
+    BACKEND_HEALTH_INTERVAL,
+    FORGE_API_PASSWORD,
+    FORGE_API_USER,
+    FORGE_HTTP2,
+    FORGE_KEEPALIVE_EXPIRY,
+    FORGE_MAX_CONNECTIONS,
+    FORGE_MAX_KEEPALIVE,
+    FORGE_URLS,
+    TIMEOUT_CONTROL,
+    TIMEOUT_GENERATION,
+)
+
+logger = logging.getLogger(__name__)
+
+# Weight of the newest sample in the exponentially weighted latency average.
+_LATENCY_ALPHA = 0.3
+
+
+class Backend:
+    """One Forge node: its pooled client plus health and load bookkeeping."""
+
+    def __init__(self, url: str) -> None:
+        self.url = url.rstrip("/")
+        self.client: httpx.AsyncClient | None = None
+        self.checkpoint: str | None = None
+        self.active_jobs = 0
+        # Jobs the scheduler may run here at once; adapted by scheduler.py.
+        self.limit = 1.0
+        self.queue_depth = 0
+        self.latency: float | None = None
+        self.failures = 0
+        self.open_until = 0.0
+
+    @property
+    def available(self) -> bool:
+        """False while the circuit breaker is open."""
+        return self.open_until <= time.monotonic()
+
+    @property
+    def load(self) -> int:
+        # Forge runs one job at a time; anything it reports beyond ours was
+        # queued by someone else (e.g. the web UI).
+        return max(self.active_jobs, self.queue_depth)
+
+    def get_client(self) -> httpx.AsyncClient:
+        if self.client is None or self.client.is_closed:
+            self.client = _build_client(self.url)
+        return self.client
+
+    def record_success(self, latency: float | None = None) -> None:
+        self.failures = 0
+        self.open_until = 0.0
+        if latency is not None:
+            self.latency = (
+                latency if self.latency is None
+                else _LATENCY_ALPHA * latency + (1 - _LATENCY_ALPHA) * self.latency
+            )
+
+    def record_failure(self, trip: bool = False) -> None:
+        """Count a failed call; *trip* opens the breaker regardless of the count."""
+        self.failures += 1
+        if trip or self.failures >= BACKEND_FAILURE_THRESHOLD:
+            if self.available:
+                logger.warning("Forge backend %s is unreachable; pausing it.", self.url)
+            self.open_until = time.monotonic() + BACKEND_COOLDOWN
+
+    def describe(self) -> str:
+        state = "healthy" if self.available else "unavailable"
+        latency = f"{self.latency * 1000:.0f} ms" if self.latency is not None else "n/a"
+        return (
+            f"{self.url}: {state}, {self.active_jobs} running here "
+            f"(limit {int(self.limit)}), "
+            f"queue {self.queue_depth}, latency {latency}, "
+            f"model {self.checkpoint or 'unknown'}"
+        )
+
+
+class BackendPool:
+    """Schedules work across the configured Forge backends."""
+
+    def __init__(self, urls: list[str]) -> None:
+        self.backends = [Backend(url) for url in urls]
+        self._jobs: dict[str, Backend] = {}
+        self._health_task: asyncio.Task | None = None
+
+    async def start(self) -> None:
+        """
+        Begin periodic health checks, the first one a full interval from now.
+
+        Probing builds each backend's client, so doing it at once would undo
+        opening clients on first use; until then tool calls open them.
+        """
+        if self._health_task is None:
+            self._health_task = asyncio.create_task(self._health_loop())
+
+    async def stop(self) -> None:
+        if self._health_task is not None:
+            self._health_task.cancel()
+            self._health_task = None
+        for backend in self.backends:
+            if backend.client is not None:
+                await backend.client.aclose()
+                backend.client = None
+
+    def get(self, url: str) -> Backend | None:
+        url = url.rstrip("/")
+        return next((b for b in self.backends if b.url == url), None)
+
+    def primary(self) -> Backend:
+        """Backend for lightweight calls: the first one in rotation."""
+        return next((b for b in self.backends if b.available), self._least_broken())
+
+    def pick(self, checkpoint: str | None = None, among: list[Backend] | None = None) -> Backend:
+        """
+        Return the least-loaded backend of *among* (default: all available).
+
+        When *checkpoint* is given, nodes that already have it loaded win ties
+        so jobs avoid a model switch. Lower probe latency breaks further ties.
+        """
+        def score(b: Backend) -> tuple:
+            switch = 1 if checkpoint and b.checkpoint != checkpoint else 0
+            return (b.load, switch, b.latency if b.latency is not None else float("inf"))
+
+        return min(among or self.candidates(), key=score)
+
+    def has_alternative(self, exclude: tuple[Backend, ...]) -> bool:
+        return any(b.available and b not in exclude for b in self.backends)
+
+    def candidates(self, exclude: tuple[Backend, ...] = ()) -> list[Backend]:
+        """Backends that may take new work, falling back to the least broken."""
+        usable = [b for b in self.backends if b.available and b not in exclude]
+        if usable:
+            return usable
+        return [self._least_broken()]
+
+    def assign(self, job_id: str, backend: Backend) -> None:
+        """Pin *job_id* to *backend* while it runs there."""
+        self._jobs[job_id] = backend
+        backend.active_jobs += 1
+
+    def release(self, job_id: str) -> None:
+        backend = self._jobs.pop(job_id, None)
+        if backend is not None:
+            backend.active_jobs -= 1
+            # The last probe counted this job; don't let it linger as load.
+            backend.queue_depth = max(backend.queue_depth - 1, 0)
+
+    def _least_broken(self) -> Backend:
+        # Everything is paused: try whichever node comes back first rather
+        # than failing without contacting Forge at all.
+        return min(self.backends, key=lambda b: b.open_until)
+
+    # -- health checks
+
+    async def check(self, backend: Backend) -> bool:
+        """Probe *backend* once and update its health and load figures."""
+        client = backend.get_client()
+        started = time.monotonic()
+        try:
+            response = await client.get(
+                "/sdapi/v1/progress",
+                params={"skip_current_image": "true"},
+                timeout=TIMEOUT_CONTROL,
+            )
+            response.raise_for_status()
+            state = response.json().get("state", {})
+            if backend.checkpoint is None:
+                opts = await client.get("/sdapi/v1/options", timeout=TIMEOUT_CONTROL)
+                opts.raise_for_status()
+                backend.checkpoint = opts.json().get("sd_model_checkpoint")
+        except Exception:
+            # A failed probe is conclusive, unlike a single failed tool call.
+            backend.record_failure(trip=True)
+            return False
+
+        backend.queue_depth = int(state.get("job_count") or 0)
+        backend.record_success(time.monotonic() - started)
+        return True
+
+    async def _health_loop(self) -> None:
+        while True:
+            await asyncio.sleep(BACKEND_HEALTH_INTERVAL)
+            await asyncio.gather(*(self.check(b) for b in self.backends))
+
+
+def _build_client(base_url: str) -> httpx.AsyncClient:
+    http2 = FORGE_HTTP2
+    if http2 and importlib.util.find_spec("h2") is None:
+        logger.warning("FORGE_HTTP2 is set but 'h2' is not installed; using HTTP/1.1.")
+        http2 = False
+
+    auth = (FORGE_API_USER, FORGE_API_PASSWORD) if FORGE_API_USER else None
+    return httpx.AsyncClient(
+        base_url=base_url,
+        auth=auth,
+        # Plain-HTTP nodes never use TLS, so skip loading the CA bundle for them.
+        verify=_ssl_context() if base_url.startswith("https:") else False,
+        timeout=TIMEOUT_GENERATION,
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=FORGE_MAX_CONNECTIONS,
+            max_keepalive_connections=FORGE_MAX_KEEPALIVE,
+            keepalive_expiry=FORGE_KEEPALIVE_EXPIRY,
+        ),
+    )
+
+
+@functools.cache
+def _ssl_context() -> ssl.SSLContext:
+    """One TLS context for every HTTPS backend; building it loads the CA bundle."""
+    return httpx.create_ssl_context()
+
+
+# Process-wide pool, started and stopped by the server lifespan.
+pool = BackendPool(FORGE_URLS)
@@ -0,0 +1,207 @@
+"""
+Stand-in for Forge's /sdapi/v1/* API, for benchmarking this server alone.
+
+Generation endpoints sleep for a fixed latency (the "GPU time") and then
+return noise PNGs of the requested size, stored uncompressed so the payload
+is as large as a real photo-like image or larger. Everything the server does
+on top of that sleep - JSON and base64 handling, disk writes, connection
+handling - is what the benchmark measures.
+
+    python -m benchmarks.mock_forge --port 7861 --latency 0.5
+"""
+
+import argparse
+import asyncio
+import base64
+import functools
+import json
+import os
+import struct
+import time
+import zlib
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+
+def noise_png(width: int, height: int) -> bytes:
+    """An RGB PNG of random pixels, zlib level 0 so its size is ~3 bytes/px."""
+    row = b"\x00" + os.urandom(width * 3)
+    raw = zlib.compress(row * height, 0)
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return (
+            struct.pack(">I", len(data)) + kind + data
+            + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+        )
+
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", raw)
+        + chunk(b"IEND", b"")
+    )
+
+
+@functools.lru_cache(maxsize=8)
+def noise_b64(width: int, height: int) -> str:
+    return base64.b64encode(noise_png(width, height)).decode("ascii")
+
+
+def png_size(b64: str) -> tuple[int, int]:
+    """Width and height from the IHDR of a base64 PNG, without decoding it all."""
+    if b64.startswith("data:"):
+        b64 = b64.split(",", 1)[1]
+    header = base64.b64decode(b64[:32])
+    return struct.unpack(">II", header[16:24])
+
+
+class MockForge:
+    """Request handlers plus the state that /progress reports."""
+
+    def __init__(self, latency: float, max_side: int) -> None:
+        self.latency = latency
+        self.max_side = max_side
+        self.model = "mock-model.safetensors"
+        self.running = 0
+        self.started = 0.0
+        self.calls: dict[str, int] = {}
+        self._gpu = asyncio.Lock()
+
+    def app(self) -> Starlette:
+        get, post = ["GET"], ["POST"]
+        return Starlette(routes=[
+            Route("/sdapi/v1/txt2img", self.generate, methods=post),
+            Route("/sdapi/v1/img2img", self.generate, methods=post),
+            Route("/sdapi/v1/extra-single-image", self.extras, methods=post),
+            Route("/sdapi/v1/progress", self.progress, methods=get),
+            Route("/sdapi/v1/options", self.options, methods=get + post),
+            Route("/sdapi/v1/interrupt", self.ok, methods=post),
+            Route("/sdapi/v1/refresh-checkpoints", self.ok, methods=post),
+            Route("/sdapi/v1/refresh-loras", self.ok, methods=post),
+            Route("/sdapi/v1/sd-models", self.listing, methods=get),
+            Route("/sdapi/v1/loras", self.listing, methods=get),
+            Route("/sdapi/v1/samplers", self.listing, methods=get),
+            Route("/sdapi/v1/upscalers", self.listing, methods=get),
+            Route("/sdapi/v1/sd-vae", self.listing, methods=get),
+            Route("/sdapi/v1/embeddings", self.embeddings, methods=get),
+            Route("/mock/stats", self.stats, methods=get),
+        ])
+
+    def _count(self, request: Request) -> None:
+        self.calls[request.url.path] = self.calls.get(request.url.path, 0) + 1
+
+    async def _work(self) -> None:
+        # Forge runs one job at a time; so does the mock.
+        self.running += 1
+        try:
+            async with self._gpu:
+                self.started = time.monotonic()
+                await asyncio.sleep(self.latency)
+        finally:
+            self.running -= 1
+
+    async def generate(self, request: Request) -> Response:
+        self._count(request)
+        body = await request.json()
+        width = min(int(body.get("width") or 512), self.max_side)
+        height = min(int(body.get("height") or 512), self.max_side)
+        if body.get("enable_hr"):
+            scale = float(body.get("hr_scale") or 2)
+            width = min(round(width * scale), self.max_side)
+            height = min(round(height * scale), self.max_side)
+        count = int(body.get("batch_size") or 1) * int(body.get("n_iter") or 1)
+        seed = int(body.get("seed", -1))
+        if seed == -1:
+            seed = int.from_bytes(os.urandom(4), "big") >> 1
+
+        await self._work()
+        image = await asyncio.to_thread(noise_b64, width, height)
+        info = {"seed": seed, "all_seeds": [seed + i for i in range(count)]}
+        return _json({"images": [image] * count, "parameters": {}, "info": json.dumps(info)})
+
+    async def extras(self, request: Request) -> Response:
+        self._count(request)
+        body = await request.json()
+        width, height = png_size(body["image"])
+        scale = float(body.get("upscaling_resize") or 2)
+        width = min(round(width * scale), self.max_side)
+        height = min(round(height * scale), self.max_side)
+
+        await self._work()
+        image = await asyncio.to_thread(noise_b64, width, height)
+        return _json({"html_info": "", "image": image})
+
+    async def progress(self, request: Request) -> Response:
+        self._count(request)
+        done = (time.monotonic() - self.started) / self.latency if self.latency else 1.0
+        progress = min(done, 0.99) if self.running else 0.0
+        return JSONResponse({
+            "progress": progress,
+            "eta_relative": max(self.latency * (1 - progress), 0.0),
+            "state": {
+                "job_count": self.running,
+                "job": "mock",
+                "sampling_step": int(progress * 20),
+                "sampling_steps": 20,
+            },
+            "current_image": None,
+        })
+
+    async def options(self, request: Request) -> Response:
+        self._count(request)
+        if request.method == "POST":
+            body = await request.json()
+            self.model = body.get("sd_model_checkpoint", self.model)
+            return JSONResponse(None)
+        return JSONResponse({"sd_model_checkpoint": self.model, "sd_vae": "Automatic"})
+
+    async def listing(self, request: Request) -> Response:
+        self._count(request)
+        name = request.url.path.rsplit("/", 1)[1]
+        return JSONResponse([
+            {
+                "name": f"{name}-{i}",
+                "title": f"{name}-{i}",
+                "model_name": f"{name}-{i}",
+                "filename": f"/models/{name}/{name}-{i}.safetensors",
+            }
+            for i in range(50)
+        ])
+
+    async def embeddings(self, request: Request) -> Response:
+        self._count(request)
+        return JSONResponse({"loaded": {f"emb-{i}": {} for i in range(20)}, "skipped": {}})
+
+    async def ok(self, request: Request) -> Response:
+        self._count(request)
+        return JSONResponse(None)
+
+    async def stats(self, request: Request) -> Response:
+        return JSONResponse(self.calls)
+
+
+def _json(data: dict) -> Response:
+    # Large bodies: skip JSONResponse's extra validation and encode once.
+    return Response(json.dumps(data), media_type="application/json")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7861)
+    parser.add_argument("--latency", type=float, default=0.5,
+                        help="Seconds each generation request takes (default 0.5).")
+    parser.add_argument("--max-side", type=int, default=8192,
+                        help="Largest image edge returned (default 8192).")
+    args = parser.parse_args()
+
+    forge = MockForge(args.latency, args.max_side)
+    uvicorn.run(forge.app(), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,340 @@
+"""
+Benchmark harness: drives the MCP tools against benchmarks/mock_forge.py.
+
+The mock answers generation requests after a fixed latency, so whatever
+time, memory and event-loop stalls are measured on top of that is this
+server's own overhead (JSON, base64, disk writes, connection handling,
+queueing). Each scenario calls one tool N times at each concurrency level
+through an in-process MCP client and reports latency percentiles,
+throughput, peak RSS and event-loop lag.
+
+    python -m benchmarks.run                        # quick run, 512px images
+    python -m benchmarks.run --profile heavy        # 8x1024^2 batches, 8K upscales
+    python -m benchmarks.run --only txt2img,img2img --concurrency 1,8 --json out.json
+
+Peak RSS uses psutil when installed, /proc on Linux, and otherwise the
+process-wide peak from the resource module.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Callable
+
+import httpx
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Image edge used for inputs and outputs, per profile.
+PROFILES = {
+    "quick": {"side": 512, "batch": 2, "upscale_side": 512, "upscale_factor": 2.0},
+    "heavy": {"side": 1024, "batch": 8, "upscale_side": 2048, "upscale_factor": 4.0},
+}
+
+
+@dataclass
+class Result:
+    scenario: str
+    concurrency: int
+    calls: int
+    errors: int
+    p50_ms: float
+    p90_ms: float
+    p99_ms: float
+    max_ms: float
+    throughput: float
+    peak_rss_mb: float | None
+    loop_lag_p99_ms: float
+    loop_lag_max_ms: float
+
+
+# ---------------------------------------------------------------------------
+# Scenarios
+# ---------------------------------------------------------------------------
+
+def scenarios(inputs: dict[str, str], profile: dict[str, Any]) -> dict[str, tuple[str, Callable[[int], dict]]]:
+    """Scenario name -> (tool name, arguments for call number i)."""
+    side, batch = profile["side"], profile["batch"]
+    image, mask = inputs["image"], inputs["mask"]
+    return {
+        "txt2img": ("txt2img", lambda i: {
+            "prompt": "bench", "width": side, "height": side, "batch_size": batch,
+            "save_path": f"txt2img_{i}.png",
+        }),
+        "txt2img_grid": ("txt2img_grid", lambda i: {
+            "prompts": ["a", "b"], "cfg_scales": [5, 7], "seeds": [1, 2, 3, 4],
+            "width": side, "height": side, "contact_sheet": False,
+            "save_prefix": f"grid_{i}",
+        }),
+        "txt2img_hires": ("txt2img_hires", lambda i: {
+            "prompt": "bench", "width": side // 2, "height": side // 2,
+            "method": "chain", "hr_upscaler": "Lanczos", "save_path": f"hires_{i}.png",
+        }),
+        "img2img": ("img2img", lambda i: {
+            "image_path": image, "prompt": "bench", "save_path": f"img2img_{i}.png",
+        }),
+        "inpaint": ("inpaint", lambda i: {
+            "image_path": image, "mask_path": mask, "prompt": "bench",
+            "save_path": f"inpaint_{i}.png",
+        }),
+        "inpaint_regions": ("inpaint_regions", lambda i: {
+            "image_path": image,
+            "regions": [{"mask_path": mask, "prompt": "a"}, {"mask_path": mask, "prompt": "b"}],
+            "save_path": f"regions_{i}.png",
+        }),
+        "upscale_image": ("upscale_image", lambda i: {
+            "image_path": inputs["upscale"], "upscaling_resize": profile["upscale_factor"],
+            "save_path": f"upscale_{i}.png",
+        }),
+        "upscale_tiled": ("upscale_image", lambda i: {
+            "image_path": inputs["upscale"], "upscaling_resize": profile["upscale_factor"],
+            "tile_size": 512, "save_path": f"tiled_{i}.png",
+        }),
+        "get_models": ("get_models", lambda i: {"use_cache": False}),
+        "get_loras": ("get_loras", lambda i: {}),
+        "get_inventory": ("get_inventory", lambda i: {"search": "lora 1"}),
+        "get_progress": ("get_progress", lambda i: {}),
+        "get_queue": ("get_queue", lambda i: {}),
+        "get_cache_stats": ("get_cache_stats", lambda i: {}),
+    }
+
+
+# ---------------------------------------------------------------------------
+# Measurement
+# ---------------------------------------------------------------------------
+
+class Sampler:
+    """Samples event-loop lag and resident memory while a scenario runs."""
+
+    def __init__(self, interval: float = 0.01) -> None:
+        self.interval = interval
+        self.lags: list[float] = []
+        self.peak_rss: int | None = None
+        self._task: asyncio.Task | None = None
+
+    async def __aenter__(self) -> "Sampler":
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._sample_rss()
+
+    async def _run(self) -> None:
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(time.perf_counter() - started - self.interval, 0.0))
+            self._sample_rss()
+
+    def _sample_rss(self) -> None:
+        rss = _current_rss()
+        if rss is not None:
+            self.peak_rss = max(self.peak_rss or 0, rss)
+
+
+def _current_rss() -> int | None:
+    try:
+        import psutil
+
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm") as fh:
+            return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+    except ImportError:
+        return None
+
+
+def _percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * pct / 100), len(ordered) - 1)]
+
+
+async def run_scenario(client, name: str, tool: str, make_args, concurrency: int, calls: int) -> Result:
+    limit = asyncio.Semaphore(concurrency)
+    latencies: list[float] = []
+    errors = 0
+
+    async def one(i: int) -> None:
+        nonlocal errors
+        async with limit:
+            started = time.perf_counter()
+            result = await client.call_tool(tool, make_args(i), raise_on_error=False)
+            latencies.append(time.perf_counter() - started)
+            if result.is_error:
+                errors += 1
+
+    async with Sampler() as sampler:
+        started = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(calls)))
+        elapsed = time.perf_counter() - started
+
+    ms = [v * 1000 for v in latencies]
+    lags = [v * 1000 for v in sampler.lags]
+    return Result(
+        scenario=name,
+        concurrency=concurrency,
+        calls=calls,
+        errors=errors,
+        p50_ms=statistics.median(ms),
+        p90_ms=_percentile(ms, 90),
+        p99_ms=_percentile(ms, 99),
+        max_ms=max(ms),
+        throughput=calls / elapsed,
+        peak_rss_mb=sampler.peak_rss / 2**20 if sampler.peak_rss else None,
+        loop_lag_p99_ms=_percentile(lags, 99),
+        loop_lag_max_ms=max(lags, default=0.0),
+    )
+
+
+# ---------------------------------------------------------------------------
+# Setup and reporting
+# ---------------------------------------------------------------------------
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _start_mock(port: int, latency: float) -> subprocess.Popen:
+    process = subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.mock_forge", "--port", str(port), "--latency", str(latency)],
+        cwd=ROOT,
+    )
+    deadline = time.monotonic() + 20
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/sdapi/v1/options", timeout=1)
+            return process
+        except httpx.TransportError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("The mock Forge server did not start.")
+
+
+def _write_inputs(directory: Path, profile: dict[str, Any]) -> dict[str, str]:
+    from benchmarks.mock_forge import noise_png
+
+    side = profile["side"]
+    paths = {
+        "image": directory / "input.png",
+        "mask": directory / "mask.png",
+        "upscale": directory / "upscale_input.png",
+    }
+    paths["image"].write_bytes(noise_png(side, side))
+    paths["mask"].write_bytes(noise_png(side, side))
+    paths["upscale"].write_bytes(noise_png(profile["upscale_side"], profile["upscale_side"]))
+    return {name: str(path) for name, path in paths.items()}
+
+
+def _print_table(results: list[Result]) -> None:
+    header = (
+        f"{'scenario':<16}{'conc':>5}{'calls':>6}{'err':>4}"
+        f"{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}"
+        f"{'req/s':>8}{'rss MB':>8}{'lag p99':>9}{'lag max':>9}"
+    )
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        rss = f"{r.peak_rss_mb:.0f}" if r.peak_rss_mb is not None else "n/a"
+        print(
+            f"{r.scenario:<16}{r.concurrency:>5}{r.calls:>6}{r.errors:>4}"
+            f"{r.p50_ms:>10.1f}{r.p90_ms:>10.1f}{r.p99_ms:>10.1f}{r.max_ms:>10.1f}"
+            f"{r.throughput:>8.2f}{rss:>8}{r.loop_lag_p99_ms:>9.1f}{r.loop_lag_max_ms:>9.1f}"
+        )
+
+
+async def _run(args: argparse.Namespace, inputs: dict[str, str]) -> list[Result]:
+    # The server reads its configuration at import time, so import it only
+    # once the environment points at the mock.
+    sys.path.insert(0, str(ROOT))
+    import server
+    from fastmcp import Client
+
+    table = scenarios(inputs, PROFILES[args.profile])
+    names = args.only.split(",") if args.only else list(table)
+    unknown = [n for n in names if n not in table]
+    if unknown:
+        raise SystemExit(f"Unknown scenario(s): {', '.join(unknown)}. Known: {', '.join(table)}")
+
+    results = []
+    async with Client(server.mcp) as client:
+        for name in names:
+            tool, make_args = table[name]
+            for concurrency in args.concurrency:
+                result = await run_scenario(
+                    client, name, tool, make_args, concurrency, args.calls
+                )
+                results.append(result)
+                print(f"  {name} x{concurrency}: p50 {result.p50_ms:.0f} ms", file=sys.stderr)
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark forge-painter against a mock Forge.")
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="quick")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="Mock GPU seconds per generation request (default 0.05).")
+    parser.add_argument("--concurrency", type=lambda s: [int(v) for v in s.split(",")],
+                        default=[1, 4, 16], help="Comma-separated levels (default 1,4,16).")
+    parser.add_argument("--calls", type=int, default=16, help="Calls per level (default 16).")
+    parser.add_argument("--only", default="", help="Comma-separated scenario names.")
+    parser.add_argument("--json", default="", help="Also write the results to this file.")
+    parser.add_argument("--forge-url", default="",
+                        help="Benchmark against this server instead of starting the mock.")
+    args = parser.parse_args()
+
+    workdir = Path(tempfile.mkdtemp(prefix="forge-bench-"))
+    mock = None
+    try:
+        if args.forge_url:
+            url = args.forge_url
+        else:
+            port = _free_port()
+            mock = _start_mock(port, args.latency)
+            url = f"http://127.0.0.1:{port}"
+        # Set both explicitly: config.py loads .env, which only fills in
+        # variables that are unset and could point FORGE_URLS at a real Forge.
+        os.environ["FORGE_URL"] = os.environ["FORGE_URLS"] = url
+        os.environ["OUTPUT_DIR"] = str(workdir / "outputs")
+        # Scenarios repeat fixed seeds; cached results would skip the work.
+        os.environ["RESULT_CACHE"] = "false"
+
+        inputs = _write_inputs(workdir, PROFILES[args.profile])
+        results = asyncio.run(_run(args, inputs))
+    finally:
+        if mock is not None:
+            mock.terminate()
+            mock.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    _print_table(results)
+    if args.json:
+        Path(args.json).write_text(json.dumps([asdict(r) for r in results], indent=2))
+
+
+if __name__ == "__main__":
+    main()
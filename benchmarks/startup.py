@@ -0,0 +1,146 @@
+"""
+Cold-start benchmark: how long until a freshly spawned server is usable.
+
+Each run starts ``python server.py`` over stdio, the way Claude Desktop does,
+and times the MCP handshake with raw JSON-RPC messages: the first
+``initialize`` response and the first ``tools/list`` response. A separate
+interpreter measures the import time of server.py alone, and the slowest
+modules are listed from ``python -X importtime``.
+
+    python -m benchmarks.startup
+    python -m benchmarks.startup --runs 10 --json startup.json
+
+No Forge server is needed; the server does not contact Forge at startup.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def _env(output_dir: str) -> dict[str, str]:
+    env = dict(os.environ)
+    # Point at a closed port and a scratch directory; startup must touch neither.
+    env.setdefault("FORGE_URL", "http://127.0.0.1:9")
+    env["OUTPUT_DIR"] = output_dir
+    env["PYTHONWARNINGS"] = "ignore"
+    return env
+
+
+def measure_import(env: dict[str, str]) -> float:
+    """Seconds to import server.py in a fresh interpreter."""
+    code = "import time; t = time.perf_counter(); import server; print(time.perf_counter() - t)"
+    out = subprocess.run(
+        [sys.executable, "-c", code], cwd=ROOT, env=env, capture_output=True, text=True, check=True
+    )
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def measure_handshake(env: dict[str, str]) -> tuple[float, float, int]:
+    """Seconds from spawn to the initialize and tools/list responses, and the tool count."""
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "server.py"],
+        cwd=ROOT,
+        env=env,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        text=True,
+    )
+    try:
+        def send(message: dict) -> None:
+            process.stdin.write(json.dumps(message) + "\n")
+            process.stdin.flush()
+
+        def reply(request_id: int) -> dict:
+            while True:
+                line = process.stdout.readline()
+                if not line:
+                    raise RuntimeError("The server exited during the handshake.")
+                message = json.loads(line)
+                if message.get("id") == request_id:
+                    return message
+
+        send({
+            "jsonrpc": "2.0", "id": 1, "method": "initialize",
+            "params": {
+                "protocolVersion": "2025-06-18",
+                "capabilities": {},
+                "clientInfo": {"name": "startup-benchmark", "version": "1"},
+            },
+        })
+        reply(1)
+        initialized = time.perf_counter() - started
+        send({"jsonrpc": "2.0", "method": "notifications/initialized"})
+        send({"jsonrpc": "2.0", "id": 2, "method": "tools/list"})
+        tools = reply(2)["result"]["tools"]
+        listed = time.perf_counter() - started
+    finally:
+        process.kill()
+        process.wait()
+    return initialized, listed, len(tools)
+
+
+def slowest_imports(env: dict[str, str], count: int) -> list[tuple[str, float]]:
+    """Modules imported by server.py or one level below it, by cumulative import time."""
+    out = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import server"],
+        cwd=ROOT, env=env, capture_output=True, text=True, check=True,
+    )
+    totals = []
+    for line in out.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, raw = line[len("import time:"):].split("|")
+        # Nesting is two spaces per level after one separator space; server is level 0.
+        depth = (len(raw) - len(raw.lstrip()) - 1) // 2
+        if cumulative.strip().isdigit() and depth in (1, 2):
+            totals.append((raw.strip(), int(cumulative) / 1e6))
+    return sorted(totals, key=lambda item: item[1], reverse=True)[:count]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure forge-painter's cold start.")
+    parser.add_argument("--runs", type=int, default=5, help="Spawns to measure (default 5).")
+    parser.add_argument("--json", default="", help="Also write the results to this file.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="forge-startup-") as output_dir:
+        env = _env(str(Path(output_dir) / "outputs"))
+        # One unmeasured run so every measured one finds compiled bytecode.
+        measure_handshake(env)
+        imports = [measure_import(env) for _ in range(args.runs)]
+        handshakes = [measure_handshake(env) for _ in range(args.runs)]
+        top = slowest_imports(env, 8)
+        created_output_dir = Path(output_dir, "outputs").exists()
+
+    results = {
+        "import_s": statistics.median(imports),
+        "initialize_s": statistics.median(h[0] for h in handshakes),
+        "tools_list_s": statistics.median(h[1] for h in handshakes),
+        "tools": handshakes[0][2],
+        "runs": args.runs,
+        "output_dir_created_at_startup": created_output_dir,
+    }
+    print(f"import server.py      {results['import_s'] * 1000:8.0f} ms  (median of {args.runs})")
+    print(f"initialize response   {results['initialize_s'] * 1000:8.0f} ms  (from spawn)")
+    print(f"tools/list response   {results['tools_list_s'] * 1000:8.0f} ms  ({results['tools']} tools)")
+    print(f"OUTPUT_DIR touched    {'yes' if created_output_dir else 'no':>8}")
+    print("Slowest imports under server.py:")
+    for name, seconds in top:
+        print(f"  {name:<24}{seconds * 1000:8.0f} ms")
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Tracked checkpoint switches.
+
+Forge answers the options request that changes sd_model_checkpoint before
+the new model is necessarily in memory, so a generation sent right after it
+could stall for the whole load or, racing the switch, still run on the old
+model. A switch here is a job in the scheduler's queue reserved for its
+backend: it waits for jobs already running there, and generation jobs queued
+after it wait for it. It then confirms the new checkpoint through
+/sdapi/v1/options and, with MODEL_SWITCH_WARMUP, runs a one-step 64x64
+generation so the weights are actually loaded. Each switch's duration is
+recorded per model and feeds the queue's wait estimates.
+"""
+
+import asyncio
+import logging
+import time
+
+from backends import Backend, pool
+from cache import listing_cache
+from config import MODEL_SWITCH_WARMUP, TIMEOUT_MODEL_SWITCH
+from metrics import metrics
+from scheduler import queue, switch_kind
+from utils import fetch_json, forge_client, format_error
+
+logger = logging.getLogger(__name__)
+
+# Smallest generation that makes Forge load the checkpoint's weights.
+_WARMUP = {
+    "prompt": "",
+    "steps": 1,
+    "width": 64,
+    "height": 64,
+    "batch_size": 1,
+    "n_iter": 1,
+    "save_images": False,
+    "send_images": False,
+}
+
+# Background preloads by checkpoint title, so repeated hints don't pile up.
+_preloads: dict[str, asyncio.Task] = {}
+
+
+def same_checkpoint(a: str | None, b: str | None) -> bool:
+    """Whether two checkpoint titles name the same model, with or without the hash suffix."""
+    if not a or not b:
+        return False
+    return a == b or a.split(" [")[0] == b.split(" [")[0]
+
+
+async def switch_checkpoint(backend: Backend, title: str) -> str | None:
+    """
+    Load checkpoint *title* on *backend* once its queued work is done.
+
+    Returns None when the checkpoint is confirmed loaded, or the error text.
+    """
+    if not backend.available:
+        return f"[{backend.url}] Unavailable — failing health checks."
+    others = tuple(b for b in pool.backends if b is not backend)
+    async with queue.slot(switch_kind(title), exclude=others):
+        return await _switch(backend, title)
+
+
+async def _switch(backend: Backend, title: str) -> str | None:
+    started = time.monotonic()
+    # Until the load is confirmed, the backend's model is unknown.
+    backend.checkpoint = None
+    try:
+        async with forge_client(TIMEOUT_MODEL_SWITCH, backend) as client:
+            response = await client.post("/sdapi/v1/options", json={"sd_model_checkpoint": title})
+    finally:
+        # Whatever happened, the cached options no longer describe Forge's state.
+        listing_cache.invalidate((backend.url, "/sdapi/v1/options"))
+    if response.status_code != 200:
+        return format_error(response)
+
+    options, error = await fetch_json(
+        "/sdapi/v1/options", TIMEOUT_MODEL_SWITCH, use_cache=False, backend=backend
+    )
+    if error:
+        return error
+    loaded = options.get("sd_model_checkpoint")
+    if not same_checkpoint(loaded, title):
+        backend.checkpoint = loaded
+        return (
+            f"[{backend.url}] Forge kept '{loaded}' instead of loading '{title}'. "
+            "Check the exact title with get_models()."
+        )
+
+    if MODEL_SWITCH_WARMUP:
+        async with forge_client(TIMEOUT_MODEL_SWITCH, backend) as client:
+            response = await client.post("/sdapi/v1/txt2img", json=_WARMUP)
+        if response.status_code != 200:
+            return format_error(response)
+
+    # Recorded under the caller's spelling, which queued jobs compare against.
+    backend.checkpoint = title
+    metrics.record(
+        "checkpoint_switch", time.monotonic() - started, backend=backend.url, model=title
+    )
+    return None
+
+
+def preload(title: str) -> str:
+    """
+    Start loading *title* in the background on the backend that can best spare it.
+
+    Prefers an idle backend whose current model no queued job is waiting for.
+    Returns a message describing what was scheduled.
+    """
+    holder = next((b for b in pool.backends if same_checkpoint(b.checkpoint, title)), None)
+    if holder is not None:
+        return f"'{title}' is already loaded on {holder.url}."
+    if title in _preloads:
+        return f"'{title}' is already being loaded."
+    # Unlike a job, a preload is not worth sending to a backend failing health checks.
+    candidates = [b for b in pool.backends if b.available]
+    if not candidates:
+        return "No Forge backend is available to preload on."
+
+    backend = min(
+        candidates,
+        key=lambda b: (b.active_jobs > 0, queue.demand(b.checkpoint), b.load),
+    )
+    task = asyncio.create_task(switch_checkpoint(backend, title))
+    _preloads[title] = task
+    task.add_done_callback(lambda t: _preload_done(title, backend, t))
+
+    when = "now" if backend.active_jobs == 0 else "after its current jobs"
+    return f"Loading '{title}' on {backend.url} {when} (~{queue.switch_duration(title):.0f}s)."
+
+
+def _preload_done(title: str, backend: Backend, task: asyncio.Task) -> None:
+    _preloads.pop(title, None)
+    if task.cancelled():
+        return
+    error = task.exception() or task.result()
+    if error:
+        logger.warning("Preloading '%s' on %s failed: %s", title, backend.url, error)
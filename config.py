@@ -11,10 +11,44 @@ load_dotenv()
 
 FORGE_URL: str = os.getenv("FORGE_URL", "http://127.0.0.1:7860")
 
+# Comma-separated list of Forge nodes to spread generation jobs across.
+# Defaults to the single FORGE_URL above.
+FORGE_URLS: list[str] = [
+    url.strip() for url in os.getenv("FORGE_URLS", FORGE_URL).split(",") if url.strip()
+]
+
 # Credentials for Forge's --api-auth flag (leave blank if auth is disabled).
 FORGE_API_USER: str = os.getenv("FORGE_API_USER", "")
 FORGE_API_PASSWORD: str = os.getenv("FORGE_API_PASSWORD", "")
 
+# ---------------------------------------------------------------------------
+# Connection pool
+# ---------------------------------------------------------------------------
+
+# One client per backend is shared for the lifetime of the server process, so
+# these bound how many sockets it may hold open to each Forge node at once.
+FORGE_MAX_CONNECTIONS: int = int(os.getenv("FORGE_MAX_CONNECTIONS", "10"))
+FORGE_MAX_KEEPALIVE: int = int(os.getenv("FORGE_MAX_KEEPALIVE", "5"))
+
+# Seconds an idle keep-alive connection is kept before being closed.
+FORGE_KEEPALIVE_EXPIRY: float = float(os.getenv("FORGE_KEEPALIVE_EXPIRY", "60"))
+
+# Negotiate HTTP/2 when Forge sits behind a proxy that supports it.
+# Requires the optional 'h2' package; falls back to HTTP/1.1 without it.
+FORGE_HTTP2: bool = os.getenv("FORGE_HTTP2", "").lower() in ("1", "true", "yes")
+
+# ---------------------------------------------------------------------------
+# Backend health
+# ---------------------------------------------------------------------------
+
+# Seconds between health probes of each backend in FORGE_URLS.
+BACKEND_HEALTH_INTERVAL: float = float(os.getenv("BACKEND_HEALTH_INTERVAL", "15"))
+
+# Consecutive connection failures before a backend is taken out of rotation,
+# and how many seconds it stays out before being tried again.
+BACKEND_FAILURE_THRESHOLD: int = int(os.getenv("BACKEND_FAILURE_THRESHOLD", "3"))
+BACKEND_COOLDOWN: float = float(os.getenv("BACKEND_COOLDOWN", "30"))
+
 # ---------------------------------------------------------------------------
 # Output
 # ---------------------------------------------------------------------------
@@ -23,8 +57,49 @@ FORGE_API_PASSWORD: str = os.getenv("FORGE_API_PASSWORD", "")
 # predictable regardless of what working directory the server is launched from
 # (e.g. when running via a .mcpb bundle with uv).
 _default_output = str(Path(__file__).parent / "outputs")
+# Created by the first tool that saves into it, not at startup.
 OUTPUT_DIR: Path = Path(os.getenv("OUTPUT_DIR", _default_output))
-OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+
+# Format generated images are saved in: "png" keeps the files Forge returns,
+# "webp" or "jpeg" re-encode them (a save_path ending in .webp, .jpg or .jpeg
+# picks that format for one call). Requires the optional 'Pillow' package.
+OUTPUT_FORMAT: str = os.getenv("OUTPUT_FORMAT", "png").lower()
+
+# WebP/JPEG quality from 1 to 100; 100 makes WebP lossless.
+OUTPUT_QUALITY: int = int(os.getenv("OUTPUT_QUALITY", "90"))
+
+# zlib level from 0 to 9 for the PNGs this server writes itself (tiled upscales,
+# contact sheets, conversions to PNG). Lower is faster but makes larger files;
+# Forge's own PNGs are saved as they are.
+PNG_COMPRESS_LEVEL: int = min(max(int(os.getenv("PNG_COMPRESS_LEVEL", "6")), 0), 9)
+
+# Longest side in pixels of the JPEG thumbnails returned inline with each
+# result, so clients can see images without opening the files. 0 disables them.
+THUMBNAIL_SIZE: int = int(os.getenv("THUMBNAIL_SIZE", "0"))
+
+# Processes for format conversion and thumbnails, which are CPU-bound. 0 runs
+# them on the IO_WORKERS threads instead.
+ENCODE_WORKERS: int = int(os.getenv("ENCODE_WORKERS", "2"))
+
+# Worker threads for base64 encoding/decoding and image file reads/writes, so
+# large images never block the server's event loop.
+IO_WORKERS: int = int(os.getenv("IO_WORKERS", "4"))
+
+# Memory for base64 encodings of input images, so iterative img2img/inpaint
+# calls on the same unchanged file skip re-reading and re-encoding it.
+UPLOAD_CACHE_MB: float = float(os.getenv("UPLOAD_CACHE_MB", "256"))
+
+# Shrink img2img sources far larger than the requested output size before
+# uploading them to Forge. Requires the optional 'Pillow' package.
+UPLOAD_DOWNSCALE: bool = os.getenv("UPLOAD_DOWNSCALE", "true").lower() in ("1", "true", "yes")
+
+# Parse generation responses incrementally and decode each image straight to
+# its file, so peak memory stays flat regardless of batch or image size.
+# Disable to fall back to loading the whole response before saving.
+STREAM_RESPONSES: bool = os.getenv("STREAM_RESPONSES", "true").lower() in ("1", "true", "yes")
+
+# Bytes of the response body handled per step while streaming.
+STREAM_CHUNK_SIZE: int = int(os.getenv("STREAM_CHUNK_SIZE", str(1024 * 1024)))
 
 # ---------------------------------------------------------------------------
 # Timeouts (seconds)
@@ -41,3 +116,146 @@ TIMEOUT_INFO: float = float(os.getenv("TIMEOUT_INFO", "30"))
 
 # Fire-and-forget control requests (interrupt, progress check).
 TIMEOUT_CONTROL: float = float(os.getenv("TIMEOUT_CONTROL", "10"))
+
+# Extra attempts for a request that failed transiently (a 500/502/503/504/429
+# or a dropped connection), when repeating it is safe: GETs and generations,
+# whose seed is fixed first. Waits are randomised up to FORGE_RETRY_BACKOFF
+# seconds, doubling per attempt, and every attempt shares the timeout above
+# as one deadline.
+FORGE_RETRIES: int = int(os.getenv("FORGE_RETRIES", "2"))
+FORGE_RETRY_BACKOFF: float = float(os.getenv("FORGE_RETRY_BACKOFF", "1"))
+
+# ---------------------------------------------------------------------------
+# Grid generation
+# ---------------------------------------------------------------------------
+
+# Largest batch_size txt2img_grid puts in one Forge request; longer runs of
+# seeds are split or repeated with n_iter. Bounded by the GPU's memory.
+GRID_MAX_BATCH: int = int(os.getenv("GRID_MAX_BATCH", "4"))
+
+# Largest number of cells one txt2img_grid call may generate.
+GRID_MAX_CELLS: int = int(os.getenv("GRID_MAX_CELLS", "256"))
+
+# Side in pixels of each thumbnail on a grid contact sheet.
+GRID_TILE_SIZE: int = int(os.getenv("GRID_TILE_SIZE", "256"))
+
+# ---------------------------------------------------------------------------
+# Progress notifications
+# ---------------------------------------------------------------------------
+
+# Generation tools send MCP progress notifications while Forge works, when
+# the client asked for them with a progress token.
+PROGRESS_NOTIFICATIONS: bool = os.getenv("PROGRESS_NOTIFICATIONS", "true").lower() in ("1", "true", "yes")
+
+# Seconds between progress polls: the minimum while the job is moving, backing
+# off towards the maximum while it stalls. The minimum also caps how often
+# notifications are sent; updates a slow client can't take in are dropped.
+PROGRESS_MIN_INTERVAL: float = float(os.getenv("PROGRESS_MIN_INTERVAL", "0.5"))
+PROGRESS_MAX_INTERVAL: float = float(os.getenv("PROGRESS_MAX_INTERVAL", "3"))
+
+# Also send Forge's live preview, shrunk to PROGRESS_PREVIEW_SIZE pixels, as
+# a log notification alongside each progress update. Requires 'Pillow'.
+PROGRESS_PREVIEW: bool = os.getenv("PROGRESS_PREVIEW", "").lower() in ("1", "true", "yes")
+PROGRESS_PREVIEW_SIZE: int = int(os.getenv("PROGRESS_PREVIEW_SIZE", "256"))
+
+# ---------------------------------------------------------------------------
+# Job queue
+# ---------------------------------------------------------------------------
+
+# Generation jobs for the checkpoint a backend already has loaded may jump
+# ahead of jobs for other models; this caps how many times any queued job can
+# be overtaken that way.
+QUEUE_FAIRNESS: int = int(os.getenv("QUEUE_FAIRNESS", "3"))
+
+# Seconds assumed for a checkpoint switch when estimating queue wait times.
+QUEUE_SWITCH_ESTIMATE: float = float(os.getenv("QUEUE_SWITCH_ESTIMATE", "30"))
+
+# Generation calls are turned away with an estimated wait, rather than queued,
+# once this many jobs are waiting or the estimated wait exceeds
+# QUEUE_MAX_WAIT seconds. 0 disables either check; submit_* jobs never wait
+# on a client, so they are always queued.
+QUEUE_MAX_LENGTH: int = int(os.getenv("QUEUE_MAX_LENGTH", "16"))
+QUEUE_MAX_WAIT: float = float(os.getenv("QUEUE_MAX_WAIT", "300"))
+
+# Ceiling of the adaptive number of jobs sent to one backend at once. Forge
+# runs one generation at a time, so the default never overlaps them; raise it
+# for a URL that fronts several GPUs and the limit will settle, AIMD-style, at
+# what the backend runs without its latency growing past
+# QUEUE_LATENCY_TOLERANCE times a job's latency when run alone.
+QUEUE_MAX_PER_BACKEND: int = max(int(os.getenv("QUEUE_MAX_PER_BACKEND", "1")), 1)
+QUEUE_LATENCY_TOLERANCE: float = float(os.getenv("QUEUE_LATENCY_TOLERANCE", "1.5"))
+
+# After set_model/preload_model switch a backend's checkpoint, run a one-step
+# 64x64 generation so Forge, which loads checkpoints lazily, has the weights
+# in memory before the tool returns.
+MODEL_SWITCH_WARMUP: bool = os.getenv("MODEL_SWITCH_WARMUP", "true").lower() in ("1", "true", "yes")
+
+# Finished background jobs (submit_* tools) whose results are kept for
+# job_result(); older ones are forgotten.
+JOB_HISTORY: int = int(os.getenv("JOB_HISTORY", "100"))
+
+# Journal every generation call to disk so a server restart does not lose it:
+# finished results can still be fetched, and unfinished jobs are resumed.
+JOURNAL: bool = os.getenv("JOURNAL", "true").lower() in ("1", "true", "yes")
+JOURNAL_DIR: Path = Path(os.getenv("JOURNAL_DIR", str(OUTPUT_DIR / ".journal")))
+
+# Compact the journal once this many records have been appended since it was
+# last compacted, so a long-running server doesn't grow it without bound.
+JOURNAL_COMPACT_LINES: int = int(os.getenv("JOURNAL_COMPACT_LINES", "1000"))
+
+# Re-run generation jobs that were interrupted by a restart. When disabled
+# they are reported as failed instead.
+JOURNAL_RESUME: bool = os.getenv("JOURNAL_RESUME", "true").lower() in ("1", "true", "yes")
+
+# ---------------------------------------------------------------------------
+# Listing cache (seconds)
+# ---------------------------------------------------------------------------
+
+# How long results of the listing tools are reused before asking Forge again.
+# refresh_models and set_model clear the cache immediately. Set a TTL to 0 to
+# disable caching for that group of endpoints.
+
+# Checkpoints, LoRAs, embeddings, upscalers and VAEs.
+CACHE_TTL_ASSETS: float = float(os.getenv("CACHE_TTL_ASSETS", "300"))
+
+# Samplers only change when Forge itself is updated.
+CACHE_TTL_SAMPLERS: float = float(os.getenv("CACHE_TTL_SAMPLERS", "3600"))
+
+# Forge options, i.e. the currently loaded checkpoint.
+CACHE_TTL_OPTIONS: float = float(os.getenv("CACHE_TTL_OPTIONS", "15"))
+
+# Upper bound on the number of cached responses.
+CACHE_MAX_ENTRIES: int = int(os.getenv("CACHE_MAX_ENTRIES", "64"))
+
+# ---------------------------------------------------------------------------
+# Result cache
+# ---------------------------------------------------------------------------
+
+# Reuse the output of a generation repeated with a fixed seed, identical
+# parameters, input images, checkpoint and VAE instead of running it again.
+# Requests with seed=-1 always run.
+RESULT_CACHE: bool = os.getenv("RESULT_CACHE", "true").lower() in ("1", "true", "yes")
+
+# Where cached results live, and the size past which the least recently used
+# ones are deleted.
+RESULT_CACHE_DIR: Path = Path(os.getenv("RESULT_CACHE_DIR", str(OUTPUT_DIR / ".cache")))
+RESULT_CACHE_MAX_MB: float = float(os.getenv("RESULT_CACHE_MAX_MB", "2048"))
+
+# ---------------------------------------------------------------------------
+# Metrics
+# ---------------------------------------------------------------------------
+
+# Time each phase of every tool call (queue wait, request, download, decode,
+# save) and count bytes and Forge errors, for get_server_metrics and the
+# Prometheus endpoint. Off, instrumentation reduces to a flag check.
+METRICS: bool = os.getenv("METRICS", "true").lower() in ("1", "true", "yes")
+
+# Serve the metrics in Prometheus text format at http://METRICS_HOST:METRICS_PORT/metrics
+# (0 disables). Only needed with the stdio transport; HTTP transports also
+# serve them at /metrics on the MCP server itself.
+METRICS_PORT: int = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST: str = os.getenv("METRICS_HOST", "127.0.0.1")
+
+# Also emit every span through the OpenTelemetry API, nested under FastMCP's
+# own span for the tool call. Needs an OpenTelemetry SDK and exporter set up.
+METRICS_OTEL: bool = os.getenv("METRICS_OTEL", "").lower() in ("1", "true", "yes")
@@ -0,0 +1,104 @@
+"""
+The work done in the encoder processes started by encoding.py.
+
+The processes are spawned, so each one imports the module its work lives in.
+This one only needs the standard library and Pillow, which keeps a worker
+small and quick to start; the server's own modules (fastmcp, httpx, config)
+stay out of it.
+"""
+
+import io
+import multiprocessing
+import os
+import threading
+import uuid
+from pathlib import Path
+
+# File suffix -> Pillow format name for every supported output format.
+FORMATS = {".png": "PNG", ".webp": "WEBP", ".jpg": "JPEG", ".jpeg": "JPEG"}
+
+# EXIF tags Forge uses for the generation parameters of WebP and JPEG files.
+_EXIF_IFD = 0x8769
+_USER_COMMENT = 0x9286
+
+_THUMBNAIL_QUALITY = 80
+
+
+def watch_parent() -> None:
+    """
+    Worker initializer: exit as soon as the server process is gone, however
+    it ended. A killed server never tells its pool to stop, and idle workers
+    would otherwise outlive it, keeping the resource tracker alive too.
+    """
+    parent = multiprocessing.parent_process()
+    if parent is None:
+        return
+
+    def wait() -> None:
+        parent.join()
+        os._exit(0)
+
+    threading.Thread(target=wait, name="watch-parent", daemon=True).start()
+
+
+def warm_up() -> None:
+    """Import Pillow's encoders, so the first real job doesn't wait for them."""
+    from PIL import Image
+
+    Image.init()
+
+
+def finish(
+    path: str, target: str, quality: int, png_level: int, thumbnail_size: int
+) -> tuple[str, bytes | None]:
+    """Convert *path* to *target* and make its thumbnail."""
+    from PIL import Image
+
+    # Read into memory first: the file may be replaced by its own conversion.
+    with Image.open(io.BytesIO(Path(path).read_bytes())) as image:
+        fmt = FORMATS.get(Path(target).suffix.lower())
+        if fmt is not None and fmt != image.format:
+            _convert(image, Path(target), fmt, quality, png_level)
+            if target != path:
+                os.remove(path)
+
+        thumbnail = None
+        if thumbnail_size > 0:
+            small = image.convert("RGB")
+            small.thumbnail((thumbnail_size, thumbnail_size))
+            out = io.BytesIO()
+            small.save(out, "JPEG", quality=_THUMBNAIL_QUALITY)
+            thumbnail = out.getvalue()
+    return target, thumbnail
+
+
+# ---------------------------------------------------------------------------
+# Internal helpers
+# ---------------------------------------------------------------------------
+
+def _convert(image, target: Path, fmt: str, quality: int, png_level: int) -> None:
+    from PIL import Image
+
+    options = {}
+    parameters = image.info.get("parameters")
+    if fmt != "PNG" and parameters:
+        exif = Image.Exif()
+        exif.get_ifd(_EXIF_IFD)[_USER_COMMENT] = b"UNICODE\0" + parameters.encode("utf-16-be")
+        options["exif"] = exif
+    if fmt == "WEBP" and quality >= 100:
+        options["lossless"] = True
+    elif fmt in ("WEBP", "JPEG"):
+        options["quality"] = quality
+    elif fmt == "PNG":
+        options["compress_level"] = png_level
+    if fmt == "JPEG" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    # Same naming as utils.temp_path_for, which would pull httpx in here.
+    tmp = target.with_name(f".{target.name}.{uuid.uuid4().hex[:8]}.part")
+    try:
+        image.save(tmp, fmt, **options)
+        os.replace(tmp, target)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
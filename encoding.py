@@ -0,0 +1,149 @@
+"""
+Output encoding: format conversion and inline thumbnails for saved images.
+
+Forge returns PNGs, which the generation tools save unchanged. With
+OUTPUT_FORMAT=webp or jpeg (or a save_path ending in .webp, .jpg or .jpeg)
+each saved file is re-encoded once the tool's images are complete, and the
+PNG is replaced. Forge's generation parameters, stored as PNG text, are kept
+in the EXIF UserComment field, where Forge's own WebP/JPEG saving puts them.
+With THUMBNAIL_SIZE set, a small JPEG of each result is also returned to the
+client as image content, so an agent can look at it without loading the file.
+
+Both are CPU-bound, so they run in a pool of ENCODE_WORKERS processes rather
+than on the server's threads. The work itself lives in encoder.py, which the
+workers import instead of the server. The pool is started in the background
+when the server starts (warm_up), if the settings mean it will be needed, or
+else on first use. Needs the optional Pillow package; without it images stay
+PNG and no thumbnails are made.
+"""
+
+import asyncio
+import importlib.util
+import logging
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import encoder
+from config import (
+    ENCODE_WORKERS,
+    OUTPUT_FORMAT,
+    OUTPUT_QUALITY,
+    PNG_COMPRESS_LEVEL,
+    THUMBNAIL_SIZE,
+)
+from metrics import metrics
+from utils import run_io
+
+logger = logging.getLogger(__name__)
+
+_HAS_PIL = importlib.util.find_spec("PIL") is not None
+
+_SUFFIXES = {"png": ".png", "webp": ".webp", "jpeg": ".jpg", "jpg": ".jpg"}
+_OUTPUT_SUFFIX = _SUFFIXES.get(OUTPUT_FORMAT, ".png")
+
+_pool: Executor | None = None
+
+
+@dataclass
+class FinishedImages:
+    """Final paths of a tool's saved images, and their thumbnails if enabled."""
+
+    paths: list[str] = field(default_factory=list)
+    thumbnails: list[bytes] = field(default_factory=list)
+
+
+async def finish_images(paths: list[str], thumbnails: bool = True) -> FinishedImages:
+    """
+    Convert saved images to their output format and make their thumbnails.
+
+    Returns the paths the images ended up at (the suffix changes with the
+    format) in the same order. A file that cannot be converted is left as
+    it was, with a warning logged. Pass thumbnails=False for images that
+    should not be shown inline.
+    """
+    size = THUMBNAIL_SIZE if thumbnails else 0
+    jobs = [(path, _target(Path(path))) for path in paths]
+    if not _HAS_PIL or not (size or any(_converts(target) for _, target in jobs)):
+        return FinishedImages(paths=list(paths))
+
+    with metrics.span("encode_output"):
+        results = await asyncio.gather(
+            *(
+                _run(
+                    encoder.finish, path, str(target), OUTPUT_QUALITY, PNG_COMPRESS_LEVEL, size
+                )
+                for path, target in jobs
+            ),
+            return_exceptions=True,
+        )
+
+    finished = FinishedImages()
+    for path, result in zip(paths, results):
+        if isinstance(result, BaseException):
+            logger.warning("Could not convert %s: %s", path, result)
+            finished.paths.append(path)
+            continue
+        final, thumbnail = result
+        finished.paths.append(final)
+        if thumbnail:
+            finished.thumbnails.append(thumbnail)
+    return finished
+
+
+def warm_up() -> None:
+    """
+    Start the encoder processes in the background if every result will need
+    them (thumbnails on, or a non-PNG OUTPUT_FORMAT), without waiting for them.
+    """
+    if _HAS_PIL and ENCODE_WORKERS > 0 and (THUMBNAIL_SIZE or _OUTPUT_SUFFIX != ".png"):
+        pool = _get_pool()
+        for _ in range(ENCODE_WORKERS):
+            # Each submission starts a worker while none is idle.
+            pool.submit(encoder.warm_up)
+
+
+async def shutdown() -> None:
+    """
+    Stop the encoder processes, if they were started, and wait for them to
+    exit. Queued conversions are dropped; running ones are left to finish.
+    """
+    global _pool
+    pool, _pool = _pool, None
+    if pool is not None:
+        await run_io(lambda: pool.shutdown(wait=True, cancel_futures=True))
+
+
+# ---------------------------------------------------------------------------
+# Internal helpers
+# ---------------------------------------------------------------------------
+
+def _target(path: Path) -> Path:
+    """Where *path* ends up: a .webp/.jpg/.jpeg suffix wins over OUTPUT_FORMAT."""
+    if path.suffix.lower() != ".png":
+        return path
+    return path.with_suffix(_OUTPUT_SUFFIX)
+
+
+def _converts(target: Path) -> bool:
+    return encoder.FORMATS.get(target.suffix.lower(), "PNG") != "PNG"
+
+
+async def _run(fn, *args):
+    if ENCODE_WORKERS <= 0:
+        return await run_io(fn, *args)
+    return await asyncio.get_running_loop().run_in_executor(_get_pool(), fn, *args)
+
+
+def _get_pool() -> Executor:
+    global _pool
+    if _pool is None:
+        # Spawned rather than forked: forking a process with running threads
+        # and an event loop is unsafe, and Windows can only spawn anyway.
+        _pool = ProcessPoolExecutor(
+            max_workers=ENCODE_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=encoder.watch_parent,
+        )
+    return _pool
@@ -0,0 +1,288 @@
+"""
+In-process registry of background generation jobs, backed by the journal.
+
+The submit_* tools start a generation tool as an asyncio task and return its
+job ID straight away; job_status, job_result and cancel_job look it up here.
+Queue entries created while the task runs are grouped under the same ID (see
+scheduler.current_job), so get_progress and interrupt_generation accept it too.
+
+Every generation call is also written to the on-disk journal (journal.py):
+submitted jobs here, blocking calls by JournalMiddleware. After a restart,
+recover() brings the journaled jobs back under their old IDs. Finished ones
+keep their result for job_result(), and unfinished background jobs are run
+again. A fixed-seed call identical to a running job, or to a successful one
+whose result no client has received yet, is answered by that job instead of
+generating again.
+"""
+
+import asyncio
+import inspect
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Coroutine
+
+from fastmcp.server.middleware import CallNext, Middleware, MiddlewareContext
+from fastmcp.tools.tool import ToolResult
+
+from config import JOB_HISTORY, JOURNAL_RESUME
+from journal import JournalEntry, journal, request_key, resumed_seeds
+from scheduler import current_job, new_job_id, queue
+
+logger = logging.getLogger(__name__)
+
+_INTERRUPTED = "Interrupted by a server restart."
+
+
+class RecoveredFailure(Exception):
+    """A job failure read back from the journal; its message is the original error."""
+
+    def __repr__(self) -> str:
+        return str(self)
+
+
+@dataclass(eq=False)
+class BackgroundJob:
+    """A generation tool call running detached from the MCP request."""
+
+    id: str
+    tool: str
+    task: asyncio.Task
+    args: dict[str, Any] = field(default_factory=dict)
+    created: float = field(default_factory=time.monotonic)
+    finished: float | None = None
+    # Brought back from the journal after a restart.
+    recovered: bool = False
+    # Its result has been returned to a client.
+    delivered: bool = False
+
+    @property
+    def key(self) -> str:
+        return request_key(self.tool, self.args)
+
+    @property
+    def state(self) -> str:
+        if not self.task.done():
+            entries = queue.jobs_for(self.id)
+            if entries and all(j.started is None for j in entries):
+                return "queued"
+            return "running"
+        if self.task.cancelled():
+            return "cancelled"
+        return "failed" if self.task.exception() else "done"
+
+    def describe(self) -> str:
+        end = self.finished if self.finished is not None else time.monotonic()
+        text = f"Job {self.id} ({self.tool}): {self.state}, {end - self.created:.0f}s elapsed"
+        if self.recovered:
+            text += ", recovered after a restart"
+        if self.state == "queued":
+            waiting = next(j for j in queue.jobs_for(self.id) if j.started is None)
+            text += (
+                f", queue position {queue.position(waiting)}, "
+                f"~{queue.estimate_wait(waiting):.0f}s until it starts"
+            )
+        return text
+
+
+class JobRegistry:
+    """Tracks background jobs, keeping the most recent JOB_HISTORY finished ones."""
+
+    def __init__(self, history: int) -> None:
+        self.history = history
+        # Generation tools that are journaled, with their default arguments.
+        self.tools: dict[str, dict[str, Any]] = {}
+        # Runs a generation tool by name with JSON arguments (set by tools/jobs.py).
+        self.runner: Callable[[str, dict[str, Any]], Awaitable[Any]] | None = None
+        self._jobs: dict[str, BackgroundJob] = {}
+        # Request key -> job that identical calls are answered by.
+        self._attachable: dict[str, BackgroundJob] = {}
+
+    def register(self, tool: str, defaults: dict[str, Any]) -> None:
+        """Journal calls of generation tool *tool*, whose defaults are *defaults*."""
+        self.tools[tool] = defaults
+
+    def arguments(self, tool: str, args: dict[str, Any]) -> dict[str, Any]:
+        """*args* with the tool's defaults filled in, so equal calls compare equal."""
+        return {**self.tools.get(tool, {}), **args}
+
+    def submit(self, tool: str, args: dict[str, Any]) -> BackgroundJob:
+        """Run *tool* with JSON *args* in the background under a new job ID."""
+        job_id = new_job_id()
+        journal.start(JournalEntry(job_id, tool, args, background=True))
+        job = self._start(job_id, tool, args, self.runner(tool, args))
+        if _deterministic(args):
+            self._attachable[job.key] = job
+        return job
+
+    def attachable(self, tool: str, args: dict[str, Any]) -> BackgroundJob | None:
+        """A job whose result also answers a call of *tool* with *args*, if any."""
+        return self._attachable.get(request_key(tool, args))
+
+    def delivered(self, job: BackgroundJob) -> None:
+        """Note that *job*'s result has been returned to a client."""
+        if job.delivered:
+            return
+        job.delivered = True
+        if self._attachable.get(job.key) is job:
+            del self._attachable[job.key]
+        journal.deliver(job.id)
+
+    def get(self, job_id: str) -> BackgroundJob | None:
+        return self._jobs.get(job_id)
+
+    def all(self) -> list[BackgroundJob]:
+        return list(self._jobs.values())
+
+    def recover(self) -> None:
+        """
+        Bring back the jobs journaled before the last restart.
+
+        Unfinished background jobs are run again under their old ID (or
+        marked failed without JOURNAL_RESUME). Unfinished blocking calls are
+        marked failed: nobody holds their ID, and running them again would
+        overwrite their save_path. Finished background jobs, and successful
+        blocking calls whose result never reached the client, are kept with
+        their journaled result. Must be called with the event loop running.
+        """
+        for entry in journal.load():
+            if entry.state == "running":
+                if (
+                    entry.background and JOURNAL_RESUME
+                    and entry.tool in self.tools and self.runner is not None
+                ):
+                    logger.info("Resuming job %s (%s) after a restart.", entry.id, entry.tool)
+                    job = self._start(
+                        entry.id, entry.tool, entry.args, self.runner(entry.tool, entry.args),
+                        submitted=entry.submitted, recovered=True, seeds=entry.seeds,
+                    )
+                    if _deterministic(entry.args):
+                        self._attachable[job.key] = job
+                    continue
+                journal.finish(entry.id, None, error=_INTERRUPTED, delivered=not entry.background)
+                entry.state, entry.result, entry.finished = "failed", _INTERRUPTED, time.time()
+
+            # A blocking call's failure was reported to its caller, or has no
+            # caller left to report to; only an undelivered success is kept.
+            if entry.background or (entry.state == "done" and not entry.delivered):
+                job = self._start(
+                    entry.id, entry.tool, entry.args, _replay(entry),
+                    submitted=entry.submitted, recovered=True, journaled=True,
+                )
+                job.finished = time.monotonic() - (time.time() - (entry.finished or time.time()))
+                job.delivered = entry.delivered
+                if entry.state == "done" and not entry.delivered and _deterministic(entry.args):
+                    self._attachable[job.key] = job
+
+    def _start(
+        self,
+        job_id: str,
+        tool: str,
+        args: dict[str, Any],
+        coro: Coroutine[Any, Any, Any],
+        *,
+        submitted: float | None = None,
+        recovered: bool = False,
+        journaled: bool = False,
+        seeds: dict[str, list[int]] | None = None,
+    ) -> BackgroundJob:
+        token = current_job.set(job_id)
+        # Copied, so the journaled entry keeps every seed.
+        seeds_token = resumed_seeds.set({k: list(v) for k, v in (seeds or {}).items()})
+        try:
+            # The task copies the current context, so it inherits the job ID
+            # and the seeds it drew before a restart.
+            task = asyncio.create_task(coro, name=f"{tool}:{job_id}")
+        finally:
+            resumed_seeds.reset(seeds_token)
+            current_job.reset(token)
+
+        job = BackgroundJob(job_id, tool, task, args, recovered=recovered)
+        if submitted is not None:
+            job.created = time.monotonic() - (time.time() - submitted)
+        task.add_done_callback(lambda _: self._finished(job, journaled))
+        self._jobs[job_id] = job
+        return job
+
+    def _finished(self, job: BackgroundJob, journaled: bool) -> None:
+        if job.finished is None:
+            job.finished = time.monotonic()
+        if not journaled:
+            if job.task.cancelled():
+                journal.finish(job.id, None, error="Cancelled.")
+            elif job.task.exception() is not None:
+                journal.finish(job.id, None, error=repr(job.task.exception()))
+            else:
+                journal.finish(job.id, result_text(job.task.result()))
+        if not job.task.cancelled():
+            # Failures are reported through job_result(), not the event loop.
+            job.task.exception()
+        done = [j for j in self._jobs.values() if j.finished is not None]
+        for old in done[: max(len(done) - self.history, 0)]:
+            del self._jobs[old.id]
+            if self._attachable.get(old.key) is old:
+                del self._attachable[old.key]
+
+
+class JournalMiddleware(Middleware):
+    """
+    Journals blocking generation calls, and answers a call identical to a
+    job in the registry (see JobRegistry.attachable) with that job's result.
+    """
+
+    async def on_call_tool(self, context: MiddlewareContext, call_next: CallNext) -> Any:
+        tool = context.message.name
+        if tool not in registry.tools:
+            return await call_next(context)
+        args = registry.arguments(tool, context.message.arguments or {})
+
+        job = registry.attachable(tool, args)
+        if job is not None:
+            # Shielded: this caller giving up must not cancel the shared job.
+            result = await asyncio.shield(job.task)
+            registry.delivered(job)
+            return result if isinstance(result, ToolResult) else ToolResult(content=result)
+
+        job_id = new_job_id()
+        journal.start(JournalEntry(job_id, tool, args))
+        try:
+            result = await call_next(context)
+        except BaseException as exc:
+            # The caller sees the error, so the outcome counts as delivered.
+            journal.finish(job_id, None, error=repr(exc), delivered=True)
+            raise
+        journal.finish(job_id, result_text(result), delivered=True)
+        return result
+
+
+def result_text(result: Any) -> str:
+    """The text of a tool result, without any image content."""
+    if isinstance(result, str):
+        return result
+    return "\n".join(
+        block.text for block in getattr(result, "content", []) if getattr(block, "text", None)
+    )
+
+
+def tool_defaults(fn: Callable[..., Any]) -> dict[str, Any]:
+    """Default argument values of tool function *fn*, minus the injected context."""
+    return {
+        p.name: p.default
+        for p in inspect.signature(fn).parameters.values()
+        if p.default is not p.empty and p.name != "ctx"
+    }
+
+
+def _deterministic(args: dict[str, Any]) -> bool:
+    """Whether a call with *args* always produces the same images."""
+    return args.get("seed") != -1 and -1 not in (args.get("seeds") or ())
+
+
+async def _replay(entry: JournalEntry) -> str:
+    if entry.state == "failed":
+        raise RecoveredFailure(entry.result)
+    return entry.result or ""
+
+
+# Process-wide registry used by tools/jobs.py.
+registry = JobRegistry(JOB_HISTORY)
@@ -0,0 +1,201 @@
+"""
+Append-only on-disk journal of generation jobs.
+
+Forge finishes a generation even if the MCP server process dies while
+waiting for it, so a restart (Claude Desktop restarting, uv respawning the
+server) must not lose track of the jobs in flight. Every generation call,
+blocking or submitted, is journaled under its job ID: the tool and its
+arguments when it starts, the random seeds it draws (so a resumed job draws
+the same ones), its result text or error when it ends, and a note once that
+result has been returned to a client. Records are JSON lines appended to
+JOURNAL_DIR/journal.jsonl and flushed immediately.
+
+On startup jobs.py replays the journal (JobRegistry.recover) and the file is
+compacted to one line per job: every unfinished one and the most recent
+finished ones. It is compacted again whenever JOURNAL_COMPACT_LINES more
+records have been appended. Identical calls are recognised by request_key(),
+a hash of the tool name and its canonical arguments.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import time
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import IO, Any
+
+from config import JOB_HISTORY, JOURNAL, JOURNAL_COMPACT_LINES, JOURNAL_DIR
+
+logger = logging.getLogger(__name__)
+
+# Seeds the job in this context drew before a restart, by request key, for
+# runner.py to draw again in the same order (set by jobs.py when resuming).
+resumed_seeds: ContextVar[dict[str, list[int]] | None] = ContextVar(
+    "resumed_seeds", default=None
+)
+
+
+def request_key(tool: str, args: dict[str, Any]) -> str:
+    """Hash identifying a call of *tool* with *args*, whatever their key order."""
+    canonical = json.dumps([tool, args], sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+@dataclass
+class JournalEntry:
+    """Last known state of one journaled job."""
+
+    id: str
+    tool: str
+    args: dict[str, Any]
+    background: bool = False
+    submitted: float = field(default_factory=time.time)
+    finished: float | None = None
+    # "running", "done" or "failed"; *result* holds the reply or the error.
+    state: str = "running"
+    result: str | None = None
+    delivered: bool = False
+    # Random seeds drawn for the job's Forge requests, by request key.
+    seeds: dict[str, list[int]] = field(default_factory=dict)
+
+
+class Journal:
+    """Appends job records to a file, and replays and compacts it on startup."""
+
+    def __init__(
+        self, directory: Path, history: int, compact_lines: int, enabled: bool = True
+    ) -> None:
+        self.path = directory / "journal.jsonl"
+        self.history = history
+        self.compact_lines = compact_lines
+        self.enabled = enabled
+        self._file: IO[str] | None = None
+        self._closed = False
+        # Records in the file, and the count at which it is compacted next.
+        self._lines = 0
+        self._compact_at = compact_lines
+
+    def load(self) -> list[JournalEntry]:
+        """
+        Replay the journal into one entry per job, oldest first.
+
+        The file is rewritten with just those entries, keeping every
+        unfinished job and the last *history* finished ones.
+        """
+        if not self.enabled or not self.path.exists():
+            return []
+        return self._compact()
+
+    def start(self, entry: JournalEntry) -> None:
+        self._append({"op": "start", **asdict(entry)})
+
+    def finish(
+        self, job_id: str, result: str | None, error: str | None = None, delivered: bool = False
+    ) -> None:
+        """Record how job *job_id* ended: its *result* text, or its *error*."""
+        if error is not None:
+            record = {"op": "failed", "id": job_id, "error": error}
+        else:
+            record = {"op": "done", "id": job_id, "result": result}
+        self._append({**record, "time": time.time(), "delivered": delivered})
+
+    def deliver(self, job_id: str) -> None:
+        """Record that job *job_id*'s result has reached a client."""
+        self._append({"op": "delivered", "id": job_id})
+
+    def seed(self, job_id: str, key: str, seed: int) -> None:
+        """Record that job *job_id* drew *seed* for the request with *key*."""
+        self._append({"op": "seed", "id": job_id, "key": key, "seed": seed})
+
+    def close(self) -> None:
+        """
+        Stop journaling. Jobs cancelled by the server shutting down are not
+        recorded as finished, so the next start resumes them.
+        """
+        self._closed = True
+        self._close_file()
+
+    # -- internals
+
+    @staticmethod
+    def _apply(entries: dict[str, JournalEntry], record: dict[str, Any]) -> None:
+        op = record.pop("op")
+        if op in ("start", "entry"):
+            entries[record["id"]] = JournalEntry(**record)
+            return
+        entry = entries.get(record["id"])
+        if entry is None:
+            return
+        if op in ("done", "failed"):
+            entry.state = op
+            entry.result = record["result"] if op == "done" else record["error"]
+            entry.finished = record.get("time")
+            entry.delivered = record.get("delivered", False)
+        elif op == "delivered":
+            entry.delivered = True
+        elif op == "seed":
+            entry.seeds.setdefault(record["key"], []).append(record["seed"])
+
+    def _append(self, record: dict[str, Any]) -> None:
+        if not self.enabled or self._closed:
+            return
+        try:
+            if self._file is None:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                self._file = open(self.path, "a", encoding="utf-8")
+            self._file.write(json.dumps(record, default=str) + "\n")
+            # Flushed to the OS at once, so it survives the process being killed.
+            self._file.flush()
+        except OSError as exc:
+            logger.warning("Could not write to the job journal: %s", exc)
+            return
+        self._lines += 1
+        if self._lines >= self._compact_at:
+            self._compact()
+
+    def _compact(self) -> list[JournalEntry]:
+        entries: dict[str, JournalEntry] = {}
+        try:
+            with open(self.path, encoding="utf-8") as fh:
+                for line in fh:
+                    try:
+                        self._apply(entries, json.loads(line))
+                    except (ValueError, KeyError, TypeError):
+                        # A line cut short by the crash being recovered from.
+                        continue
+        except OSError as exc:
+            logger.warning("Could not read the job journal: %s", exc)
+            return []
+
+        finished = [e for e in entries.values() if e.state != "running"]
+        for old in finished[: max(len(finished) - self.history, 0)]:
+            del entries[old.id]
+        kept = list(entries.values())
+        self._rewrite(kept)
+        # Unfinished jobs can't be dropped, so count from what is left.
+        self._lines = len(kept)
+        self._compact_at = len(kept) + self.compact_lines
+        return kept
+
+    def _close_file(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _rewrite(self, entries: list[JournalEntry]) -> None:
+        self._close_file()
+        tmp = self.path.with_suffix(".tmp")
+        try:
+            with open(tmp, "w", encoding="utf-8") as fh:
+                for entry in entries:
+                    fh.write(json.dumps({"op": "entry", **asdict(entry)}, default=str) + "\n")
+            os.replace(tmp, self.path)
+        except OSError as exc:
+            logger.warning("Could not compact the job journal: %s", exc)
+
+
+# Process-wide journal used by jobs.py.
+journal = Journal(JOURNAL_DIR, JOB_HISTORY, JOURNAL_COMPACT_LINES, JOURNAL)
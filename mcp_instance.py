@@ -1,3 +1,45 @@
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
 from fastmcp import FastMCP
 
-mcp = FastMCP("Forge-Painter")
+import encoding
+from backends import pool
+from config import JOURNAL, METRICS, METRICS_HOST, METRICS_PORT
+from jobs import JournalMiddleware, registry
+from journal import journal
+from metrics import ToolMetrics, serve_prometheus
+from scheduler import AdmissionMiddleware
+
+
+@asynccontextmanager
+async def lifespan(server: FastMCP) -> AsyncIterator[None]:
+    """
+    Keep the Forge backend clients open for the lifetime of the server, along
+    with the Prometheus listener when METRICS_PORT is set. Jobs journaled
+    before the last restart are recovered once the clients are up. Encoder
+    processes (see encoding.py) are started in the background, and stopped
+    on the way out.
+    """
+    await pool.start()
+    registry.recover()
+    encoding.warm_up()
+    exporter = await serve_prometheus(METRICS_HOST, METRICS_PORT) if METRICS and METRICS_PORT else None
+    try:
+        yield
+    finally:
+        if exporter is not None:
+            exporter.close()
+            await exporter.wait_closed()
+        await encoding.shutdown()
+        journal.close()
+        await pool.stop()
+
+
+mcp = FastMCP("Forge-Painter", lifespan=lifespan)
+if METRICS:
+    mcp.add_middleware(ToolMetrics())
+# Only blocking calls are turned away: submit_* jobs run outside any request.
+mcp.add_middleware(AdmissionMiddleware(registry.tools))
+if JOURNAL:
+    mcp.add_middleware(JournalMiddleware())
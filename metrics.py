@@ -0,0 +1,379 @@
+"""
+Timings and counters for the request hot path.
+
+Spans time one phase of a tool call: the call as a whole ("tool"), waiting
+in the job queue ("queue_wait"), a request to Forge until its response
+headers arrive ("request"), reading a streamed response body ("download"),
+base64 encoding and decoding ("encode", "decode"), writing result files
+("save") and checkpoint switches ("checkpoint_switch"). Each span is
+labelled with the tool it ran for, taken from a context variable the tool
+middleware sets, so work in the image I/O threads and in background jobs is
+attributed too. Counters track bytes sent to and received from Forge per
+endpoint, and Forge errors by status code.
+
+Everything is kept in memory and reported by get_server_metrics, as
+Prometheus text (the /metrics route on HTTP transports, or METRICS_PORT),
+and to span hooks registered with add_hook(): callables that receive every
+finished Span, e.g. to export them as OpenTelemetry spans (METRICS_OTEL).
+With METRICS off, span() returns a shared no-op and the rest return at once.
+"""
+
+import asyncio
+import bisect
+import importlib.util
+import logging
+import threading
+import time
+from collections import deque
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Callable
+
+from fastmcp.server.middleware import CallNext, Middleware, MiddlewareContext
+
+from config import METRICS, METRICS_OTEL
+
+logger = logging.getLogger(__name__)
+
+# Name of the tool the current task is working for.
+current_tool: ContextVar[str] = ContextVar("current_tool", default="")
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Histogram bucket bounds in seconds, from progress polls to 4x upscales.
+_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# Recent durations kept per series for the percentiles in get_server_metrics.
+_RECENT = 512
+
+_COUNTERS = {
+    "bytes_sent": "Request body bytes sent to Forge.",
+    "bytes_received": "Response body bytes received from Forge.",
+    "forge_errors": "Failed Forge requests, by HTTP status or 'unreachable'.",
+    "tool_errors": "Tool calls that raised an exception.",
+    "forge_retries": "Forge requests repeated after a transient failure.",
+    "queue_rejected": "Generation calls turned away because the queue was full.",
+}
+
+
+@dataclass
+class Span:
+    """One finished, timed phase, as passed to span hooks."""
+
+    name: str
+    tool: str
+    start: float  # Unix time
+    duration: float  # seconds
+    attributes: dict[str, Any] = field(default_factory=dict)
+    error: str | None = None
+
+
+class _Series:
+    """Duration histogram plus a window of recent samples."""
+
+    __slots__ = ("count", "total", "buckets", "recent")
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.buckets = [0] * (len(_BUCKETS) + 1)
+        self.recent: deque[float] = deque(maxlen=_RECENT)
+
+    def add(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        self.buckets[bisect.bisect_left(_BUCKETS, seconds)] += 1
+        self.recent.append(seconds)
+
+
+class _Timer:
+    """Context manager returned by Metrics.span()."""
+
+    __slots__ = ("_metrics", "_name", "_attributes", "_wall", "_start")
+
+    def __init__(self, metrics: "Metrics", name: str, attributes: dict[str, Any]) -> None:
+        self._metrics = metrics
+        self._name = name
+        self._attributes = attributes
+
+    def __enter__(self) -> "_Timer":
+        self._wall = time.time()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        self._metrics.record(
+            self._name,
+            time.perf_counter() - self._start,
+            start=self._wall,
+            error=exc_type.__name__ if exc_type else None,
+            **self._attributes,
+        )
+        return False
+
+
+class _NoTimer:
+    __slots__ = ()
+
+    def __enter__(self) -> "_NoTimer":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        return False
+
+
+_NO_TIMER = _NoTimer()
+
+
+class Metrics:
+    """
+    In-memory registry of span durations and counters.
+
+    Thread-safe: spans end both on the event loop and in the I/O threads.
+    Span attributes become labels, so keep them low-cardinality (endpoint
+    paths, backend URLs).
+    """
+
+    def __init__(self, enabled: bool) -> None:
+        self.enabled = enabled
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._series: dict[tuple, _Series] = {}
+        self._counters: dict[tuple, float] = {}
+        self._hooks: list[Callable[[Span], None]] = []
+
+    def span(self, name: str, **attributes: Any) -> _Timer | _NoTimer:
+        """Time the enclosed block as a span called *name*."""
+        if not self.enabled:
+            return _NO_TIMER
+        return _Timer(self, name, attributes)
+
+    def record(
+        self,
+        name: str,
+        seconds: float,
+        *,
+        start: float | None = None,
+        error: str | None = None,
+        **attributes: Any,
+    ) -> None:
+        """Add a span measured by the caller, e.g. summed over many chunks."""
+        if not self.enabled:
+            return
+        tool = current_tool.get()
+        key = (name, tool, tuple(sorted(attributes.items())))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = _Series()
+            series.add(seconds)
+        if self._hooks:
+            span = Span(
+                name, tool, start if start is not None else time.time() - seconds,
+                seconds, attributes, error,
+            )
+            for hook in self._hooks:
+                try:
+                    hook(span)
+                except Exception:
+                    logger.exception("Metrics span hook %r failed", hook)
+
+    def count(self, name: str, value: float = 1, **labels: Any) -> None:
+        """Add *value* to the counter *name* (one of _COUNTERS)."""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def add_hook(self, hook: Callable[[Span], None]) -> None:
+        """
+        Call *hook* with every finished Span.
+
+        Hooks run synchronously wherever the span ended, which may be an I/O
+        thread, so they must be quick and thread-safe.
+        """
+        self._hooks.append(hook)
+
+    def remove_hook(self, hook: Callable[[Span], None]) -> None:
+        self._hooks.remove(hook)
+
+    # -- reporting
+
+    def summary(self) -> str:
+        """Human-readable report for get_server_metrics."""
+        with self._lock:
+            series = {key: (s.count, s.total, sorted(s.recent)) for key, s in self._series.items()}
+            counters = dict(self._counters)
+
+        lines = [f"Uptime: {time.time() - self.started:.0f}s"]
+        by_tool: dict[str, list[str]] = {}
+        for (name, tool, attrs), (count, total, recent) in sorted(series.items()):
+            label = name + "".join(f" {v}" for _, v in attrs)
+            by_tool.setdefault(tool or "(no tool)", []).append(
+                f"    {label}: {count}x, avg {_ms(total / count)}, "
+                f"p50 {_ms(_pct(recent, 50))}, p95 {_ms(_pct(recent, 95))}, "
+                f"max {_ms(recent[-1])}"
+            )
+        if by_tool:
+            lines.append("Timings (percentiles over the last calls):")
+            for tool, rows in by_tool.items():
+                lines.append(f"  {tool}")
+                lines += rows
+        else:
+            lines.append("No timings recorded yet.")
+
+        for name in _COUNTERS:
+            rows = [
+                (dict(labels), value)
+                for (n, labels), value in sorted(counters.items()) if n == name
+            ]
+            if not rows:
+                continue
+            if name.startswith("bytes"):
+                parts = [f"{_label_text(labels)} {_size(value)}" for labels, value in rows]
+            else:
+                parts = [f"{_label_text(labels)} x{value:.0f}" for labels, value in rows]
+            lines.append(f"{name.replace('_', ' ').capitalize()}: " + ", ".join(parts))
+        return "\n".join(lines)
+
+    def prometheus(self) -> str:
+        """Prometheus text exposition of every series and counter."""
+        with self._lock:
+            series = {key: (s.count, s.total, list(s.buckets)) for key, s in self._series.items()}
+            counters = dict(self._counters)
+
+        out = [
+            "# HELP forge_painter_span_seconds Duration of each phase of a tool call.",
+            "# TYPE forge_painter_span_seconds histogram",
+        ]
+        for (name, tool, attrs), (count, total, buckets) in sorted(series.items()):
+            labels = {"span": name, "tool": tool, **dict(attrs)}
+            cumulative = 0
+            for bound, hits in zip((*_BUCKETS, "+Inf"), buckets):
+                cumulative += hits
+                out.append(
+                    f"forge_painter_span_seconds_bucket{_labels({**labels, 'le': bound})} {cumulative}"
+                )
+            out.append(f"forge_painter_span_seconds_sum{_labels(labels)} {total}")
+            out.append(f"forge_painter_span_seconds_count{_labels(labels)} {count}")
+
+        for name, help_text in _COUNTERS.items():
+            metric = f"forge_painter_{name}_total"
+            out.append(f"# HELP {metric} {help_text}")
+            out.append(f"# TYPE {metric} counter")
+            for (n, labels), value in sorted(counters.items()):
+                if n == name:
+                    out.append(f"{metric}{_labels(dict(labels))} {value:g}")
+
+        out.append("# HELP forge_painter_uptime_seconds Seconds since the server started.")
+        out.append("# TYPE forge_painter_uptime_seconds gauge")
+        out.append(f"forge_painter_uptime_seconds {time.time() - self.started:.0f}")
+        return "\n".join(out) + "\n"
+
+
+def _pct(ordered: list[float], pct: float) -> float:
+    return ordered[min(int(len(ordered) * pct / 100), len(ordered) - 1)]
+
+
+def _ms(seconds: float) -> str:
+    return f"{seconds * 1000:.0f}ms" if seconds < 10 else f"{seconds:.1f}s"
+
+
+def _size(size: float) -> str:
+    return f"{size / 2**20:.1f} MB" if size >= 2**20 else f"{size / 1024:.1f} KB"
+
+
+def _label_text(labels: dict[str, Any]) -> str:
+    return ",".join(str(v) for v in labels.values()) or "total"
+
+
+def _labels(labels: dict[str, Any]) -> str:
+    def escape(value: Any) -> str:
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels.items()) + "}"
+
+
+# ---------------------------------------------------------------------------
+# Integrations
+# ---------------------------------------------------------------------------
+
+class ToolMetrics(Middleware):
+    """Times every tool call and labels the spans inside it with the tool's name."""
+
+    async def on_call_tool(self, context: MiddlewareContext, call_next: CallNext) -> Any:
+        name = context.message.name
+        token = current_tool.set(name)
+        try:
+            with metrics.span("tool"):
+                return await call_next(context)
+        except Exception:
+            metrics.count("tool_errors", tool=name)
+            raise
+        finally:
+            current_tool.reset(token)
+
+
+async def serve_prometheus(host: str, port: int) -> asyncio.Server:
+    """
+    Serve GET /metrics on *host*:*port*.
+
+    For the stdio transport, which has no HTTP server of its own to mount
+    the /metrics route on.
+    """
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request = await reader.readline()
+            while (await reader.readline()).strip():
+                pass  # headers
+            parts = request.split()
+            if len(parts) >= 2 and parts[0] == b"GET" and parts[1].split(b"?")[0] == b"/metrics":
+                status, body = "200 OK", metrics.prometheus().encode("utf-8")
+            else:
+                status, body = "404 Not Found", b"Not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {PROMETHEUS_CONTENT_TYPE}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("ascii")
+                + body
+            )
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+
+def _otel_exporter() -> Callable[[Span], None]:
+    """Span hook re-emitting spans through the OpenTelemetry API."""
+    from opentelemetry import trace
+    from opentelemetry.trace import Status, StatusCode
+
+    tracer = trace.get_tracer("forge-painter")
+
+    def export(span: Span) -> None:
+        # Started in the current context, so phases nest under FastMCP's own
+        # span for the tool call.
+        otel_span = tracer.start_span(
+            f"forge.{span.name}",
+            start_time=int(span.start * 1e9),
+            attributes={"mcp.tool": span.tool, **{k: str(v) for k, v in span.attributes.items()}},
+        )
+        if span.error:
+            otel_span.set_status(Status(StatusCode.ERROR, span.error))
+        otel_span.end(end_time=int((span.start + span.duration) * 1e9))
+
+    return export
+
+
+# Process-wide registry.
+metrics = Metrics(METRICS)
+
+if METRICS and METRICS_OTEL:
+    if importlib.util.find_spec("opentelemetry") is not None:
+        metrics.add_hook(_otel_exporter())
+    else:
+        logger.warning("METRICS_OTEL is set but 'opentelemetry-api' is not installed.")
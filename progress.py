@@ -0,0 +1,179 @@
+"""
+MCP progress notifications for running generation jobs.
+
+While a generation tool waits on Forge, a ProgressReporter polls the
+backend's /sdapi/v1/progress through its pooled keep-alive client and relays
+the result to the calling client as progress notifications, so agents don't
+have to spend tool calls on get_progress. Polling speeds up while the
+percentage moves and backs off while it stands still; concurrent jobs on the
+same backend share one in-flight request.
+
+Polling and sending are decoupled: the poller only overwrites the latest
+state, and the sender forwards whatever is newest at most once per
+PROGRESS_MIN_INTERVAL. A client that reads notifications slowly therefore
+sees fewer, fresher updates instead of a growing backlog of stale ones.
+"""
+
+import asyncio
+import base64
+import importlib.util
+import io
+import logging
+from typing import Any
+
+import httpx
+from fastmcp import Context
+
+from backends import Backend
+from config import (
+    PROGRESS_MAX_INTERVAL,
+    PROGRESS_MIN_INTERVAL,
+    PROGRESS_NOTIFICATIONS,
+    PROGRESS_PREVIEW,
+    PROGRESS_PREVIEW_SIZE,
+    TIMEOUT_CONTROL,
+)
+from utils import fetch_json, run_io
+
+logger = logging.getLogger(__name__)
+
+_PROGRESS_PATH = "/sdapi/v1/progress?skip_current_image=true"
+_PREVIEW_PATH = "/sdapi/v1/progress?skip_current_image=false"
+
+# Live previews are shrunk with Pillow before sending; without it they are
+# left out rather than forwarding full-size images.
+_SEND_PREVIEWS = PROGRESS_PREVIEW and importlib.util.find_spec("PIL") is not None
+if PROGRESS_PREVIEW and not _SEND_PREVIEWS:
+    logger.warning("PROGRESS_PREVIEW is set but 'Pillow' is not installed; previews are off.")
+
+
+class ProgressReporter:
+    """
+    Relays a generation's Forge progress to one tool call's MCP client.
+
+    Use it as an async context manager around the whole generation and call
+    track() with the job's backend once the job leaves the queue. Does
+    nothing when *ctx* is None (e.g. for background jobs, whose request has
+    already been answered) or PROGRESS_NOTIFICATIONS is off.
+
+    *stage* is ``(index, count)`` for tools that run several generations in
+    one call: each one then reports within its share of the 0-100 range, so
+    progress keeps increasing across stages.
+    """
+
+    def __init__(self, ctx: Context | None, stage: tuple[int, int] = (0, 1)) -> None:
+        self.ctx = ctx if PROGRESS_NOTIFICATIONS else None
+        self.stage = stage
+        self.label = f"Stage {stage[0] + 1}/{stage[1]}" if stage[1] > 1 else "Generation"
+        self._backend: Backend | None = None
+        self._latest: tuple[float, str, str | None] | None = None
+        self._sent_progress = -1.0
+        self._changed = asyncio.Event()
+        self._tracking = asyncio.Event()
+        self._tasks: list[asyncio.Task] = []
+
+    async def __aenter__(self) -> "ProgressReporter":
+        if self.ctx is not None:
+            self._publish(0.0, f"{self.label}: waiting for a free Forge backend")
+            self._tasks = [
+                asyncio.create_task(self._poll()),
+                asyncio.create_task(self._send()),
+            ]
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def track(self, backend: Backend) -> None:
+        """Start following the backend the job now runs on."""
+        self._backend = backend
+        self._tracking.set()
+
+    # -- polling
+
+    async def _poll(self) -> None:
+        await self._tracking.wait()
+        interval = PROGRESS_MIN_INTERVAL
+        last = None
+        while True:
+            backend = self._backend
+            try:
+                data, error = await fetch_json(
+                    _PREVIEW_PATH if _SEND_PREVIEWS else _PROGRESS_PATH,
+                    TIMEOUT_CONTROL,
+                    backend=backend,
+                )
+            except httpx.HTTPError:
+                data, error = None, "unreachable"
+            if not error and isinstance(data, dict):
+                progress = float(data.get("progress") or 0.0)
+                eta = float(data.get("eta_relative") or 0.0)
+                state = data.get("state") or {}
+                step = f"step {state.get('sampling_step', 0)}/{state.get('sampling_steps', 0)}"
+                preview = data.get("current_image") if _SEND_PREVIEWS else None
+                self._publish(
+                    progress * 100,
+                    f"{self.label}: {progress * 100:.0f}% ({step}), ETA {eta:.0f}s",
+                    preview,
+                )
+                # Poll faster while the job moves, back off while it stalls
+                # (model loading, VAE decode, other users' jobs).
+                if progress != last:
+                    interval = max(interval / 2, PROGRESS_MIN_INTERVAL)
+                else:
+                    interval = min(interval * 1.5, PROGRESS_MAX_INTERVAL)
+                last = progress
+            else:
+                interval = PROGRESS_MAX_INTERVAL
+            await asyncio.sleep(interval)
+
+    def _publish(self, progress: float, message: str, preview: str | None = None) -> None:
+        index, count = self.stage
+        self._latest = ((index * 100 + progress) / count, message, preview)
+        self._changed.set()
+
+    # -- sending
+
+    async def _send(self) -> None:
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            progress, message, preview = self._latest
+            # MCP requires progress to increase with every notification, so
+            # stalls and restarts (a retry on another backend) stay silent.
+            if progress <= self._sent_progress:
+                continue
+            try:
+                await self.ctx.report_progress(progress, 100, message)
+                if preview:
+                    await self._send_preview(progress, preview)
+            except Exception as exc:
+                # The client went away; the generation itself carries on.
+                logger.debug("Dropping progress notifications: %s", exc)
+                return
+            self._sent_progress = progress
+            await asyncio.sleep(PROGRESS_MIN_INTERVAL)
+
+    async def _send_preview(self, progress: float, preview: str) -> None:
+        preview = await run_io(_shrink_preview, preview)
+        await self.ctx.log(
+            f"{self.label} preview at {progress:.0f}%",
+            level="info",
+            logger_name="forge.preview",
+            extra={"progress": progress, "mimeType": "image/jpeg", "image": preview},
+        )
+
+
+def _shrink_preview(b64: str) -> str:
+    """Downscale a base64 live preview to at most PROGRESS_PREVIEW_SIZE px."""
+    from PIL import Image
+
+    if b64.startswith("data:"):
+        b64 = b64.split(",", 1)[1]
+    with Image.open(io.BytesIO(base64.b64decode(b64))) as image:
+        image.thumbnail((PROGRESS_PREVIEW_SIZE, PROGRESS_PREVIEW_SIZE))
+        out = io.BytesIO()
+        image.convert("RGB").save(out, "JPEG", quality=80)
+    return base64.b64encode(out.getvalue()).decode("utf-8")
@@ -0,0 +1,179 @@
+"""
+Content-addressed cache of deterministic generation results.
+
+A generation with a fixed seed, identical parameters, the same checkpoint and
+VAE and the same input images produces the same pixels, so its output can be
+reused instead of spending another GPU run. Entries are keyed by a SHA-256 of
+a canonical form of all of those, stored under RESULT_CACHE_DIR, and evicted
+least-recently-used once the directory grows past RESULT_CACHE_MAX_MB.
+Requests with seed=-1 are never looked up or stored.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable
+
+from config import RESULT_CACHE_DIR, RESULT_CACHE_MAX_MB
+
+# Payload fields holding base64 images; they are hashed rather than embedded.
+_IMAGE_FIELDS = ("init_images", "mask", "image")
+
+
+def cache_key(
+    endpoint: str, payload: dict[str, Any], checkpoint: str, vae: str
+) -> str | None:
+    """
+    Canonical hash of one generation request, or None if it is not cacheable.
+
+    Blocking (hashes the input images); call it through utils.run_io().
+    """
+    if payload.get("seed", -1) == -1:
+        return None
+
+    canonical = dict(payload)
+    for name in _IMAGE_FIELDS:
+        value = canonical.get(name)
+        if isinstance(value, str):
+            canonical[name] = _digest(value)
+        elif isinstance(value, list):
+            canonical[name] = [_digest(v) for v in value]
+
+    blob = json.dumps(
+        {"endpoint": endpoint, "payload": canonical, "checkpoint": checkpoint, "vae": vae},
+        sort_keys=True,
+        separators=(",", ":"),
+        default=str,
+    )
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+def _digest(value: str) -> str:
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """
+    On-disk store of result images and their Forge info, keyed by cache_key().
+
+    Methods are blocking and meant to run in the image I/O thread pool; a lock
+    keeps the in-memory index consistent across those threads.
+    """
+
+    def __init__(self, root: Path, max_bytes: int) -> None:
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # key -> [total bytes, last used]; loaded from disk on first use.
+        self._index: dict[str, list[float]] | None = None
+
+    def fetch(
+        self, key: str, outputs: Callable[[int], Path | None]
+    ) -> dict[str, Any] | None:
+        """
+        Materialise a cached result: image i is placed at ``outputs(i)``.
+
+        Returns ``{"images": [...saved paths], "info": {...}}``, or None on a miss.
+        """
+        with self._lock:
+            index = self._load_index()
+            meta_path = self._meta_path(key)
+            if key not in index or not meta_path.exists():
+                index.pop(key, None)
+                self.misses += 1
+                return None
+            meta = json.loads(meta_path.read_text("utf-8"))
+            index[key][1] = time.time()
+            os.utime(meta_path)
+
+        saved = []
+        for i in range(meta["count"]):
+            target = outputs(i)
+            if target is None:
+                continue
+            _link_or_copy(self._image_path(key, i), target)
+            saved.append(str(target))
+        with self._lock:
+            self.hits += 1
+        return {"images": saved, "info": meta["info"]}
+
+    def store(self, key: str, images: list[str], info: dict[str, Any]) -> None:
+        """Add the saved output files of a finished generation to the cache."""
+        if self.max_bytes <= 0 or not images:
+            return
+        entry_dir = self._meta_path(key).parent
+        entry_dir.mkdir(parents=True, exist_ok=True)
+
+        size = 0
+        for i, image in enumerate(images):
+            cached = self._image_path(key, i)
+            _link_or_copy(Path(image), cached)
+            size += cached.stat().st_size
+        meta_path = self._meta_path(key)
+        meta_path.write_text(json.dumps({"count": len(images), "info": info}), "utf-8")
+        size += meta_path.stat().st_size
+
+        with self._lock:
+            index = self._load_index()
+            index[key] = [size, time.time()]
+            self._evict(index)
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            index = self._load_index()
+            return {
+                "entries": len(index),
+                "bytes": int(sum(size for size, _ in index.values())),
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def _evict(self, index: dict[str, list[float]]) -> None:
+        total = sum(size for size, _ in index.values())
+        for key, (size, _) in sorted(index.items(), key=lambda item: item[1][1]):
+            if total <= self.max_bytes:
+                break
+            for path in self._meta_path(key).parent.glob(f"{key}*"):
+                path.unlink(missing_ok=True)
+            del index[key]
+            total -= size
+
+    def _load_index(self) -> dict[str, list[float]]:
+        if self._index is None:
+            self._index = {}
+            for meta_path in self.root.glob("*/*.json"):
+                key = meta_path.stem
+                files = list(meta_path.parent.glob(f"{key}*"))
+                self._index[key] = [
+                    sum(f.stat().st_size for f in files),
+                    meta_path.stat().st_mtime,
+                ]
+        return self._index
+
+    def _meta_path(self, key: str) -> Path:
+        return self.root / key[:2] / f"{key}.json"
+
+    def _image_path(self, key: str, index: int) -> Path:
+        return self.root / key[:2] / f"{key}_{index}.png"
+
+
+def _link_or_copy(src: Path, dst: Path) -> None:
+    """Hardlink *src* to *dst* (replacing it), copying across filesystems."""
+    tmp = dst.with_name(f".{dst.name}.link")
+    tmp.unlink(missing_ok=True)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+# Process-wide result cache.
+result_cache = ResultCache(RESULT_CACHE_DIR, int(RESULT_CACHE_MAX_MB * 1024 * 1024))
@@ -0,0 +1,600 @@
+"""
+Shared request/response path for the generation tools.
+
+Forge answers generation calls with one JSON object whose "images" (or
+"image") field holds every result as a base64 string. Rather than loading the
+whole body and then decoding each string into a second copy, responses are
+parsed incrementally: image strings are base64-decoded chunk by chunk straight
+into their output files, and only the small remaining fields (info,
+parameters) are kept in memory.
+
+Seeded requests are first looked up in the result cache (result_cache.py);
+a hit is placed at the output paths without contacting Forge at all.
+"""
+
+import binascii
+import json
+import logging
+import os
+import random
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Generator
+
+import httpx
+from fastmcp import Context
+
+from backends import Backend, pool
+from config import (
+    CACHE_TTL_OPTIONS,
+    FORGE_RETRIES,
+    RESULT_CACHE,
+    STREAM_CHUNK_SIZE,
+    STREAM_RESPONSES,
+    TIMEOUT_GENERATION,
+)
+from journal import journal, request_key, resumed_seeds
+from metrics import metrics
+from progress import ProgressReporter
+from result_cache import cache_key, result_cache
+from scheduler import current_job, queue
+from utils import (
+    fetch_json,
+    forge_client,
+    format_error,
+    run_io,
+    save_images,
+    temp_path_for,
+)
+
+logger = logging.getLogger(__name__)
+
+# Maps a result index to its output file, or None to discard that image.
+OutputPaths = Callable[[int], Path | None]
+
+# Endpoints that draw a random seed for seed=-1, and the range Forge draws from.
+_SEEDED_ENDPOINTS = {"/sdapi/v1/txt2img", "/sdapi/v1/img2img"}
+_MAX_SEED = 4294967294
+
+
+@dataclass
+class GenerationResult:
+    """Outcome of one generation request."""
+
+    images: list[str] = field(default_factory=list)
+    info: dict[str, Any] = field(default_factory=dict)
+    error: str | None = None
+    job_id: str = ""
+    cached: bool = False
+    # Base64 results kept for a following stage; see run_generation(keep_images).
+    encoded: list[str] = field(default_factory=list)
+
+
+async def run_generation(
+    endpoint: str,
+    payload: dict[str, Any],
+    outputs: OutputPaths,
+    *,
+    image_key: str = "images",
+    timeout: float = TIMEOUT_GENERATION,
+    checkpoint: str | None = None,
+    ctx: Context | None = None,
+    stage: tuple[int, int] = (0, 1),
+    keep_images: bool = False,
+) -> GenerationResult:
+    """
+    POST *payload* to *endpoint* and save the returned images.
+
+    *image_key* names the response field holding the base64 result: a list for
+    txt2img/img2img ("images") or a single string for extras ("image"). The
+    job waits in the model-affinity queue for a free backend and is pinned to
+    it under a job ID while it runs. If that backend cannot be reached at all,
+    the job is queued again for the next healthy one.
+
+    *checkpoint*, when given, is loaded as part of the job via Forge's
+    override_settings, and the queue prefers a backend that already has it.
+
+    Requests with a fixed seed are served from the result cache when the same
+    request already ran on the same checkpoint and VAE (``cached`` is then
+    set), and stored in it otherwise.
+
+    Forge requests that fail transiently are retried (see utils.ForgeClient)
+    within *timeout*. So that a retry, or a background job resumed after a
+    restart, reproduces the same images, a random seed (seed=-1) is drawn
+    here rather than left to Forge, and journaled for background jobs.
+
+    With *ctx*, the calling client receives progress notifications (see
+    progress.py) while the job is queued and running; *stage* places them
+    within a multi-step tool's overall progress.
+
+    With *keep_images*, every returned image is also kept in ``encoded`` as
+    Forge's base64 string (the response is buffered rather than streamed), so
+    pipelines can hand it to the next stage without a disk round-trip;
+    *outputs* may then map every index to None. Such requests bypass the
+    result cache.
+    """
+    cacheable = RESULT_CACHE and not keep_images
+    request = payload
+    key = await _result_key(endpoint, request, checkpoint) if cacheable else None
+    if key is not None:
+        hit = await run_io(result_cache.fetch, key, outputs)
+        if hit is not None:
+            return GenerationResult(images=hit["images"], info=hit["info"], cached=True)
+
+    if (
+        endpoint in _SEEDED_ENDPOINTS and payload.get("seed", -1) == -1
+        and (FORGE_RETRIES > 0 or current_job.get() is not None)
+    ):
+        payload = {**payload, "seed": _draw_seed(endpoint, request)}
+
+    if checkpoint:
+        payload = {
+            **payload,
+            "override_settings": {
+                **payload.get("override_settings", {}),
+                "sd_model_checkpoint": checkpoint,
+            },
+            "override_settings_restore_afterwards": False,
+        }
+
+    tried: tuple[Backend, ...] = ()
+    async with ProgressReporter(ctx, stage) as progress:
+        while True:
+            async with queue.slot(endpoint, checkpoint, exclude=tried) as job:
+                metrics.record("queue_wait", job.started - job.submitted, endpoint=endpoint)
+                progress.track(job.backend)
+                # Stored under the model this backend has now, which a switch
+                # queued ahead of the job may have changed since the lookup.
+                model = checkpoint or job.backend.checkpoint
+                if cacheable:
+                    key = await _result_key(endpoint, request, checkpoint, job.backend)
+                try:
+                    result = await _post_and_save(
+                        job.backend, endpoint, payload, outputs, image_key, timeout,
+                        keep_images,
+                    )
+                except httpx.ConnectError:
+                    # Nothing reached Forge, so trying elsewhere cannot duplicate work.
+                    tried += (job.backend,)
+                    if not pool.has_alternative(tried):
+                        raise
+                    continue
+
+                if checkpoint and not result.error:
+                    job.backend.checkpoint = checkpoint
+                result.job_id = job.id
+                break
+
+    if (
+        key is not None and not result.error and result.images
+        and _rendered_with(result.info, model)
+    ):
+        try:
+            await run_io(result_cache.store, key, result.images, result.info)
+        except OSError as exc:
+            logger.warning("Could not add a result to the cache: %s", exc)
+    return result
+
+
+async def _result_key(
+    endpoint: str,
+    payload: dict[str, Any],
+    checkpoint: str | None,
+    backend: Backend | None = None,
+) -> str | None:
+    """
+    Result cache key for a request, or None if it must not be cached.
+
+    Without an explicit *checkpoint*, the model loaded on *backend* (the one
+    running the job) counts; before the job has a backend, the model loaded
+    everywhere, if no switch is under way.
+    """
+    if payload.get("seed", -1) == -1:
+        return None
+    try:
+        options, error = await fetch_json(
+            "/sdapi/v1/options", ttl=CACHE_TTL_OPTIONS, backend=backend
+        )
+    except httpx.HTTPError:
+        # Leave reporting an unreachable Forge to the generation itself.
+        return None
+    if error or not isinstance(options, dict):
+        return None
+    if not checkpoint and backend is not None:
+        checkpoint = backend.checkpoint or options.get("sd_model_checkpoint")
+    elif not checkpoint:
+        # The result depends on which node runs the job and on switches
+        # queued ahead of it, so only use the cache when neither can matter.
+        if len({b.checkpoint for b in pool.backends}) > 1 or queue.switching():
+            return None
+        checkpoint = options.get("sd_model_checkpoint")
+    if not checkpoint:
+        return None
+    return await run_io(cache_key, endpoint, payload, checkpoint, options.get("sd_vae", ""))
+
+
+def _draw_seed(endpoint: str, payload: dict[str, Any]) -> int:
+    """
+    A random seed for a seed=-1 request: the one drawn before the restart
+    when resuming a background job, otherwise a new one, journaled.
+    """
+    key = request_key(endpoint, payload)
+    drawn = resumed_seeds.get()
+    if drawn and drawn.get(key):
+        return drawn[key].pop(0)
+    seed = random.randrange(_MAX_SEED)
+    if (job_id := current_job.get()) is not None:
+        journal.seed(job_id, key, seed)
+    return seed
+
+
+def _rendered_with(info: dict[str, Any], checkpoint: str | None) -> bool:
+    """
+    Whether Forge's reply agrees that *checkpoint* made the images. Replies
+    that don't name a model (extras, mock servers) are taken on trust.
+    """
+    if not checkpoint:
+        return True
+    title = checkpoint.split(" [")[0]
+    model_hash = info.get("sd_model_hash")
+    if model_hash and checkpoint.endswith("]") and " [" in checkpoint:
+        title_hash = checkpoint.rsplit(" [", 1)[1].rstrip("]")
+        return title_hash.startswith(model_hash) or model_hash.startswith(title_hash)
+    name = info.get("sd_model_name")
+    if name:
+        return Path(title).stem == Path(name).stem
+    return True
+
+
+async def _post_and_save(
+    backend: Backend,
+    endpoint: str,
+    payload: dict[str, Any],
+    outputs: OutputPaths,
+    image_key: str,
+    timeout: float,
+    keep_images: bool = False,
+) -> GenerationResult:
+    async with forge_client(timeout, backend) as client:
+        if keep_images or not STREAM_RESPONSES:
+            response = await client.post(endpoint, json=payload, idempotent=True)
+            if response.status_code != 200:
+                return GenerationResult(error=format_error(response))
+            data = await run_io(_parse_json, response)
+            result = await _save_buffered(data, image_key, outputs)
+            if keep_images:
+                images = data.get(image_key) or []
+                result.encoded = [images] if isinstance(images, str) else list(images)
+            return result
+
+        async with client.stream("POST", endpoint, json=payload, idempotent=True) as response:
+            if response.status_code != 200:
+                await response.aread()
+                return GenerationResult(error=format_error(response))
+
+            parser = ImageStreamParser(image_key, outputs)
+            # Time spent waiting for body chunks, as opposed to handling them.
+            download = 0.0
+            try:
+                waited = time.perf_counter()
+                async for chunk in response.aiter_bytes(STREAM_CHUNK_SIZE):
+                    download += time.perf_counter() - waited
+                    await run_io(parser.feed, chunk)
+                    waited = time.perf_counter()
+                download += time.perf_counter() - waited
+                await run_io(parser.close)
+            except BaseException:
+                parser.abort()
+                raise
+            finally:
+                metrics.record("download", download, endpoint=endpoint)
+                metrics.record("decode", parser.decode_seconds)
+                metrics.record("save", parser.save_seconds)
+
+    return GenerationResult(images=parser.saved, info=_parse_info(parser.fields))
+
+
+async def _save_buffered(
+    data: dict[str, Any], image_key: str, outputs: OutputPaths
+) -> GenerationResult:
+    images = data.get(image_key) or []
+    if isinstance(images, str):
+        images = [images]
+    pairs = [(b64, outputs(i)) for i, b64 in enumerate(images)]
+    pairs = [(b64, out) for b64, out in pairs if out is not None]
+    await save_images([b64 for b64, _ in pairs], [out for _, out in pairs])
+    return GenerationResult(images=[str(out) for _, out in pairs], info=_parse_info(data))
+
+
+def _parse_json(response: httpx.Response) -> Any:
+    with metrics.span("decode"):
+        return response.json()
+
+
+def _parse_info(fields: dict[str, Any]) -> dict[str, Any]:
+    # Forge returns "info" as a JSON-encoded string rather than an object.
+    info = fields.get("info") or {}
+    if isinstance(info, str):
+        try:
+            info = json.loads(info)
+        except ValueError:
+            return {}
+    return info if isinstance(info, dict) else {}
+
+
+# ---------------------------------------------------------------------------
+# Incremental response parser
+# ---------------------------------------------------------------------------
+
+_WHITESPACE = b" \t\r\n"
+_QUOTE = ord('"')
+_SIMPLE_ESCAPES = {
+    ord('"'): b'"', ord("\\"): b"\\", ord("/"): b"/",
+    ord("b"): b"\b", ord("f"): b"\f", ord("n"): b"\n", ord("r"): b"\r", ord("t"): b"\t",
+}
+
+
+class _Base64File:
+    """
+    Decodes base64 text fed in arbitrary slices into a file.
+
+    Data goes to a temporary file that replaces *path* on close, so a failed
+    download never leaves a truncated image behind and an existing file at
+    *path* (possibly hardlinked from the result cache) is never overwritten
+    in place.
+    """
+
+    def __init__(self, path: Path | None) -> None:
+        self.path = path
+        self._tmp = temp_path_for(path) if path is not None else None
+        self._fh = open(self._tmp, "wb") if self._tmp is not None else None
+        self._pending = b""
+        self._started = False
+        self.decode_seconds = 0.0
+        self.save_seconds = 0.0
+
+    def write(self, text: bytes) -> None:
+        if self._fh is None or not text:
+            return
+        data = self._pending + text
+        if not self._started:
+            # Tolerate data URLs ("data:image/png;base64,....").
+            if len(data) < 5 or (data.startswith(b"data:") and b"," not in data):
+                self._pending = data
+                return
+            if data.startswith(b"data:"):
+                data = data[data.index(b",") + 1:]
+            self._started = True
+        usable = len(data) - len(data) % 4
+        if usable:
+            self._write(data[:usable])
+        self._pending = data[usable:]
+
+    def close(self) -> None:
+        if self._fh is None:
+            return
+        if self._pending.strip(b"="):
+            padding = b"=" * (-len(self._pending) % 4)
+            self._write(self._pending + padding)
+        started = time.perf_counter()
+        self._fh.close()
+        self._fh = None
+        os.replace(self._tmp, self.path)
+        self.save_seconds += time.perf_counter() - started
+
+    def discard(self) -> None:
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+        if self._tmp is not None:
+            self._tmp.unlink(missing_ok=True)
+
+    def _write(self, text: bytes) -> None:
+        started = time.perf_counter()
+        data = binascii.a2b_base64(text)
+        decoded = time.perf_counter()
+        self._fh.write(data)
+        self.decode_seconds += decoded - started
+        self.save_seconds += time.perf_counter() - decoded
+
+
+class ImageStreamParser:
+    """
+    Push parser for a Forge generation response.
+
+    Feed it the response body in chunks of any size. Strings under *image_key*
+    are decoded straight to the files given by *outputs*; every other
+    top-level field is collected into ``fields``. Time spent base64-decoding
+    and writing files is summed in ``decode_seconds`` and ``save_seconds``.
+    Not thread-safe: feed it from one thread at a time.
+    """
+
+    def __init__(self, image_key: str, outputs: OutputPaths) -> None:
+        self.image_key = image_key
+        self.outputs = outputs
+        self.fields: dict[str, Any] = {}
+        self.saved: list[str] = []
+        self.decode_seconds = 0.0
+        self.save_seconds = 0.0
+        self._chunk = b""
+        self._pos = 0
+        self._done = False
+        self._current: _Base64File | None = None
+        self._parser = self._parse()
+        next(self._parser)
+
+    def feed(self, chunk: bytes) -> None:
+        if self._done:
+            if chunk.strip(_WHITESPACE):
+                raise ValueError("Unexpected data after the end of the response.")
+            return
+        self._chunk, self._pos = chunk, 0
+        try:
+            self._parser.send(None)
+        except StopIteration:
+            self._done = True
+
+    def close(self) -> None:
+        if not self._done:
+            raise ValueError("Forge response ended before the JSON body was complete.")
+
+    def abort(self) -> None:
+        """Remove a partially written image after a failure."""
+        if self._current is not None:
+            self._current.discard()
+            self._add_timings(self._current)
+            self._current = None
+
+    # -- generator-based grammar; each bare ``yield`` waits for the next chunk
+
+    def _parse(self) -> Generator[None, None, None]:
+        yield
+        yield from self._skip_ws()
+        yield from self._expect(b"{")
+        while True:
+            yield from self._skip_ws()
+            if (yield from self._peek()) == ord("}"):
+                self._pos += 1
+                return
+            yield from self._expect(b'"')
+            key_parts: list[bytes] = []
+            yield from self._string(key_parts.append)
+            key = b"".join(key_parts).decode("utf-8")
+            yield from self._skip_ws()
+            yield from self._expect(b":")
+            yield from self._skip_ws()
+
+            if key == self.image_key:
+                yield from self._images()
+            else:
+                raw: list[bytes] = []
+                yield from self._raw_value(raw)
+                self.fields[key] = json.loads(b"".join(raw))
+
+            yield from self._skip_ws()
+            sep = yield from self._next()
+            if sep == ord("}"):
+                return
+            if sep != ord(","):
+                raise ValueError(f"Malformed Forge response near {chr(sep)!r}.")
+
+    def _images(self) -> Generator[None, None, None]:
+        first = yield from self._peek()
+        if first == _QUOTE:
+            self._pos += 1
+            yield from self._image(0)
+            return
+        if first != ord("["):
+            raw: list[bytes] = []
+            yield from self._raw_value(raw)
+            return
+        self._pos += 1
+        index = 0
+        while True:
+            yield from self._skip_ws()
+            b = yield from self._next()
+            if b == ord("]"):
+                return
+            if b == ord(","):
+                continue
+            if b != _QUOTE:
+                raise ValueError(f"Expected a base64 string in '{self.image_key}'.")
+            yield from self._image(index)
+            index += 1
+
+    def _image(self, index: int) -> Generator[None, None, None]:
+        out = self.outputs(index)
+        self._current = _Base64File(out)
+        yield from self._string(self._current.write)
+        self._current.close()
+        self._add_timings(self._current)
+        self._current = None
+        if out is not None:
+            self.saved.append(str(out))
+
+    def _add_timings(self, image: _Base64File) -> None:
+        self.decode_seconds += image.decode_seconds
+        self.save_seconds += image.save_seconds
+
+    def _string(
+        self, sink: Callable[[bytes], None], raw: bool = False
+    ) -> Generator[None, None, None]:
+        """Consume a string body (after its opening quote) into *sink*."""
+        while True:
+            if self._pos >= len(self._chunk):
+                yield
+                continue
+            chunk, pos = self._chunk, self._pos
+            quote = chunk.find(b'"', pos)
+            slash = chunk.find(b"\\", pos)
+            if quote == -1 and slash == -1:
+                sink(chunk[pos:])
+                self._pos = len(chunk)
+                continue
+            end = quote if slash == -1 or (quote != -1 and quote < slash) else slash
+            if end > pos:
+                sink(chunk[pos:end])
+            self._pos = end + 1
+            if end == quote:
+                return
+            esc = yield from self._next()
+            if raw:
+                sink(b"\\" + bytes([esc]))
+            elif esc == ord("u"):
+                digits = b""
+                for _ in range(4):
+                    digits += bytes([(yield from self._next())])
+                sink(chr(int(digits, 16)).encode("utf-8", "surrogatepass"))
+            elif esc in _SIMPLE_ESCAPES:
+                sink(_SIMPLE_ESCAPES[esc])
+            else:
+                raise ValueError("Invalid escape sequence in Forge response.")
+
+    def _raw_value(self, out: list[bytes]) -> Generator[None, None, None]:
+        """Copy the raw bytes of one JSON value (of any type) into *out*."""
+        depth = 0
+        while True:
+            b = yield from self._peek()
+            if b == _QUOTE:
+                self._pos += 1
+                out.append(b'"')
+                yield from self._string(out.append, raw=True)
+                out.append(b'"')
+            elif b in b"{[":
+                depth += 1
+                self._pos += 1
+                out.append(bytes([b]))
+            elif b in b"}]" or (b == ord(",") and depth == 0):
+                if depth == 0:
+                    return
+                depth -= 1
+                self._pos += 1
+                out.append(bytes([b]))
+            else:
+                self._pos += 1
+                out.append(bytes([b]))
+
+    def _skip_ws(self) -> Generator[None, None, None]:
+        while True:
+            chunk = self._chunk
+            while self._pos < len(chunk) and chunk[self._pos] in _WHITESPACE:
+                self._pos += 1
+            if self._pos < len(chunk):
+                return
+            yield
+
+    def _peek(self) -> Generator[None, None, int]:
+        while self._pos >= len(self._chunk):
+            yield
+        return self._chunk[self._pos]
+
+    def _next(self) -> Generator[None, None, int]:
+        b = yield from self._peek()
+        self._pos += 1
+        return b
+
+    def _expect(self, token: bytes) -> Generator[None, None, None]:
+        b = yield from self._next()
+        if b != token[0]:
+            raise ValueError(f"Malformed Forge response: expected {token.decode()!r}.")
@@ -0,0 +1,379 @@
+"""
+Model-affinity job queue in front of the generation tools.
+
+Forge runs one job at a time and switching checkpoints takes 10-60 seconds,
+so generation jobs wait here until a backend is free instead of piling up
+inside Forge. A free backend takes the oldest job for the checkpoint it
+already has loaded, so jobs for the current model run first; a job for
+another model may be overtaken at most QUEUE_FAIRNESS times before it runs
+regardless, so no model starves.
+
+Checkpoint switches (checkpoints.py) are queued here too, as jobs of kind
+switch_kind(model) reserved for one backend, so generation jobs queued after
+a switch never race it. Their measured durations replace
+QUEUE_SWITCH_ESTIMATE in wait estimates, per model.
+
+Each backend runs up to Backend.limit jobs at once, adapted AIMD-style
+between 1 and QUEUE_MAX_PER_BACKEND: it grows slowly while jobs sharing the
+backend run as fast as jobs run alone there, and halves when they slow down
+past QUEUE_LATENCY_TOLERANCE or time out. A few connections per backend are
+always left to the informational and control tools, which bypass the queue.
+When the queue is full (QUEUE_MAX_LENGTH, QUEUE_MAX_WAIT), AdmissionMiddleware
+turns new generation calls away at once with the estimated wait.
+"""
+
+import asyncio
+import time
+import uuid
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Container
+
+import httpx
+from fastmcp.server.middleware import CallNext, Middleware, MiddlewareContext
+from fastmcp.tools.tool import ToolResult
+
+from backends import Backend, BackendPool, pool
+from config import (
+    FORGE_MAX_CONNECTIONS,
+    QUEUE_FAIRNESS,
+    QUEUE_LATENCY_TOLERANCE,
+    QUEUE_MAX_LENGTH,
+    QUEUE_MAX_PER_BACKEND,
+    QUEUE_MAX_WAIT,
+    QUEUE_SWITCH_ESTIMATE,
+)
+from metrics import metrics
+
+# Assumed run time of a kind of job before any has been measured.
+_DEFAULT_DURATION = 30.0
+
+# Weight of the newest sample in the per-endpoint duration average.
+_DURATION_ALPHA = 0.3
+
+# Connections per backend kept free of generation jobs for progress polling
+# and the informational and control tools.
+_RESERVED_CONNECTIONS = 2
+_MAX_LIMIT = max(min(QUEUE_MAX_PER_BACKEND, FORGE_MAX_CONNECTIONS - _RESERVED_CONNECTIONS), 1)
+
+# AIMD steps: a backend's limit grows by _INCREASE / limit per job that ran at
+# the limit without slowing down, and is multiplied by _DECREASE otherwise.
+_INCREASE = 0.25
+_DECREASE = 0.5
+
+
+# ID of the submitted job (see jobs.py) the current task is working for.
+# Every queue entry it creates is grouped under that ID.
+current_job: ContextVar[str | None] = ContextVar("current_job", default=None)
+
+
+def new_job_id() -> str:
+    return uuid.uuid4().hex[:8]
+
+
+def switch_kind(checkpoint: str) -> str:
+    """Job kind of a switch to *checkpoint*; its durations are the load times."""
+    return f"load {checkpoint}"
+
+
+def is_switch(kind: str) -> bool:
+    return kind.startswith(switch_kind(""))
+
+
+@dataclass(eq=False)
+class Job:
+    """A generation request waiting for, or running on, a backend."""
+
+    id: str
+    kind: str
+    checkpoint: str | None = None
+    exclude: tuple[Backend, ...] = ()
+    group: str | None = None
+    submitted: float = field(default_factory=time.monotonic)
+    started: float | None = None
+    skipped: int = 0
+    backend: Backend | None = None
+    # Ran alongside another job on its backend at some point.
+    shared: bool = False
+    # Started when its backend reached its limit.
+    saturated: bool = False
+    # Timed out in Forge.
+    overloaded: bool = False
+    ready: asyncio.Future = field(
+        default_factory=lambda: asyncio.get_running_loop().create_future()
+    )
+
+    @property
+    def public_id(self) -> str:
+        """The ID users know this job by: its submitted job's, if any."""
+        return self.group or self.id
+
+
+class JobQueue:
+    """Dispatches queued jobs to free backends, preferring a loaded checkpoint."""
+
+    def __init__(self, backends: BackendPool) -> None:
+        self._pool = backends
+        self._pending: list[Job] = []
+        self._running: dict[str, Job] = {}
+        self._durations: dict[str, float] = {}
+        # (backend URL, kind) -> duration of such jobs when run alone there.
+        self._baselines: dict[tuple[str, str], float] = {}
+
+    @asynccontextmanager
+    async def slot(
+        self,
+        kind: str,
+        checkpoint: str | None = None,
+        exclude: tuple[Backend, ...] = (),
+    ) -> AsyncIterator[Job]:
+        """
+        Wait for a backend to run one job of *kind* (the API endpoint).
+
+        Yields the started Job, whose ``backend`` is reserved for it until the
+        block exits. *checkpoint* is the model the job needs, if any.
+        """
+        job = Job(new_job_id(), kind, checkpoint or None, exclude, current_job.get())
+        self._pending.append(job)
+        self._dispatch()
+        try:
+            await job.ready
+            yield job
+        except httpx.TimeoutException:
+            job.overloaded = True
+            raise
+        finally:
+            if job in self._pending:
+                self._pending.remove(job)
+            if job.started is not None:
+                self._finish(job)
+            self._dispatch()
+
+    def jobs_for(self, job_id: str) -> list[Job]:
+        """Running and queued entries for *job_id*, matched directly or by group."""
+        return [
+            j for j in [*self._running.values(), *self._pending]
+            if job_id in (j.id, j.group)
+        ]
+
+    def running(self) -> list[Job]:
+        return list(self._running.values())
+
+    def position(self, job: Job) -> int | None:
+        """1-based place of a waiting job in the queue, or None."""
+        return self._pending.index(job) + 1 if job in self._pending else None
+
+    def estimate_wait(self, job: Job) -> float:
+        """Rough number of seconds until *job* starts running."""
+        if job.started is not None:
+            return 0.0
+        ahead = self._pending[: self._pending.index(job)] if job in self._pending else []
+        return self._wait_behind(ahead)
+
+    def estimate_new_wait(self) -> float:
+        """Rough number of seconds a job queued now would wait to start."""
+        if not self._pending and any(self._has_room(b) for b in self._pool.candidates()):
+            return 0.0
+        return self._wait_behind(self._pending)
+
+    def full(self) -> bool:
+        """Whether a new generation call should be turned away rather than queued."""
+        if QUEUE_MAX_LENGTH > 0 and len(self._pending) >= QUEUE_MAX_LENGTH:
+            return True
+        return QUEUE_MAX_WAIT > 0 and self.estimate_new_wait() > QUEUE_MAX_WAIT
+
+    def waiting(self) -> int:
+        return len(self._pending)
+
+    def switching(self) -> bool:
+        """Whether a checkpoint switch is running or queued."""
+        return any(is_switch(j.kind) for j in [*self._running.values(), *self._pending])
+
+    def duration(self, kind: str) -> float:
+        return self._durations.get(kind, _DEFAULT_DURATION)
+
+    def switch_duration(self, checkpoint: str) -> float:
+        """Seconds a switch to *checkpoint* is expected to take."""
+        return self._durations.get(switch_kind(checkpoint), QUEUE_SWITCH_ESTIMATE)
+
+    def switch_durations(self) -> dict[str, float]:
+        """Measured switch time of every checkpoint loaded so far."""
+        prefix = switch_kind("")
+        return {
+            kind[len(prefix):]: seconds
+            for kind, seconds in self._durations.items() if kind.startswith(prefix)
+        }
+
+    def demand(self, checkpoint: str | None) -> int:
+        """Number of running and queued jobs that asked for *checkpoint*."""
+        return sum(
+            1 for j in [*self._running.values(), *self._pending] if j.checkpoint == checkpoint
+        )
+
+    def describe(self) -> str:
+        now = time.monotonic()
+        lines = [
+            f"  {job.public_id}  running on {job.backend.url} for {now - job.started:.0f}s"
+            f"  ({job.kind}, model {job.checkpoint or 'any'})"
+            for job in self._running.values()
+        ]
+        lines += [
+            f"  {job.public_id}  queued #{i + 1}, ~{self.estimate_wait(job):.0f}s wait"
+            f"  ({job.kind}, model {job.checkpoint or 'any'})"
+            for i, job in enumerate(self._pending)
+        ]
+        if not lines:
+            summary = "No generation jobs running or queued."
+        else:
+            summary = (
+                f"Jobs: {len(self._running)} running, {len(self._pending)} queued\n"
+                + "\n".join(lines)
+            )
+        switches = self.switch_durations()
+        if switches:
+            summary += "\nCheckpoint load times: " + ", ".join(
+                f"{name} ~{seconds:.0f}s" for name, seconds in sorted(switches.items())
+            )
+        return summary
+
+    # -- dispatching
+
+    def _dispatch(self) -> None:
+        while self._pending:
+            free = [b for b in self._pool.candidates() if self._has_room(b)]
+            choice = self._select(free) if free else None
+            if choice is None:
+                return
+            self._start(*choice)
+
+    def _select(self, free: list[Backend]) -> tuple[Job, Backend] | None:
+        head = self._pending[0]
+        if head.skipped >= QUEUE_FAIRNESS:
+            usable = self._usable(head, free)
+            if usable:
+                return head, self._pool.pick(head.checkpoint, usable)
+
+        # Prefer the oldest job that can run without a checkpoint switch...
+        for job in self._pending:
+            matching = [
+                b for b in self._usable(job, free)
+                if job.checkpoint is None or b.checkpoint == job.checkpoint
+            ]
+            if matching:
+                return job, self._pool.pick(job.checkpoint, matching)
+
+        # ...otherwise switch models for the oldest job that can run at all.
+        for job in self._pending:
+            usable = self._usable(job, free)
+            if usable:
+                return job, self._pool.pick(job.checkpoint, usable)
+        return None
+
+    def _usable(self, job: Job, free: list[Backend]) -> list[Backend]:
+        return [
+            b for b in free
+            if b not in job.exclude and (b.active_jobs == 0 or self._can_share(job, b))
+        ]
+
+    @staticmethod
+    def _has_room(backend: Backend) -> bool:
+        return backend.active_jobs < int(backend.limit)
+
+    def _can_share(self, job: Job, backend: Backend) -> bool:
+        """Whether *job* may start on *backend* while other jobs run there."""
+        # Checkpoint switches, and jobs that need one, must have Forge to themselves.
+        if is_switch(job.kind) or (job.checkpoint and job.checkpoint != backend.checkpoint):
+            return False
+        return not any(
+            j.backend is backend and is_switch(j.kind) for j in self._running.values()
+        )
+
+    def _start(self, job: Job, backend: Backend) -> None:
+        index = self._pending.index(job)
+        for overtaken in self._pending[:index]:
+            overtaken.skipped += 1
+        del self._pending[index]
+
+        job.started = time.monotonic()
+        job.backend = backend
+        for other in self._running.values():
+            if other.backend is backend:
+                other.shared = job.shared = True
+        self._pool.assign(job.id, backend)
+        job.saturated = not self._has_room(backend)
+        self._running[job.id] = job
+        if not job.ready.done():
+            job.ready.set_result(backend)
+
+    def _finish(self, job: Job) -> None:
+        self._running.pop(job.id, None)
+        self._pool.release(job.id)
+        elapsed = time.monotonic() - job.started
+        previous = self._durations.get(job.kind)
+        self._durations[job.kind] = (
+            elapsed if previous is None
+            else _DURATION_ALPHA * elapsed + (1 - _DURATION_ALPHA) * previous
+        )
+        if not is_switch(job.kind):
+            self._adapt(job, elapsed)
+
+    def _adapt(self, job: Job, elapsed: float) -> None:
+        """Move the limit of *job*'s backend by how long *job* took there."""
+        backend = job.backend
+        key = (backend.url, job.kind)
+        baseline = self._baselines.get(key)
+        if not job.shared and not job.overloaded:
+            self._baselines[key] = (
+                elapsed if baseline is None
+                else _DURATION_ALPHA * elapsed + (1 - _DURATION_ALPHA) * baseline
+            )
+        slowed = (
+            job.shared and baseline is not None and elapsed > QUEUE_LATENCY_TOLERANCE * baseline
+        )
+        if job.overloaded or slowed:
+            backend.limit = max(backend.limit * _DECREASE, 1.0)
+        elif job.saturated:
+            backend.limit = min(backend.limit + _INCREASE / backend.limit, _MAX_LIMIT)
+
+    def _wait_behind(self, ahead: list[Job]) -> float:
+        now = time.monotonic()
+        running = sum(
+            max(self.duration(j.kind) - (now - j.started), 0.0)
+            for j in self._running.values()
+        )
+        queued = sum(self.duration(j.kind) + self._switch_cost(j) for j in ahead)
+        return (running + queued) / max(len(self._pool.candidates()), 1)
+
+    def _switch_cost(self, job: Job) -> float:
+        if not job.checkpoint:
+            return 0.0
+        if any(b.checkpoint == job.checkpoint for b in self._pool.backends):
+            return 0.0
+        return self.switch_duration(job.checkpoint)
+
+
+class AdmissionMiddleware(Middleware):
+    """
+    Answers calls of the generation tools in *tools* with a queue-full
+    message and the estimated wait while JobQueue.full(), instead of queueing
+    them past their client's timeout. Every other tool goes straight through.
+    """
+
+    def __init__(self, tools: Container[str]) -> None:
+        self.tools = tools
+
+    async def on_call_tool(self, context: MiddlewareContext, call_next: CallNext) -> Any:
+        tool = context.message.name
+        if tool in self.tools and queue.full():
+            metrics.count("queue_rejected", tool=tool)
+            return ToolResult(content=(
+                f"Queue full: {queue.waiting()} generation job(s) are waiting, "
+                f"~{queue.estimate_new_wait():.0f}s estimated wait. Try again later, "
+                f"or use submit_{tool} to queue it in the background."
+            ))
+        return await call_next(context)
+
+
+# Process-wide queue shared by every generation tool.
+queue = JobQueue(pool)
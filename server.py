@@ -1,11 +1,17 @@
-from mcp_instance import mcp
+# The encoder processes (see encoding.py) are spawned, and spawning re-runs
+# this file as __mp_main__ in each one; they need none of the server.
+if __name__ != "__mp_main__":
+    from mcp_instance import mcp
 
-# Importing each module causes its @mcp.tool() decorators to register
-# against the shared mcp instance above.
-import tools.generation  # noqa: F401
-import tools.models      # noqa: F401
-import tools.assets      # noqa: F401
-import tools.control     # noqa: F401
+    # Importing each module causes its @mcp.tool() decorators to register
+    # against the shared mcp instance above.
+    import tools.generation  # noqa: F401
+    import tools.models      # noqa: F401
+    import tools.assets      # noqa: F401
+    import tools.control     # noqa: F401
+    import tools.jobs        # noqa: F401
 
 if __name__ == "__main__":
-    mcp.run()
+    # The banner goes to a log nobody reads under Claude Desktop, and printing
+    # it first checks PyPI for a newer FastMCP, blocking startup for up to 2s.
+    mcp.run(show_banner=False)
@@ -0,0 +1,294 @@
+"""
+Tiled upscaling for sources too large to upscale in one Forge request.
+
+The source is split into overlapping tiles, each upscaled by its own
+/sdapi/v1/extra-single-image request. Tiles go through the job queue, so
+they run in parallel on every available backend, and each result streams to
+a temporary file. The output is then stitched one row of tiles (a band) at a
+time, cross-fading linearly over the overlaps, and written with a streaming
+PNG encoder: only the current band and the overlap rows carried into the next
+one are ever held in memory, never the full-resolution canvas. Tile requests
+are likewise started a few at a time, in stitching order, rather than all at
+once.
+
+Needs the optional Pillow package.
+"""
+
+import asyncio
+import base64
+import io
+import struct
+import tempfile
+import zlib
+from collections import deque
+from pathlib import Path
+from typing import Any
+
+from fastmcp import Context
+
+from backends import pool
+from config import PNG_COMPRESS_LEVEL
+from runner import GenerationResult, run_generation
+from utils import run_io, temp_path_for
+
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# Smallest tile edge accepted, in source pixels. Smaller tiles only multiply
+# the requests (and their fixed overhead) for no saving in VRAM.
+MIN_TILE_SIZE = 128
+
+
+async def upscale_tiled(
+    image_path: str,
+    out: Path,
+    payload: dict[str, Any],
+    tile_size: int,
+    overlap: int,
+    ctx: Context | None = None,
+) -> GenerationResult:
+    """
+    Upscale *image_path* tile by tile into *out*.
+
+    *payload* holds the extras parameters (upscaler, resize factor, ...)
+    shared by every tile; the tile image itself is filled in here.
+    *tile_size* must be at least MIN_TILE_SIZE and more than twice *overlap*.
+    """
+    if tile_size < MIN_TILE_SIZE or tile_size <= 2 * overlap:
+        raise ValueError(
+            f"tile_size must be at least {MIN_TILE_SIZE} and more than twice the overlap."
+        )
+    source = await run_io(_load_rgb, image_path)
+    overlap = max(overlap, 0)
+    xs = tile_positions(source.width, tile_size, overlap)
+    ys = tile_positions(source.height, tile_size, overlap)
+    total = len(xs) * len(ys)
+    parallel = max(len(pool.backends), 1)
+    limit = asyncio.Semaphore(parallel)
+    finished = 0
+
+    with tempfile.TemporaryDirectory(prefix=".tiles-", dir=out.parent) as workdir:
+
+        async def upscale(row: int, col: int) -> Path:
+            nonlocal finished
+            box = (xs[col], ys[row], min(xs[col] + tile_size, source.width),
+                   min(ys[row] + tile_size, source.height))
+            path = Path(workdir) / f"{row}_{col}.png"
+            async with limit:
+                b64 = await run_io(_encode_tile, source, box)
+                result = await run_generation(
+                    "/sdapi/v1/extra-single-image",
+                    {**payload, "image": b64},
+                    lambda i: path if i == 0 else None,
+                    image_key="image",
+                )
+            if result.error or not result.images:
+                raise _TileError(result.error or "Forge returned no image data.")
+            finished += 1
+            if ctx is not None:
+                await ctx.report_progress(finished, total, f"{finished}/{total} tiles upscaled")
+            return path
+
+        # Tiles are started in stitching order, keeping twice as many in
+        # flight as can run, so the backends stay busy while a band is
+        # stitched without a task existing for every tile up front.
+        tiles = ((r, c) for r in range(len(ys)) for c in range(len(xs)))
+        started: deque[asyncio.Task] = deque()
+
+        def top_up() -> None:
+            while len(started) < 2 * parallel and (tile := next(tiles, None)) is not None:
+                started.append(asyncio.create_task(upscale(*tile)))
+
+        assembler = TileAssembler(out, source.size, xs, ys, tile_size)
+        try:
+            # Stitch each band as soon as its tiles are done, while the
+            # following tiles are still being upscaled.
+            for row in range(len(ys)):
+                paths = []
+                for _ in xs:
+                    top_up()
+                    paths.append(await started.popleft())
+                top_up()
+                await run_io(assembler.add_band, row, paths)
+            await run_io(assembler.close)
+        except BaseException as exc:
+            for task in started:
+                task.cancel()
+            await asyncio.gather(*started, return_exceptions=True)
+            assembler.discard()
+            if isinstance(exc, _TileError):
+                return GenerationResult(error=str(exc))
+            raise
+
+    return GenerationResult(images=[str(out)])
+
+
+def tile_positions(length: int, tile: int, overlap: int) -> list[int]:
+    """
+    Start offsets of tiles covering *length* pixels.
+
+    Tiles advance by tile - overlap; the last one is aligned to the far edge,
+    so it may overlap its neighbour by more than *overlap*.
+    """
+    if length <= tile:
+        return [0]
+    stride = tile - overlap
+    positions = list(range(0, length - tile, stride))
+    positions.append(length - tile)
+    return positions
+
+
+class _TileError(Exception):
+    """A tile request failed; carries Forge's error text."""
+
+
+class TileAssembler:
+    """
+    Stitches upscaled tiles into one PNG, one band of tiles at a time.
+
+    Bands must be added in order. The scale factor is taken from the first
+    tile, and every tile is fitted to the size that factor implies, so
+    rounding in the upscaler never opens gaps between tiles.
+    """
+
+    def __init__(
+        self,
+        out: Path,
+        size: tuple[int, int],
+        xs: list[int],
+        ys: list[int],
+        tile_size: int,
+    ) -> None:
+        self.out = out
+        self.size = size
+        self.xs = xs
+        self.ys = ys
+        self.tile_size = tile_size
+        self.scale: float | None = None
+        self._writer: PngWriter | None = None
+        self._carry = None
+
+    def add_band(self, row: int, paths: list[Path]) -> None:
+        from PIL import Image
+
+        if self.scale is None:
+            with Image.open(paths[0]) as first:
+                self.scale = first.width / min(self.tile_size, self.size[0])
+            self._writer = PngWriter(self.out, self._at(self.size[0]), self._at(self.size[1]))
+
+        top = self._at(self.ys[row])
+        bottom = self._at(min(self.ys[row] + self.tile_size, self.size[1]))
+        band = Image.new("RGB", (self._writer.width, bottom - top))
+
+        placed_to = 0
+        for col, path in enumerate(paths):
+            left = self._at(self.xs[col])
+            right = self._at(min(self.xs[col] + self.tile_size, self.size[0]))
+            with Image.open(path) as tile:
+                tile = tile.convert("RGB")
+            if tile.size != (right - left, band.height):
+                tile = tile.resize((right - left, band.height), Image.LANCZOS)
+            fade = placed_to - left
+            band.paste(tile, (left, 0), _ramp(tile.size, fade, horizontal=True) if fade > 0 else None)
+            placed_to = right
+
+        if self._carry is not None:
+            # Cross-fade the top of this band into the rows kept from the last.
+            carry = self._carry
+            fresh = band.crop((0, 0, band.width, carry.height))
+            band.paste(Image.composite(fresh, carry, _ramp(fresh.size, carry.height, horizontal=False)))
+
+        if row + 1 < len(self.ys):
+            keep_from = self._at(self.ys[row + 1]) - top
+            self._writer.write(band.crop((0, 0, band.width, keep_from)))
+            self._carry = band.crop((0, keep_from, band.width, band.height))
+        else:
+            self._writer.write(band)
+            self._carry = None
+
+    def close(self) -> None:
+        self._writer.close()
+
+    def discard(self) -> None:
+        if self._writer is not None:
+            self._writer.discard()
+
+    def _at(self, pixel: int) -> int:
+        """Output coordinate of source coordinate *pixel*."""
+        return round(pixel * self.scale)
+
+
+class PngWriter:
+    """
+    Writes an RGB PNG row block by row block without holding the whole image.
+
+    Rows are zlib-compressed as they arrive and flushed to a temporary file
+    that replaces *path* once every row has been written.
+    """
+
+    def __init__(self, path: Path, width: int, height: int) -> None:
+        self.path = path
+        self.width = width
+        self.height = height
+        self.rows = 0
+        self._tmp = temp_path_for(path)
+        self._fh = open(self._tmp, "wb")
+        self._zlib = zlib.compressobj(PNG_COMPRESS_LEVEL)
+        self._fh.write(_PNG_SIGNATURE)
+        # 8-bit truecolour, default compression/filter method, no interlace.
+        self._chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+
+    def write(self, image) -> None:
+        """Append the rows of an RGB image exactly ``width`` pixels wide."""
+        if image.mode != "RGB" or image.width != self.width:
+            raise ValueError("Rows must be RGB and match the PNG width.")
+        raw = image.tobytes()
+        stride = self.width * 3
+        # Each scanline is prefixed with filter type 0 (none).
+        data = b"".join(b"\x00" + raw[i:i + stride] for i in range(0, len(raw), stride))
+        self._chunk(b"IDAT", self._zlib.compress(data))
+        self.rows += image.height
+
+    def close(self) -> None:
+        if self.rows != self.height:
+            raise ValueError(f"PNG has {self.rows} of {self.height} rows.")
+        self._chunk(b"IDAT", self._zlib.flush())
+        self._chunk(b"IEND", b"")
+        self._fh.close()
+        self._tmp.replace(self.path)
+
+    def discard(self) -> None:
+        self._fh.close()
+        self._tmp.unlink(missing_ok=True)
+
+    def _chunk(self, kind: bytes, data: bytes) -> None:
+        if kind == b"IDAT" and not data:
+            return
+        self._fh.write(struct.pack(">I", len(data)) + kind + data)
+        self._fh.write(struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF))
+
+
+def _ramp(size: tuple[int, int], length: int, horizontal: bool):
+    """L-mode mask fading from 0 to 255 over the first *length* pixels."""
+    from PIL import Image
+
+    extent = size[0] if horizontal else size[1]
+    length = min(length, extent)
+    values = bytes(
+        round((i + 1) * 255 / (length + 1)) if i < length else 255 for i in range(extent)
+    )
+    if horizontal:
+        return Image.frombytes("L", (extent, 1), values).resize(size, Image.NEAREST)
+    return Image.frombytes("L", (1, extent), values).resize(size, Image.NEAREST)
+
+
+def _load_rgb(path: str):
+    from PIL import Image
+
+    with Image.open(path) as image:
+        return image.convert("RGB")
+
+
+def _encode_tile(source, box: tuple[int, int, int, int]) -> str:
+    buf = io.BytesIO()
+    source.crop(box).save(buf, "PNG")
+    return base64.b64encode(buf.getvalue()).decode("utf-8")
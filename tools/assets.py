@@ -1,23 +1,29 @@
-from config import TIMEOUT_INFO
+import asyncio
+from typing import Any, Callable
+
+from config import CACHE_TTL_ASSETS, CACHE_TTL_SAMPLERS
 from mcp_instance import mcp
-from utils import forge_client, format_error
+from utils import fetch_json
 
 
 @mcp.tool()
-async def get_loras() -> str:
+async def get_loras(use_cache: bool = True) -> str:
     """
     List all LoRA models available in Forge.
 
     LoRAs are lightweight style/character adapters you can activate in your
     prompt with the syntax <lora:name:weight> (e.g. <lora:character_elf:0.8>).
-    """
-    async with forge_client(TIMEOUT_INFO) as client:
-        response = await client.get("/sdapi/v1/loras")
 
-    if response.status_code != 200:
-        return format_error(response)
+    Args:
+        use_cache: Reuse a recently fetched listing. Set to False to query Forge
+                   directly, e.g. right after adding files outside refresh_models().
+    """
+    loras, error = await fetch_json(
+        "/sdapi/v1/loras", ttl=CACHE_TTL_ASSETS, use_cache=use_cache
+    )
+    if error:
+        return error
 
-    loras = response.json()
     if not loras:
         return "No LoRAs found."
 
@@ -26,39 +32,45 @@ async def get_loras() -> str:
 
 
 @mcp.tool()
-async def get_samplers() -> str:
+async def get_samplers(use_cache: bool = True) -> str:
     """
     List all sampler algorithms available in Forge.
 
     The sampler controls how diffusion steps are performed. Different samplers
     trade speed vs quality. Recommended starters: 'Euler a', 'DPM++ 2M Karras'.
-    """
-    async with forge_client(TIMEOUT_INFO) as client:
-        response = await client.get("/sdapi/v1/samplers")
 
-    if response.status_code != 200:
-        return format_error(response)
+    Args:
+        use_cache: Reuse a recently fetched listing. Set to False to query Forge
+                   directly, e.g. right after adding files outside refresh_models().
+    """
+    samplers, error = await fetch_json(
+        "/sdapi/v1/samplers", ttl=CACHE_TTL_SAMPLERS, use_cache=use_cache
+    )
+    if error:
+        return error
 
-    samplers = response.json()
     names = [s["name"] for s in samplers]
     return "Available samplers:\n  " + "\n  ".join(names)
 
 
 @mcp.tool()
-async def get_embeddings() -> str:
+async def get_embeddings(use_cache: bool = True) -> str:
     """
     List all textual inversion embeddings (TI tokens) loaded in Forge.
 
     Embeddings are activated directly in prompts by their token name, e.g.
     'masterpiece, best quality, <embedding_name>'.
-    """
-    async with forge_client(TIMEOUT_INFO) as client:
-        response = await client.get("/sdapi/v1/embeddings")
 
-    if response.status_code != 200:
-        return format_error(response)
+    Args:
+        use_cache: Reuse a recently fetched listing. Set to False to query Forge
+                   directly, e.g. right after adding files outside refresh_models().
+    """
+    data, error = await fetch_json(
+        "/sdapi/v1/embeddings", ttl=CACHE_TTL_ASSETS, use_cache=use_cache
+    )
+    if error:
+        return error
 
-    data = response.json()
     loaded = list(data.get("loaded", {}).keys())
     skipped = list(data.get("skipped", {}).keys())
 
@@ -69,38 +81,144 @@ async def get_embeddings() -> str:
 
 
 @mcp.tool()
-async def get_upscalers() -> str:
+async def get_upscalers(use_cache: bool = True) -> str:
     """
     List all upscaler models available in Forge for use with upscale_image().
-    """
-    async with forge_client(TIMEOUT_INFO) as client:
-        response = await client.get("/sdapi/v1/upscalers")
 
-    if response.status_code != 200:
-        return format_error(response)
+    Args:
+        use_cache: Reuse a recently fetched listing. Set to False to query Forge
+                   directly, e.g. right after adding files outside refresh_models().
+    """
+    upscalers, error = await fetch_json(
+        "/sdapi/v1/upscalers", ttl=CACHE_TTL_ASSETS, use_cache=use_cache
+    )
+    if error:
+        return error
 
-    upscalers = response.json()
     names = [u["name"] for u in upscalers]
     return "Available upscalers:\n  " + "\n  ".join(names)
 
 
 @mcp.tool()
-async def get_vaes() -> str:
+async def get_vaes(use_cache: bool = True) -> str:
     """
     List all VAE (Variational Autoencoder) models available in Forge.
 
     The VAE affects colour accuracy and fine detail. 'Automatic' uses the one
     baked into the checkpoint; swap it if colours look washed out or over-saturated.
-    """
-    async with forge_client(TIMEOUT_INFO) as client:
-        response = await client.get("/sdapi/v1/sd-vae")
 
-    if response.status_code != 200:
-        return format_error(response)
+    Args:
+        use_cache: Reuse a recently fetched listing. Set to False to query Forge
+                   directly, e.g. right after adding files outside refresh_models().
+    """
+    vaes, error = await fetch_json(
+        "/sdapi/v1/sd-vae", ttl=CACHE_TTL_ASSETS, use_cache=use_cache
+    )
+    if error:
+        return error
 
-    vaes = response.json()
     if not vaes:
         return "No VAEs found."
 
     names = [v["model_name"] for v in vaes]
     return "Available VAEs:\n  " + "\n  ".join(names)
+
+
+@mcp.tool()
+async def get_inventory(
+    kinds: str = "",
+    search: str = "",
+    limit: int = 25,
+    use_cache: bool = True,
+) -> str:
+    """
+    List models, LoRAs, samplers, embeddings, upscalers and VAEs in one call.
+
+    The listings are fetched from Forge in parallel. Each kind is summarised
+    on one line with its total count and at most *limit* names, so this stays
+    compact even with thousands of LoRAs; use *search* to find specific ones
+    instead of paging through everything.
+
+    Args:
+        kinds:     Comma-separated subset to include, e.g. "models,loras".
+                   Leave empty for all of: models, loras, samplers, embeddings,
+                   upscalers, vaes.
+        search:    Only list names containing every word of this text,
+                   case-insensitively (e.g. "elf xl"). LoRA aliases match too.
+        limit:     Maximum names shown per kind; counts always cover every match.
+        use_cache: Reuse recently fetched listings. Set to False to query Forge
+                   directly, e.g. right after adding files outside refresh_models().
+    """
+    wanted = [k.strip().lower() for k in kinds.split(",") if k.strip()] or list(_INVENTORY)
+    unknown = [k for k in wanted if k not in _INVENTORY]
+    if unknown:
+        return f"Unknown kind(s): {', '.join(unknown)}. Choose from: {', '.join(_INVENTORY)}."
+
+    results = await asyncio.gather(*(
+        fetch_json(_INVENTORY[k][0], ttl=_INVENTORY[k][1], use_cache=use_cache) for k in wanted
+    ))
+    terms = search.lower().split()
+    limit = max(limit, 0)
+
+    lines = []
+    for kind, (data, error) in zip(wanted, results):
+        if error:
+            lines.append(f"{kind}: {error}")
+            continue
+        index = _index(kind, data)
+        names = [name for folded, name in index if all(t in folded for t in terms)]
+        count = f"{len(names)} of {len(index)} match" if terms else f"{len(index)}"
+        shown = ", ".join(names[:limit])
+        more = f" … (+{len(names) - limit} more)" if len(names) > limit else ""
+        lines.append(f"{kind} ({count}): {shown or 'none'}{more}")
+    return "\n".join(lines)
+
+
+# ---------------------------------------------------------------------------
+# Internal helpers
+# ---------------------------------------------------------------------------
+
+# Inventory kind -> (endpoint, cache TTL, names of the listed entries).
+# Each name is paired with extra text that searches match as well.
+_INVENTORY: dict[str, tuple[str, float, Callable[[Any], list[tuple[str, str]]]]] = {
+    "models": (
+        "/sdapi/v1/sd-models", CACHE_TTL_ASSETS,
+        lambda data: [(m["title"], "") for m in data],
+    ),
+    "loras": (
+        "/sdapi/v1/loras", CACHE_TTL_ASSETS,
+        lambda data: [(l["name"], l.get("alias") or "") for l in data],
+    ),
+    "samplers": (
+        "/sdapi/v1/samplers", CACHE_TTL_SAMPLERS,
+        lambda data: [(s["name"], " ".join(s.get("aliases") or ())) for s in data],
+    ),
+    "embeddings": (
+        "/sdapi/v1/embeddings", CACHE_TTL_ASSETS,
+        lambda data: [(name, "") for name in data.get("loaded", {})],
+    ),
+    "upscalers": (
+        "/sdapi/v1/upscalers", CACHE_TTL_ASSETS,
+        lambda data: [(u["name"], "") for u in data],
+    ),
+    "vaes": (
+        "/sdapi/v1/sd-vae", CACHE_TTL_ASSETS,
+        lambda data: [(v["model_name"], "") for v in data],
+    ),
+}
+
+# Inventory kind -> (listing it was built from, [(lower-cased search text, name)]).
+# Rebuilt only when fetch_json returns a new listing, not on every search.
+_indexes: dict[str, tuple[Any, list[tuple[str, str]]]] = {}
+
+
+def _index(kind: str, data: Any) -> list[tuple[str, str]]:
+    cached = _indexes.get(kind)
+    if cached is not None and cached[0] is data:
+        return cached[1]
+    index = [
+        (f"{name} {extra}".lower(), name)
+        for name, extra in sorted(_INVENTORY[kind][2](data), key=lambda e: e[0].lower())
+    ]
+    _indexes[kind] = (data, index)
+    return index
@@ -1,49 +1,205 @@
-from config import TIMEOUT_CONTROL
+import asyncio
+
+import httpx
+from starlette.requests import Request
+from starlette.responses import Response
+
+from backends import Backend, pool
+from cache import inflight_gets, listing_cache, upload_cache
+from config import METRICS, TIMEOUT_CONTROL
 from mcp_instance import mcp
-from utils import forge_client, format_error
+from metrics import PROMETHEUS_CONTENT_TYPE, metrics
+from result_cache import result_cache
+from scheduler import Job, queue
+from utils import fetch_json, forge_client, format_error, run_io
+
+# The text-only tools never need Forge's live preview image.
+_PROGRESS_PATH = "/sdapi/v1/progress?skip_current_image=true"
 
 
 @mcp.tool()
-async def get_progress() -> str:
+async def get_progress(job_id: str = "") -> str:
     """
     Check the progress of the currently running generation in Forge.
 
     Returns the completion percentage and estimated time remaining.
-    Returns 'idle' if nothing is generating.
-    """
-    async with forge_client(TIMEOUT_CONTROL) as client:
-        response = await client.get("/sdapi/v1/progress")
+    Returns 'idle' if nothing is generating. When several Forge backends are
+    configured, each one is reported along with the IDs of jobs running on it.
 
-    if response.status_code != 200:
-        return format_error(response)
+    Args:
+        job_id: Only report the backend running this job, or the queue
+                position and expected wait if it has not started yet.
+    """
+    waiting = _queued_only(job_id)
+    if waiting:
+        return (
+            f"Job {job_id} is queued at position {queue.position(waiting)}; "
+            f"expected to start in ~{queue.estimate_wait(waiting):.0f}s."
+        )
 
-    data = response.json()
-    progress = data.get("progress", 0)
+    backends = _target_backends(job_id)
+    if backends is None:
+        return f"No running job with ID '{job_id}'."
 
-    if progress == 0 and not data.get("state", {}).get("job_count"):
-        return "Forge is idle — no generation in progress."
+    if len(pool.backends) == 1:
+        return await _progress(pool.backends[0])
 
-    eta = data.get("eta_relative", 0)
-    job = data.get("state", {}).get("job", "unknown")
-    return (
-        f"Generation in progress: {progress * 100:.1f}% complete\n"
-        f"Current job: {job}\n"
-        f"ETA: {eta:.1f}s"
-    )
+    # Report paused backends too, so a dead node doesn't silently vanish.
+    if not job_id:
+        backends = pool.backends
+    reports = await asyncio.gather(*(_progress(b) for b in backends))
+    return "\n\n".join(reports)
 
 
 @mcp.tool()
-async def interrupt_generation() -> str:
+async def interrupt_generation(job_id: str = "") -> str:
     """
     Interrupt (cancel) the currently running generation in Forge immediately.
 
     Use this if a generation is taking too long or if you submitted the wrong
     prompt and want to stop it before it finishes.
+
+    Args:
+        job_id: Only interrupt the backend running this job (see get_progress).
+                Leave empty to interrupt every backend.
     """
-    async with forge_client(TIMEOUT_CONTROL) as client:
-        response = await client.post("/sdapi/v1/interrupt")
+    if _queued_only(job_id):
+        return f"Job {job_id} is still queued; nothing is running to interrupt."
+
+    backends = _target_backends(job_id)
+    if backends is None:
+        return f"No running job with ID '{job_id}'."
 
-    if response.status_code != 200:
-        return format_error(response)
+    async def interrupt(backend: Backend) -> str | None:
+        async with forge_client(TIMEOUT_CONTROL, backend) as client:
+            response = await client.post("/sdapi/v1/interrupt")
+        return format_error(response) if response.status_code != 200 else None
+
+    errors = [e for e in await asyncio.gather(*(interrupt(b) for b in backends)) if e]
+    if errors:
+        return "\n".join(errors)
 
     return "Generation interrupted."
+
+
+@mcp.tool()
+async def get_queue() -> str:
+    """
+    List generation jobs that are running or waiting for a free backend,
+    with each queued job's position and expected wait.
+
+    Jobs for the checkpoint a backend already has loaded are run first, so
+    the order can differ from submission order.
+    """
+    return queue.describe()
+
+
+@mcp.tool()
+async def get_backends() -> str:
+    """
+    Show the health, load and loaded checkpoint of each configured Forge
+    backend (see FORGE_URLS).
+    """
+    return "Forge backends:\n" + "\n".join(f"  {b.describe()}" for b in pool.backends)
+
+
+@mcp.tool()
+async def get_cache_stats() -> str:
+    """
+    Report how often listing tools (get_models, get_loras, ...) were answered
+    from the local cache instead of asking Forge again, and how many requests
+    were saved by sharing one in-flight request between concurrent callers.
+    Also reports the result cache that serves repeated fixed-seed generations
+    and the cache of encoded input images.
+    """
+    stats = listing_cache.stats()
+    lookups = stats["hits"] + stats["misses"]
+    hit_rate = stats["hits"] / lookups * 100 if lookups else 0.0
+    flights = inflight_gets.stats()
+    results = await run_io(result_cache.stats)
+    uploads = upload_cache.stats()
+    return (
+        f"Listing cache: {stats['entries']}/{stats['maxsize']} entries\n"
+        f"Hits: {stats['hits']}  Misses: {stats['misses']}  Hit rate: {hit_rate:.1f}%\n"
+        f"Requests sent: {flights['started']}  Coalesced: {flights['shared']}\n"
+        f"Result cache: {results['entries']} results, "
+        f"{results['bytes'] / 2**20:.1f}/{results['max_bytes'] / 2**20:.0f} MB, "
+        f"hits {results['hits']}, misses {results['misses']}\n"
+        f"Upload cache: {uploads['entries']} images, "
+        f"{uploads['bytes'] / 2**20:.1f}/{uploads['max_bytes'] / 2**20:.0f} MB, "
+        f"hits {uploads['hits']}, misses {uploads['misses']}"
+    )
+
+
+@mcp.tool()
+async def get_server_metrics() -> str:
+    """
+    Report where the time in tool calls goes: waiting in the job queue, the
+    Forge request itself, downloading, decoding and saving the images, and
+    checkpoint switches, per tool. Also reports bytes exchanged with Forge
+    per endpoint and Forge errors by status code.
+    """
+    if not METRICS:
+        return "Metrics are disabled (METRICS=false)."
+    return metrics.summary()
+
+
+@mcp.custom_route("/metrics", methods=["GET"], include_in_schema=False)
+async def prometheus_metrics(request: Request) -> Response:
+    """Prometheus scrape endpoint, served when running over an HTTP transport."""
+    return Response(metrics.prometheus(), media_type=PROMETHEUS_CONTENT_TYPE)
+
+
+# ---------------------------------------------------------------------------
+# Internal helpers
+# ---------------------------------------------------------------------------
+
+def _target_backends(job_id: str) -> list[Backend] | None:
+    """Backends a control call applies to, or None for an unknown job ID."""
+    if not job_id:
+        return [b for b in pool.backends if b.available] or pool.backends
+    backends = {j.backend for j in queue.jobs_for(job_id) if j.started is not None}
+    return list(backends) or None
+
+
+def _queued_only(job_id: str) -> Job | None:
+    """The first queue entry of *job_id* if none of its entries has started."""
+    jobs = queue.jobs_for(job_id) if job_id else []
+    if jobs and all(j.started is None for j in jobs):
+        return jobs[0]
+    return None
+
+
+async def _progress(backend: Backend) -> str:
+    if len(pool.backends) == 1:
+        data, error = await fetch_json(_PROGRESS_PATH, TIMEOUT_CONTROL)
+        prefix = ""
+    else:
+        prefix = f"[{backend.url}] "
+        if not backend.available:
+            return prefix + "Unavailable — failing health checks."
+        try:
+            data, error = await fetch_json(
+                _PROGRESS_PATH, TIMEOUT_CONTROL, backend=backend
+            )
+        except httpx.HTTPError as exc:
+            return prefix + f"Unreachable: {exc}"
+    if error:
+        return prefix + error
+
+    jobs = sorted({j.public_id for j in queue.running() if j.backend is backend})
+    if jobs:
+        prefix += f"Jobs {', '.join(jobs)}: "
+
+    progress = data.get("progress", 0)
+
+    if progress == 0 and not data.get("state", {}).get("job_count"):
+        return prefix + "Forge is idle — no generation in progress."
+
+    eta = data.get("eta_relative", 0)
+    job = data.get("state", {}).get("job", "unknown")
+    return prefix + (
+        f"Generation in progress: {progress * 100:.1f}% complete\n"
+        f"Current job: {job}\n"
+        f"ETA: {eta:.1f}s"
+    )
@@ -1,8 +1,35 @@
+import asyncio
+import base64
+import importlib.util
+import io
+import itertools
+import os
+from dataclasses import dataclass
 from pathlib import Path
-
-from config import OUTPUT_DIR, TIMEOUT_GENERATION
+from typing import Any
+
+import httpx
+from fastmcp import Context
+from fastmcp.tools.tool import ToolResult
+from fastmcp.utilities.types import Image as ImageContent
+
+from backends import pool
+from config import (
+    GRID_MAX_BATCH,
+    GRID_MAX_CELLS,
+    GRID_TILE_SIZE,
+    OUTPUT_DIR,
+    PNG_COMPRESS_LEVEL,
+)
+from encoding import FinishedImages, finish_images
 from mcp_instance import mcp
-from utils import decode_and_save, encode_image, forge_client, format_error
+from runner import GenerationResult, run_generation
+from tiling import MIN_TILE_SIZE, upscale_tiled
+from utils import decode_and_save, encode_image, run_io, temp_path_for
+
+# Contact sheets for txt2img_grid, tiled upscaling and concurrent
+# inpaint_regions need the optional Pillow package.
+_HAS_PIL = importlib.util.find_spec("PIL") is not None
 
 
 @mcp.tool()
@@ -17,7 +44,9 @@ async def txt2img(
     seed: int = -1,
     batch_size: int = 1,
     save_path: str = "output.png",
-) -> str:
+    checkpoint: str = "",
+    ctx: Context | None = None,
+) -> str | ToolResult:
     """
     Generate one or more images from a text prompt using Stable Diffusion Forge.
 
@@ -38,6 +67,9 @@ async def txt2img(
         batch_size: Number of images to generate in one request.
         save_path: Filename for the output PNG. Relative paths are placed inside
                    OUTPUT_DIR; absolute paths are used as-is.
+        checkpoint: Checkpoint title to run this job with (see get_models()).
+                    Queued jobs for the already-loaded model run first. Leave
+                    empty to use whichever model is loaded.
     """
     payload = {
         "prompt": prompt,
@@ -51,29 +83,327 @@ async def txt2img(
         "batch_size": batch_size,
     }
 
-    async with forge_client(TIMEOUT_GENERATION) as client:
-        response = await client.post("/sdapi/v1/txt2img", json=payload)
-
-    if response.status_code != 200:
-        return format_error(response)
+    base = _resolve_path(save_path)
+    result = await run_generation(
+        "/sdapi/v1/txt2img",
+        payload,
+        lambda i: base if i == 0 else base.with_stem(f"{base.stem}_{i}"),
+        checkpoint=checkpoint or None,
+        ctx=ctx,
+    )
+    if result.error:
+        return result.error
 
-    data = response.json()
-    images = data.get("images", [])
-    info = data.get("info", {})
-    seeds = info.get("all_seeds", [seed] * len(images)) if isinstance(info, dict) else [seed]
+    finished = await finish_images(result.images)
+    saved = finished.paths
+    seeds = result.info.get("all_seeds", [seed] * len(saved))
 
-    base = _resolve_path(save_path)
-    saved = []
-    for i, img_b64 in enumerate(images):
-        out = base if i == 0 else base.with_stem(f"{base.stem}_{i}")
-        decode_and_save(img_b64, str(out))
-        saved.append(str(out))
-
-    return (
-        f"Generated {len(saved)} image(s).\n"
+    return _reply(
+        f"Generated {len(saved)} image(s){_cached_note(result)}.\n"
         f"Saved to: {', '.join(saved)}\n"
-        f"Seeds used: {seeds}"
+        f"Seeds used: {seeds}",
+        finished,
+    )
+
+
+@mcp.tool()
+async def txt2img_grid(
+    prompts: list[str],
+    negative_prompt: str = "",
+    cfg_scales: list[float] = [7.0],
+    steps: list[int] = [20],
+    sampler_names: list[str] = ["Euler a"],
+    seeds: list[int] = [-1],
+    width: int = 1024,
+    height: int = 1024,
+    save_prefix: str = "grid",
+    contact_sheet: bool = True,
+    max_parallel: int = 0,
+    checkpoint: str = "",
+    ctx: Context | None = None,
+) -> str | ToolResult:
+    """
+    Generate every combination of prompts, CFG scales, step counts, samplers
+    and seeds in one call (an X/Y sweep), e.g. 4 prompts x 3 cfg x 4 seeds.
+
+    Cells that differ only by seed are packed into batched Forge requests
+    (consecutive seeds share one request), and requests run in parallel
+    across the available backends. Each image is saved as soon as its request
+    finishes, as <save_prefix>_<cell>.png. Returns one line per cell with its
+    parameters, file and seed.
+
+    Args:
+        prompts: Positive prompts, one per row group.
+        negative_prompt: Things to avoid, shared by every cell.
+        cfg_scales: CFG scale values to sweep.
+        steps: Step counts to sweep.
+        sampler_names: Samplers to sweep.
+        seeds: Seeds to sweep (the grid columns). -1 gives a random seed per cell.
+        width: Image width in pixels.
+        height: Image height in pixels.
+        save_prefix: Filename prefix for the outputs. Relative paths are placed
+                     inside OUTPUT_DIR.
+        contact_sheet: Also save <save_prefix>_sheet.png with every result as
+                       a thumbnail, one row per parameter combination and one
+                       column per seed. Requires Pillow.
+        max_parallel: Maximum Forge requests in flight at once. 0 uses one
+                      per configured backend.
+        checkpoint: Checkpoint title to run the sweep with (see get_models()).
+    """
+    rows = list(itertools.product(range(len(prompts)), cfg_scales, steps, sampler_names))
+    cells = len(rows) * len(seeds)
+    if not cells:
+        return "Nothing to generate: every parameter list needs at least one value."
+    if cells > GRID_MAX_CELLS:
+        return f"The grid has {cells} cells; the limit is {GRID_MAX_CELLS} (GRID_MAX_CELLS)."
+
+    prefix = _resolve_path(save_prefix)
+    paths = [
+        [prefix.with_name(f"{prefix.stem}_{r * len(seeds) + c:03d}.png") for c in range(len(seeds))]
+        for r in range(len(rows))
+    ]
+    used_seeds: list[list[int | None]] = [[None] * len(seeds) for _ in rows]
+    done: list[list[bool]] = [[False] * len(seeds) for _ in rows]
+    errors: list[str] = []
+    finished = 0
+    limit = asyncio.Semaphore(max_parallel or len(pool.backends))
+
+    async def run(row: int, seed: int, columns: list[int], batch_size: int, n_iter: int) -> None:
+        nonlocal finished
+        prompt_index, cfg, step_count, sampler = rows[row]
+        payload = {
+            "prompt": prompts[prompt_index],
+            "negative_prompt": negative_prompt,
+            "steps": step_count,
+            "cfg_scale": cfg,
+            "width": width,
+            "height": height,
+            "sampler_name": sampler,
+            "seed": seed,
+            "batch_size": batch_size,
+            "n_iter": n_iter,
+        }
+        async with limit:
+            try:
+                result = await run_generation(
+                    "/sdapi/v1/txt2img",
+                    payload,
+                    lambda i: paths[row][columns[i]] if i < len(columns) else None,
+                    checkpoint=checkpoint or None,
+                )
+            except httpx.HTTPError as exc:
+                # Keep the cells that did succeed rather than failing the sweep.
+                result = GenerationResult(error=f"Could not reach Forge: {exc!r}")
+        if result.error:
+            errors.append(f"Cells starting at seed {seed} of row {row}: {result.error}")
+        else:
+            all_seeds = result.info.get("all_seeds") or []
+            for i, column in enumerate(columns[: len(result.images)]):
+                done[row][column] = True
+                used_seeds[row][column] = all_seeds[i] if i < len(all_seeds) else None
+
+        finished += len(columns)
+        if ctx is not None:
+            await ctx.report_progress(finished, cells, f"{finished}/{cells} grid cells")
+
+    await asyncio.gather(*(
+        run(row, *request)
+        for row in range(len(rows))
+        for request in _pack_seeds(seeds, GRID_MAX_BATCH)
+    ))
+
+    # The sheet is drawn from the PNGs, before they are converted.
+    sheet: Path | None = None
+    if contact_sheet and any(map(any, done)) and _HAS_PIL:
+        sheet = prefix.with_name(f"{prefix.stem}_sheet.png")
+        tiles = [[p if ok else None for p, ok in zip(pr, dr)] for pr, dr in zip(paths, done)]
+        await run_io(_compose_sheet, tiles, sheet)
+
+    saved = [str(p) for pr, dr in zip(paths, done) for p, ok in zip(pr, dr) if ok]
+    # Only the sheet is shown inline; a thumbnail per cell would flood the reply.
+    finished_cells, finished_sheet = await asyncio.gather(
+        finish_images(saved, thumbnails=False),
+        finish_images([str(sheet)] if sheet else []),
+    )
+    final = dict(zip(saved, finished_cells.paths))
+
+    lines = [f"Generated {sum(map(sum, done))}/{cells} grid cell(s)."]
+    for r, (prompt_index, cfg, step_count, sampler) in enumerate(rows):
+        for c in range(len(seeds)):
+            status = final[str(paths[r][c])] if done[r][c] else "FAILED"
+            lines.append(
+                f"  [{r * len(seeds) + c:03d}] prompt {prompt_index + 1}, "
+                f"cfg {cfg}, steps {step_count}, {sampler}, "
+                f"seed {used_seeds[r][c] if done[r][c] else seeds[c]}: {status}"
+            )
+
+    if sheet is not None:
+        lines.insert(1, f"Contact sheet: {finished_sheet.paths[0]}")
+    elif contact_sheet and any(map(any, done)):
+        lines.insert(1, "Contact sheet skipped: Pillow is not installed.")
+
+    return _reply("\n".join(lines + errors), finished_sheet)
+
+
+@mcp.tool()
+async def txt2img_hires(
+    prompt: str,
+    negative_prompt: str = "",
+    steps: int = 20,
+    cfg_scale: float = 7.0,
+    width: int = 768,
+    height: int = 768,
+    sampler_name: str = "Euler a",
+    seed: int = -1,
+    hr_scale: float = 2.0,
+    hr_upscaler: str = "Latent",
+    denoising_strength: float = 0.5,
+    hr_steps: int = 0,
+    method: str = "native",
+    save_intermediate: bool = False,
+    save_path: str = "output_hires.png",
+    checkpoint: str = "",
+    ctx: Context | None = None,
+) -> str | ToolResult:
+    """
+    Generate a high-resolution image in two stages (hires fix): a base image
+    at width x height, upscaled by hr_scale and refined with a second
+    img2img-style pass.
+
+    Use this instead of chaining txt2img, upscale_image and img2img: no
+    intermediate image is written, read back or re-uploaded.
+
+    Args:
+        prompt: Positive prompt describing the desired image.
+        negative_prompt: Things to avoid in the image.
+        steps: Diffusion steps for the base image.
+        cfg_scale: Classifier-free guidance scale.
+        width: Base image width; the output is width * hr_scale.
+        height: Base image height; the output is height * hr_scale.
+        sampler_name: Sampler to use for both passes.
+        seed: RNG seed. Use -1 for random.
+        hr_scale: Upscale factor between the two passes.
+        hr_upscaler: Upscaler between the passes (see get_upscalers()).
+                     'Latent' variants upscale the latent directly and only
+                     work with method='native'.
+        denoising_strength: How much the second pass may change the upscaled
+                            image (0.3-0.6 keeps the composition).
+        hr_steps: Steps for the second pass. 0 uses the same as steps.
+        method: 'native' runs both passes inside Forge in one request using
+                its hires-fix (enable_hr) fields. 'chain' runs txt2img,
+                extras upscale and img2img as separate requests, passing the
+                images between them in memory; use it for upscalers or
+                backends where the native path is unavailable.
+        save_intermediate: With method='chain', also save the base and
+                           upscaled images as <save_path>_base.png and
+                           <save_path>_upscaled.png.
+        save_path: Filename for the output PNG. Relative paths land in OUTPUT_DIR.
+        checkpoint: Checkpoint title to run this job with (see get_models()).
+    """
+    out = _resolve_path(save_path)
+    base_payload = {
+        "prompt": prompt,
+        "negative_prompt": negative_prompt,
+        "steps": steps,
+        "cfg_scale": cfg_scale,
+        "width": width,
+        "height": height,
+        "sampler_name": sampler_name,
+        "seed": seed,
+    }
+
+    if method == "native":
+        result = await run_generation(
+            "/sdapi/v1/txt2img",
+            {
+                **base_payload,
+                "enable_hr": True,
+                "hr_scale": hr_scale,
+                "hr_upscaler": hr_upscaler,
+                "hr_second_pass_steps": hr_steps,
+                "denoising_strength": denoising_strength,
+            },
+            _first_only(out),
+            checkpoint=checkpoint or None,
+            ctx=ctx,
+        )
+        if result.error:
+            return result.error
+        if not result.images:
+            return "No images returned by Forge."
+        finished = await finish_images(result.images)
+        return _reply(
+            f"Hires generation complete{_cached_note(result)}. Saved to '{finished.paths[0]}'. "
+            f"Seed: {result.info.get('seed', seed)}",
+            finished,
+        )
+
+    if method != "chain":
+        return f"Unknown method '{method}'. Use 'native' or 'chain'."
+    if hr_upscaler.lower().startswith("latent"):
+        return "Latent upscalers only work with method='native'; pick an image upscaler."
+
+    def stage_output(suffix: str):
+        return _first_only(out.with_stem(f"{out.stem}_{suffix}")) if save_intermediate else _discard
+
+    base = await run_generation(
+        "/sdapi/v1/txt2img",
+        base_payload,
+        stage_output("base"),
+        checkpoint=checkpoint or None,
+        ctx=ctx,
+        stage=(0, 3),
+        keep_images=True,
+    )
+    if base.error:
+        return base.error
+    if not base.encoded:
+        return "No images returned by Forge."
+    used_seed = base.info.get("seed", seed)
+
+    upscaled = await run_generation(
+        "/sdapi/v1/extra-single-image",
+        {"image": base.encoded[0], "upscaling_resize": hr_scale, "upscaler_1": hr_upscaler},
+        stage_output("upscaled"),
+        image_key="image",
+        ctx=ctx,
+        stage=(1, 3),
+        keep_images=True,
+    )
+    if upscaled.error:
+        return upscaled.error
+    if not upscaled.encoded:
+        return "Forge returned no upscaled image."
+
+    refined = await run_generation(
+        "/sdapi/v1/img2img",
+        {
+            **base_payload,
+            "init_images": [upscaled.encoded[0]],
+            "width": round(width * hr_scale),
+            "height": round(height * hr_scale),
+            "steps": hr_steps or steps,
+            "seed": used_seed,
+            "denoising_strength": denoising_strength,
+        },
+        _first_only(out),
+        checkpoint=checkpoint or None,
+        ctx=ctx,
+        stage=(2, 3),
     )
+    if refined.error:
+        return refined.error
+    if not refined.images:
+        return "No images returned by Forge."
+
+    finished, intermediate = await asyncio.gather(
+        finish_images(refined.images),
+        finish_images(base.images + upscaled.images, thumbnails=False),
+    )
+    lines = [f"Hires generation complete. Saved to '{finished.paths[0]}'. Seed: {used_seed}"]
+    if save_intermediate:
+        lines.append(f"Intermediate images: {', '.join(intermediate.paths)}")
+    return _reply("\n".join(lines), finished)
 
 
 @mcp.tool()
@@ -89,7 +419,9 @@ async def img2img(
     sampler_name: str = "Euler a",
     seed: int = -1,
     save_path: str = "output_img2img.png",
-) -> str:
+    checkpoint: str = "",
+    ctx: Context | None = None,
+) -> str | ToolResult:
     """
     Transform an existing image guided by a text prompt (image-to-image).
 
@@ -109,8 +441,13 @@ async def img2img(
         sampler_name: Sampler to use.
         seed: RNG seed (-1 for random).
         save_path: Filename for the output PNG. Relative paths land in OUTPUT_DIR.
+        checkpoint: Checkpoint title to run this job with (see get_models()).
+                    Queued jobs for the already-loaded model run first. Leave
+                    empty to use whichever model is loaded.
     """
-    b64 = encode_image(image_path)
+    # Forge resizes the source to the output size anyway, so don't upload
+    # more pixels than that.
+    b64 = await encode_image(image_path, (width, height) if width and height else None)
 
     payload = {
         "init_images": [b64],
@@ -127,23 +464,27 @@ async def img2img(
     if height:
         payload["height"] = height
 
-    async with forge_client(TIMEOUT_GENERATION) as client:
-        response = await client.post("/sdapi/v1/img2img", json=payload)
-
-    if response.status_code != 200:
-        return format_error(response)
+    out = _resolve_path(save_path)
+    result = await run_generation(
+        "/sdapi/v1/img2img",
+        payload,
+        _first_only(out),
+        checkpoint=checkpoint or None,
+        ctx=ctx,
+    )
+    if result.error:
+        return result.error
 
-    data = response.json()
-    images = data.get("images", [])
-    info = data.get("info", {})
-    used_seed = info.get("seed", seed) if isinstance(info, dict) else seed
+    used_seed = result.info.get("seed", seed)
 
-    if not images:
+    if not result.images:
         return "No images returned by Forge."
 
-    out = _resolve_path(save_path)
-    decode_and_save(images[0], str(out))
-    return f"img2img complete. Saved to '{out}'. Seed: {used_seed}"
+    finished = await finish_images(result.images)
+    return _reply(
+        f"img2img complete{_cached_note(result)}. Saved to '{finished.paths[0]}'. Seed: {used_seed}",
+        finished,
+    )
 
 
 @mcp.tool()
@@ -160,7 +501,9 @@ async def inpaint(
     inpainting_fill: int = 1,
     seed: int = -1,
     save_path: str = "output_inpaint.png",
-) -> str:
+    checkpoint: str = "",
+    ctx: Context | None = None,
+) -> str | ToolResult:
     """
     Inpaint (fill or redraw) a masked region of an existing image.
 
@@ -182,9 +525,13 @@ async def inpaint(
                          0=fill, 1=original, 2=latent noise, 3=latent nothing.
         seed: RNG seed (-1 for random).
         save_path: Filename for the output PNG. Relative paths land in OUTPUT_DIR.
+        checkpoint: Checkpoint title to run this job with (see get_models()).
+                    Queued jobs for the already-loaded model run first. Leave
+                    empty to use whichever model is loaded.
     """
-    img_b64 = encode_image(image_path)
-    mask_b64 = encode_image(mask_path)
+    img_b64, mask_b64 = await asyncio.gather(
+        encode_image(image_path), encode_image(mask_path)
+    )
 
     payload = {
         "init_images": [img_b64],
@@ -201,21 +548,149 @@ async def inpaint(
         "seed": seed,
     }
 
-    async with forge_client(TIMEOUT_GENERATION) as client:
-        response = await client.post("/sdapi/v1/img2img", json=payload)
+    out = _resolve_path(save_path)
+    result = await run_generation(
+        "/sdapi/v1/img2img",
+        payload,
+        _first_only(out),
+        checkpoint=checkpoint or None,
+        ctx=ctx,
+    )
+    if result.error:
+        return result.error
+
+    if not result.images:
+        return "No images returned by Forge."
 
-    if response.status_code != 200:
-        return format_error(response)
+    finished = await finish_images(result.images)
+    return _reply(
+        f"Inpainting complete{_cached_note(result)}. Saved to '{finished.paths[0]}'.", finished
+    )
 
-    data = response.json()
-    images = data.get("images", [])
 
-    if not images:
-        return "No images returned by Forge."
+@dataclass
+class InpaintRegion:
+    """One mask and what to paint into it, for inpaint_regions."""
+
+    mask_path: str
+    prompt: str
+    denoising_strength: float | None = None
+
+
+@mcp.tool()
+async def inpaint_regions(
+    image_path: str,
+    regions: list[InpaintRegion],
+    negative_prompt: str = "",
+    denoising_strength: float = 0.75,
+    steps: int = 20,
+    cfg_scale: float = 7.0,
+    sampler_name: str = "Euler a",
+    mask_blur: int = 4,
+    inpainting_fill: int = 1,
+    seed: int = -1,
+    save_path: str = "output_inpaint.png",
+    checkpoint: str = "",
+    ctx: Context | None = None,
+) -> str | ToolResult:
+    """
+    Inpaint several masked regions of one image in a single call, e.g. eyes,
+    hands and a costume piece of a portrait.
+
+    Regions are applied in order, each on top of the previous result, with
+    the intermediate image kept in memory rather than saved and re-uploaded.
+    Regions whose masks don't overlap run concurrently on the same input and
+    are composited locally (requires Pillow; without it they run one after
+    another). Only the final image is saved.
+
+    Args:
+        image_path: Path to the source image.
+        regions: List of {mask_path, prompt, denoising_strength (optional)}.
+                 Masks are white where to repaint and black elsewhere.
+        negative_prompt: Things to avoid, shared by every region.
+        denoising_strength: Default strength for regions that don't set one.
+        steps: Diffusion steps.
+        cfg_scale: Prompt adherence strength.
+        sampler_name: Sampler to use.
+        mask_blur: Blur radius applied to mask edges for smoother blending.
+        inpainting_fill: Fill mode for the masked area before diffusion.
+                         0=fill, 1=original, 2=latent noise, 3=latent nothing.
+        seed: RNG seed (-1 for random), shared by every region.
+        save_path: Filename for the output PNG. Relative paths land in OUTPUT_DIR.
+        checkpoint: Checkpoint title to run this job with (see get_models()).
+    """
+    if not regions:
+        return "No regions given."
+
+    current, *masks = await asyncio.gather(
+        encode_image(image_path), *(encode_image(r.mask_path) for r in regions)
+    )
+    if _HAS_PIL:
+        size, footprints, waves = await run_io(
+            _plan_regions, image_path, [r.mask_path for r in regions], mask_blur
+        )
+    else:
+        size, footprints = None, None
+        waves = [[i] for i in range(len(regions))]
+
+    async def paint(index: int, image: str, stage: tuple[int, int], report: bool) -> GenerationResult:
+        region = regions[index]
+        payload = {
+            "init_images": [image],
+            "mask": masks[index],
+            "prompt": region.prompt,
+            "negative_prompt": negative_prompt,
+            "denoising_strength": (
+                region.denoising_strength if region.denoising_strength is not None
+                else denoising_strength
+            ),
+            "steps": steps,
+            "cfg_scale": cfg_scale,
+            "sampler_name": sampler_name,
+            "mask_blur": mask_blur,
+            "inpainting_fill": inpainting_fill,
+            "inpaint_full_res": True,
+            "seed": seed,
+        }
+        if size:
+            # Keep every pass at the source size so results can be composited.
+            payload["width"], payload["height"] = size
+        return await run_generation(
+            "/sdapi/v1/img2img",
+            payload,
+            _discard,
+            checkpoint=checkpoint or None,
+            ctx=ctx if report else None,
+            stage=stage,
+            keep_images=True,
+        )
+
+    for number, wave in enumerate(waves):
+        results = await asyncio.gather(*(
+            paint(index, current, (number, len(waves)), report=i == 0)
+            for i, index in enumerate(wave)
+        ))
+        for index, result in zip(wave, results):
+            if result.error:
+                return f"Region {index + 1}: {result.error}"
+            if not result.encoded:
+                return f"Region {index + 1}: no image returned by Forge."
+        if len(wave) == 1:
+            current = results[0].encoded[0]
+        else:
+            patches = [(r.encoded[0], footprints[i]) for i, r in zip(wave, results)]
+            current = await run_io(_composite, current, patches)
 
     out = _resolve_path(save_path)
-    decode_and_save(images[0], str(out))
-    return f"Inpainting complete. Saved to '{out}'."
+    await decode_and_save(current, str(out))
+    finished = await finish_images([str(out)])
+    concurrent = sum(len(wave) for wave in waves if len(wave) > 1)
+    return _reply(
+        f"Inpainted {len(regions)} region(s) in {len(waves)} pass(es)"
+        + (f", {concurrent} of them concurrently" if concurrent else "")
+        + f". Saved to '{finished.paths[0]}'.",
+        finished,
+    )
 
 
 @mcp.tool()
@@ -224,12 +699,18 @@ async def upscale_image(
     upscaling_resize: float = 2.0,
     upscaler: str = "R-ESRGAN 4x+",
     save_path: str = "output_upscaled.png",
-) -> str:
+    tile_size: int = 0,
+    tile_overlap: int = 32,
+    ctx: Context | None = None,
+) -> str | ToolResult:
     """
     Upscale an image using a super-resolution model available in Forge.
 
     Ideal for taking a draft character portrait or map tile and making it
-    print-ready without re-generating from scratch.
+    print-ready without re-generating from scratch. For very large sources,
+    set tile_size to upscale the image in overlapping tiles, in parallel
+    across backends, instead of one request that may time out or run Forge
+    out of VRAM.
 
     Args:
         image_path: Path to the image to upscale.
@@ -238,29 +719,48 @@ async def upscale_image(
                   'R-ESRGAN 4x+', 'R-ESRGAN 4x+ Anime6B',
                   'Lanczos', 'Nearest', 'LDSR', '4x-UltraSharp'.
         save_path: Filename for the output PNG. Relative paths land in OUTPUT_DIR.
+        tile_size: Tile edge in source pixels (e.g. 512), at least 128 and
+                   more than twice tile_overlap. 0 upscales the whole
+                   image in one request. Tiled mode requires Pillow and
+                   drops any alpha channel.
+        tile_overlap: Source pixels shared by neighbouring tiles, blended
+                      to hide seams.
     """
-    b64 = encode_image(image_path)
-
     payload = {
-        "image": b64,
         "upscaling_resize": upscaling_resize,
         "upscaler_1": upscaler,
     }
+    out = _resolve_path(save_path)
 
-    async with forge_client(TIMEOUT_GENERATION) as client:
-        response = await client.post("/sdapi/v1/extra-single-image", json=payload)
-
-    if response.status_code != 200:
-        return format_error(response)
-
-    data = response.json()
-    img_b64 = data.get("image")
-    if not img_b64:
+    if tile_size > 0:
+        if not _HAS_PIL:
+            return "Tiled upscaling requires Pillow (pip install Pillow)."
+        if tile_size < MIN_TILE_SIZE or tile_size <= 2 * tile_overlap:
+            return (
+                f"tile_size must be at least {MIN_TILE_SIZE} and more than twice "
+                f"tile_overlap ({tile_overlap})."
+            )
+        result = await upscale_tiled(image_path, out, payload, tile_size, tile_overlap, ctx)
+    else:
+        payload["image"] = await encode_image(image_path)
+        result = await run_generation(
+            "/sdapi/v1/extra-single-image",
+            payload,
+            _first_only(out),
+            image_key="image",
+            ctx=ctx,
+        )
+    if result.error:
+        return result.error
+
+    if not result.images:
         return "Forge returned no image data."
 
-    out = _resolve_path(save_path)
-    decode_and_save(img_b64, str(out))
-    return f"Upscaled {upscaling_resize}x using '{upscaler}'. Saved to '{out}'."
+    finished = await finish_images(result.images)
+    return _reply(
+        f"Upscaled {upscaling_resize}x using '{upscaler}'. Saved to '{finished.paths[0]}'.",
+        finished,
+    )
 
 
 # ---------------------------------------------------------------------------
@@ -268,6 +768,177 @@ async def upscale_image(
 # ---------------------------------------------------------------------------
 
 def _resolve_path(save_path: str) -> Path:
-    """Return an absolute Path, placing relative paths inside OUTPUT_DIR."""
+    """Return an absolute Path, placing relative paths inside OUTPUT_DIR (created if needed)."""
     p = Path(save_path)
-    return p if p.is_absolute() else OUTPUT_DIR / p
+    if p.is_absolute():
+        return p
+    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+    return OUTPUT_DIR / p
+
+
+def _reply(text: str, finished: FinishedImages) -> str | ToolResult:
+    """Tool reply: *text*, followed by the thumbnails of *finished* as image content."""
+    if not finished.thumbnails:
+        return text
+    thumbnails = [ImageContent(data=thumb, format="jpeg") for thumb in finished.thumbnails]
+    return ToolResult(content=[text, *thumbnails])
+
+
+def _first_only(out: Path):
+    """Output mapping that keeps the first returned image and drops the rest."""
+    return lambda i: out if i == 0 else None
+
+
+def _discard(index: int) -> None:
+    """Output mapping that saves nothing (results are kept in memory)."""
+    return None
+
+
+def _cached_note(result: GenerationResult) -> str:
+    return " (reused from the result cache)" if result.cached else ""
+
+
+def _pack_seeds(seeds: list[int], max_batch: int) -> list[tuple[int, list[int], int, int]]:
+    """
+    Group grid columns into as few Forge requests as possible.
+
+    Forge gives the images of one request the seeds seed, seed+1, ... so runs
+    of consecutive seeds share a request, as do all random (-1) columns.
+    Returns ``(seed, columns, batch_size, n_iter)`` per request, where
+    ``columns[i]`` is the column that the request's i-th image belongs to.
+    """
+    runs: list[tuple[int, list[int]]] = []
+    for seed, column in sorted((s, c) for c, s in enumerate(seeds) if s != -1):
+        if runs and runs[-1][0] + len(runs[-1][1]) == seed:
+            runs[-1][1].append(column)
+        else:
+            runs.append((seed, [column]))
+    random_columns = [c for c, s in enumerate(seeds) if s == -1]
+    if random_columns:
+        runs.append((-1, random_columns))
+
+    requests = []
+    for start, columns in runs:
+        i = 0
+        while i < len(columns):
+            batch_size = min(len(columns) - i, max_batch)
+            n_iter = (len(columns) - i) // batch_size
+            count = batch_size * n_iter
+            seed = start if start == -1 else start + i
+            requests.append((seed, columns[i:i + count], batch_size, n_iter))
+            i += count
+    return requests
+
+
+def _compose_sheet(tiles: list[list[Path | None]], out: Path) -> None:
+    """Paste thumbnails of *tiles* (rows of image paths) into one PNG."""
+    from PIL import Image
+
+    size = GRID_TILE_SIZE
+    columns = max(len(row) for row in tiles)
+    sheet = Image.new("RGB", (columns * size, len(tiles) * size), "white")
+    for r, row in enumerate(tiles):
+        for c, path in enumerate(row):
+            if path is None:
+                continue
+            with Image.open(path) as image:
+                image.thumbnail((size, size))
+                x = c * size + (size - image.width) // 2
+                y = r * size + (size - image.height) // 2
+                sheet.paste(image.convert("RGB"), (x, y))
+    tmp = temp_path_for(out)
+    sheet.save(tmp, "PNG", compress_level=PNG_COMPRESS_LEVEL)
+    os.replace(tmp, out)
+
+
+def _plan_regions(
+    image_path: str, mask_paths: list[str], mask_blur: int
+) -> tuple[tuple[int, int], list, list[list[int]]]:
+    """Source size, region footprints and their passes (see _schedule_regions)."""
+    size, footprints = _mask_footprints(image_path, mask_paths, mask_blur)
+    return size, footprints, _schedule_regions(footprints)
+
+
+def _mask_footprints(
+    image_path: str, mask_paths: list[str], mask_blur: int
+) -> tuple[tuple[int, int], list]:
+    """
+    Source size and, per mask, a binary image of every pixel inpainting may
+    change: the mask's non-black area grown by the blur radius.
+    """
+    from PIL import Image
+
+    with Image.open(image_path) as image:
+        size = image.size
+    footprints = []
+    for path in mask_paths:
+        with Image.open(path) as mask:
+            area = _binary(mask.convert("L").resize(size))
+        footprints.append(_dilate(area, mask_blur))
+    return size, footprints
+
+
+def _dilate(area, radius: int):
+    """
+    Grow binary image *area* by *radius* pixels in every direction.
+
+    Same result as MaxFilter(2 * radius + 1), but built from box blurs, one
+    axis at a time, which release the GIL; MaxFilter holds it for up to a
+    second on a large mask, stalling the event loop despite run_io.
+    """
+    from PIL import ImageFilter
+
+    while radius > 0:
+        # One set pixel must still blur to a non-zero value: 255 / (2 * 127 + 1).
+        step = min(radius, 127)
+        area = _binary(area.filter(ImageFilter.BoxBlur((step, 0))))
+        area = _binary(area.filter(ImageFilter.BoxBlur((0, step))))
+        radius -= step
+    return area
+
+
+def _binary(image):
+    return image.point(lambda v: 255 if v else 0)
+
+
+def _schedule_regions(footprints: list) -> list[list[int]]:
+    """
+    Group regions into passes that can run concurrently.
+
+    A region runs one pass after the latest earlier region it overlaps, so
+    overlapping regions still apply in the order given.
+    """
+    from PIL import ImageChops
+
+    passes: list[int] = []
+    for i, footprint in enumerate(footprints):
+        after = [
+            passes[j] for j in range(i)
+            if ImageChops.multiply(footprints[j], footprint).getbbox() is not None
+        ]
+        passes.append(max(after) + 1 if after else 0)
+    waves: list[list[int]] = [[] for _ in range(max(passes) + 1)]
+    for i, number in enumerate(passes):
+        waves[number].append(i)
+    return waves
+
+
+def _composite(base: str, patches: list[tuple[str, Any]]) -> str:
+    """Paste each inpainted result onto *base* through its footprint."""
+    from PIL import Image
+
+    image = _open_b64(base).convert("RGB")
+    for b64, footprint in patches:
+        with _open_b64(b64) as patch:
+            image.paste(patch.convert("RGB").resize(image.size), (0, 0), footprint)
+    buf = io.BytesIO()
+    image.save(buf, "PNG")
+    return base64.b64encode(buf.getvalue()).decode("utf-8")
+
+
+def _open_b64(b64: str):
+    from PIL import Image
+
+    if b64.startswith("data:"):
+        b64 = b64.split(",", 1)[1]
+    return Image.open(io.BytesIO(base64.b64decode(b64)))
@@ -0,0 +1,153 @@
+import inspect
+from typing import Any, Awaitable, Callable
+
+from fastmcp.tools.tool import ToolResult
+from pydantic_core import to_jsonable_python
+
+from jobs import registry, tool_defaults
+from mcp_instance import mcp
+from tools.control import interrupt_generation
+from tools.generation import (
+    img2img,
+    inpaint,
+    inpaint_regions,
+    txt2img,
+    txt2img_grid,
+    txt2img_hires,
+    upscale_image,
+)
+
+
+@mcp.tool()
+async def job_status(job_id: str = "") -> str:
+    """
+    Check on background jobs started with the submit_* tools.
+
+    States are 'queued' (waiting for a free backend), 'running', 'done',
+    'failed' and 'cancelled'. Use get_progress(job_id) for step-level progress
+    of a running job and job_result(job_id) once it is done.
+
+    Args:
+        job_id: The ID returned by a submit_* tool. Leave empty to list all
+                known jobs.
+    """
+    if not job_id:
+        jobs = registry.all()
+        if not jobs:
+            return "No background jobs."
+        return "\n".join(job.describe() for job in jobs)
+
+    job = registry.get(job_id)
+    if job is None:
+        return f"No background job with ID '{job_id}'."
+    return job.describe()
+
+
+@mcp.tool()
+async def job_result(job_id: str) -> str | ToolResult:
+    """
+    Return the result of a finished background job: the same text (and
+    thumbnails) the corresponding blocking tool (txt2img, img2img, ...) would
+    have returned.
+
+    Args:
+        job_id: The ID returned by a submit_* tool.
+    """
+    job = registry.get(job_id)
+    if job is None:
+        return f"No background job with ID '{job_id}'."
+
+    if not job.task.done():
+        return f"{job.describe()}. The result is not ready yet."
+    if job.task.cancelled():
+        return f"Job {job_id} was cancelled."
+    if job.task.exception():
+        return f"Job {job_id} failed: {job.task.exception()!r}"
+    registry.delivered(job)
+    return job.task.result()
+
+
+@mcp.tool()
+async def cancel_job(job_id: str) -> str:
+    """
+    Cancel a background job.
+
+    A queued job is simply removed from the queue. A running job is
+    interrupted in Forge (as with interrupt_generation) before being stopped.
+
+    Args:
+        job_id: The ID returned by a submit_* tool.
+    """
+    job = registry.get(job_id)
+    if job is None:
+        return f"No background job with ID '{job_id}'."
+    if job.task.done():
+        return f"Job {job_id} already finished ({job.state})."
+
+    notes = []
+    if job.state == "running":
+        notes.append(await interrupt_generation(job_id))
+    job.task.cancel()
+    return "\n".join([*notes, f"Job {job_id} cancelled."])
+
+
+# ---------------------------------------------------------------------------
+# submit_* variants of the generation tools
+# ---------------------------------------------------------------------------
+
+def _register_submit_variant(tool_fn: Callable[..., Awaitable[str | ToolResult]]) -> None:
+    """
+    Register submit_<tool>: same arguments as *tool_fn*, but it runs in the
+    background and returns a job ID immediately.
+    """
+    async def submit(**kwargs: Any) -> str:
+        # JSON arguments, as journaled and as a restart replays them.
+        args = registry.arguments(tool_fn.__name__, to_jsonable_python(kwargs))
+        existing = registry.attachable(tool_fn.__name__, args)
+        if existing is not None:
+            return (
+                f"An identical request is already job {existing.id} ({existing.state}). "
+                f"Fetch its output with job_result('{existing.id}')."
+            )
+        job = registry.submit(tool_fn.__name__, args)
+        return (
+            f"Submitted job {job.id} ({tool_fn.__name__}). "
+            f"Check it with job_status('{job.id}') and fetch the output with "
+            f"job_result('{job.id}')."
+        )
+
+    # The submit call is answered right away, so there is no request left to
+    # send progress notifications to: drop the injected Context parameter.
+    signature = inspect.signature(tool_fn)
+    signature = signature.replace(
+        parameters=[p for p in signature.parameters.values() if p.name != "ctx"],
+        return_annotation=str,
+    )
+
+    summary = inspect.getdoc(tool_fn).split("\n\n", 1)
+    submit.__name__ = f"submit_{tool_fn.__name__}"
+    submit.__signature__ = signature
+    submit.__annotations__ = {
+        **{k: v for k, v in tool_fn.__annotations__.items() if k != "ctx"},
+        "return": str,
+    }
+    submit.__doc__ = (
+        f"{summary[0]}\n\n"
+        f"Background version of {tool_fn.__name__}(): returns a job ID right away "
+        f"instead of waiting for Forge. Use job_status, job_result and cancel_job "
+        f"with that ID.\n\n{summary[1] if len(summary) > 1 else ''}"
+    )
+    mcp.tool()(submit)
+    registry.register(tool_fn.__name__, tool_defaults(tool_fn))
+
+
+async def _run_tool(tool: str, args: dict[str, Any]) -> ToolResult:
+    """Run generation tool *tool* outside any MCP request, as submitted jobs do."""
+    return await (await mcp.get_tool(tool)).run(args)
+
+
+for _tool in (
+    txt2img, txt2img_grid, txt2img_hires, img2img, inpaint, inpaint_regions, upscale_image
+):
+    _register_submit_variant(_tool)
+registry.runner = _run_tool
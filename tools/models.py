@@ -1,23 +1,34 @@
-from config import TIMEOUT_INFO, TIMEOUT_MODEL_SWITCH
+import asyncio
+import time
+
+import httpx
+
+from backends import Backend, pool
+from cache import listing_cache
+from checkpoints import preload, switch_checkpoint
+from config import CACHE_TTL_ASSETS, CACHE_TTL_OPTIONS, TIMEOUT_INFO
 from mcp_instance import mcp
-from utils import forge_client, format_error
+from utils import fetch_json, forge_client, format_error
 
 
 @mcp.tool()
-async def get_models() -> str:
+async def get_models(use_cache: bool = True) -> str:
     """
     List all Stable Diffusion checkpoints (models) available in Forge.
 
     Returns the model title and filename for each checkpoint so you can
     pick the right one for your art style before generating.
-    """
-    async with forge_client(TIMEOUT_INFO) as client:
-        response = await client.get("/sdapi/v1/sd-models")
 
-    if response.status_code != 200:
-        return format_error(response)
+    Args:
+        use_cache: Reuse a recently fetched listing. Set to False to query Forge
+                   directly, e.g. right after adding files outside refresh_models().
+    """
+    models, error = await fetch_json(
+        "/sdapi/v1/sd-models", ttl=CACHE_TTL_ASSETS, use_cache=use_cache
+    )
+    if error:
+        return error
 
-    models = response.json()
     if not models:
         return "No models found."
 
@@ -26,40 +37,82 @@ async def get_models() -> str:
 
 
 @mcp.tool()
-async def set_model(model_title: str) -> str:
+async def set_model(model_title: str, backend_url: str = "") -> str:
     """
-    Switch the active Stable Diffusion checkpoint in Forge.
+    Switch the active Stable Diffusion checkpoint in Forge and wait until it
+    is loaded.
 
-    Use get_models() first to see the exact title string to pass here.
-    Model switching can take 10-60 seconds depending on model size.
+    Use get_models() first to see the exact title string to pass here. The
+    switch waits for generations already running or queued on the backend,
+    and generations requested afterwards wait for the switch, so they always
+    run on the new model. Loading can take 10-60 seconds depending on model size.
 
     Args:
         model_title: The exact title of the model as returned by get_models().
+        backend_url: Only switch this Forge backend (see get_backends()). Leave
+                     empty to switch every configured backend.
     """
-    payload = {"sd_model_checkpoint": model_title}
+    backends = _target_backends(backend_url)
+    if not backends:
+        return f"Unknown backend '{backend_url}'."
 
-    async with forge_client(TIMEOUT_MODEL_SWITCH) as client:
-        response = await client.post("/sdapi/v1/options", json=payload)
+    started = time.monotonic()
+    errors = [
+        e for e in await asyncio.gather(*(switch_checkpoint(b, model_title) for b in backends)) if e
+    ]
+    if errors:
+        return "\n".join(errors)
 
-    if response.status_code != 200:
-        return format_error(response)
+    return f"Model '{model_title}' is loaded and ready ({time.monotonic() - started:.1f}s)."
 
-    return f"Model switched to '{model_title}'. Give Forge a moment to load it before generating."
+
+@mcp.tool()
+async def preload_model(model_title: str) -> str:
+    """
+    Hint that a checkpoint will be needed soon, so Forge can load it ahead of time.
+
+    Returns immediately. The model is loaded in the background on the backend
+    that can best spare it: an idle one whose current model no queued job
+    needs, or otherwise the single backend once its current jobs finish.
+    Generations that later pass checkpoint=model_title are routed to it
+    without waiting for a switch. Does nothing if the model is already loaded.
+
+    Args:
+        model_title: The exact title of the model as returned by get_models().
+    """
+    return preload(model_title)
 
 
 @mcp.tool()
-async def get_current_model() -> str:
+async def get_current_model(use_cache: bool = True) -> str:
     """
     Return the name of the checkpoint that is currently loaded in Forge.
+
+    Args:
+        use_cache: Reuse a value fetched in the last few seconds. Set to False
+                   if the model may have been changed from the Forge web UI.
     """
-    async with forge_client(TIMEOUT_INFO) as client:
-        response = await client.get("/sdapi/v1/options")
+    async def current(backend: Backend) -> str:
+        opts, error = await fetch_json(
+            "/sdapi/v1/options", ttl=CACHE_TTL_OPTIONS, use_cache=use_cache, backend=backend
+        )
+        if error:
+            return error
+        backend.checkpoint = opts.get("sd_model_checkpoint")
+        return f"Current model: {opts.get('sd_model_checkpoint', 'unknown')}"
+
+    if len(pool.backends) == 1:
+        return await current(pool.backends[0])
 
-    if response.status_code != 200:
-        return format_error(response)
+    async def report(backend: Backend) -> str:
+        if not backend.available:
+            return f"[{backend.url}] Unavailable — failing health checks."
+        try:
+            return f"[{backend.url}] {await current(backend)}"
+        except httpx.HTTPError as exc:
+            return f"[{backend.url}] Unreachable: {exc}"
 
-    opts = response.json()
-    return f"Current model: {opts.get('sd_model_checkpoint', 'unknown')}"
+    return "\n".join(await asyncio.gather(*(report(b) for b in pool.backends)))
 
 
 @mcp.tool()
@@ -71,15 +124,35 @@ async def refresh_models() -> str:
     Run this after copying new model files into the Forge models directory
     so they appear in get_models(), get_loras(), etc. without restarting Forge.
     """
-    async with forge_client(TIMEOUT_INFO) as client:
-        r_ckpt = await client.post("/sdapi/v1/refresh-checkpoints")
-        r_lora = await client.post("/sdapi/v1/refresh-loras")
-
-    results = []
-    results.append(
-        "Checkpoints refreshed." if r_ckpt.status_code == 200 else format_error(r_ckpt)
-    )
-    results.append(
-        "LoRAs refreshed." if r_lora.status_code == 200 else format_error(r_lora)
-    )
+    async def refresh(backend: Backend) -> list[str]:
+        async with forge_client(TIMEOUT_INFO, backend) as client:
+            r_ckpt, r_lora = await asyncio.gather(
+                client.post("/sdapi/v1/refresh-checkpoints"),
+                client.post("/sdapi/v1/refresh-loras"),
+            )
+
+        prefix = f"[{backend.url}] " if len(pool.backends) > 1 else ""
+        return [
+            prefix + ("Checkpoints refreshed." if r_ckpt.status_code == 200 else format_error(r_ckpt)),
+            prefix + ("LoRAs refreshed." if r_lora.status_code == 200 else format_error(r_lora)),
+        ]
+
+    # Both rescans run at once, on every backend at once.
+    results = [
+        line for lines in await asyncio.gather(*(refresh(b) for b in pool.backends))
+        for line in lines
+    ]
+
+    listing_cache.invalidate()
     return "\n".join(results)
+
+
+# ---------------------------------------------------------------------------
+# Internal helpers
+# ---------------------------------------------------------------------------
+
+def _target_backends(backend_url: str) -> list[Backend]:
+    if not backend_url:
+        return [b for b in pool.backends if b.available] or pool.backends
+    backend = pool.get(backend_url)
+    return [backend] if backend else []
@@ -1,45 +1,317 @@
+import asyncio
 import base64
+import contextvars
+import importlib.util
+import io
+import itertools
+import logging
+import os
+import random
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import AsyncGenerator
+from typing import Any, AsyncGenerator, AsyncIterator, Callable, TypeVar
 
 import httpx
 
+from backends import Backend, pool
+from cache import MISS, inflight_gets, listing_cache, upload_cache
 from config import (
-    FORGE_API_PASSWORD,
-    FORGE_API_USER,
-    FORGE_URL,
+    FORGE_RETRIES,
+    FORGE_RETRY_BACKOFF,
+    IO_WORKERS,
     TIMEOUT_GENERATION,
+    TIMEOUT_INFO,
+    UPLOAD_DOWNSCALE,
 )
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Bounded pool for blocking image work (base64 and disk I/O).
+_io_pool = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="forge-io")
+
+# Source images are only shrunk when the requested output is smaller than
+# this fraction of them; anything closer is left for Forge to resize.
+_DOWNSCALE_BELOW = 0.75
+
+# Pillow is optional; without it sources are uploaded at full size.
+_CAN_DOWNSCALE = UPLOAD_DOWNSCALE and importlib.util.find_spec("PIL") is not None
+
+# Failures that say the node itself is unhealthy rather than the request bad.
+_BACKEND_DOWN_STATUSES = {502, 503, 504}
+
+# Failures worth repeating a safe request for: Forge running out of VRAM
+# (500), an overloaded or restarting node, or a connection dropped before
+# the response arrived. Read timeouts are not retried; the deadline is spent.
+_RETRY_STATUSES = {429, 500, 502, 503, 504}
+_RETRY_ERRORS = (httpx.NetworkError, httpx.RemoteProtocolError, httpx.ConnectTimeout)
+_IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS"}
+_MAX_RETRY_DELAY = 30.0
+_MIN_ATTEMPT_TIMEOUT = 1.0
+
+
+class ForgeClient:
+    """
+    Per-call view of one backend's shared httpx client.
+
+    Tools talk to this instead of the pooled client directly so that each call
+    keeps its own timeout without mutating state shared with concurrent calls,
+    and so connection failures count towards the backend's circuit breaker.
+    Every request is timed as a "request" span and its bytes are counted.
+
+    The timeout is a deadline for the whole call: a request that failed
+    transiently is retried up to FORGE_RETRIES times, with jittered
+    exponential backoff, only while another attempt fits before it. GETs are
+    retried; other methods only when sent with ``idempotent=True``.
+    """
+
+    def __init__(self, backend: Backend, timeout: float) -> None:
+        self.backend = backend
+        self.timeout = timeout
+        self.deadline = time.monotonic() + timeout
+
+    async def request(
+        self, method: str, url: str, *, idempotent: bool | None = None, **kwargs: Any
+    ) -> httpx.Response:
+        response = await self._send(method, url, idempotent, kwargs, stream=False)
+        metrics.count("bytes_received", response.num_bytes_downloaded, endpoint=_endpoint(url))
+        return response
+
+    async def get(self, url: str, **kwargs: Any) -> httpx.Response:
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url: str, **kwargs: Any) -> httpx.Response:
+        return await self.request("POST", url, **kwargs)
+
+    @asynccontextmanager
+    async def stream(
+        self, method: str, url: str, *, idempotent: bool | None = None, **kwargs: Any
+    ) -> AsyncIterator[httpx.Response]:
+        """
+        Send a request whose body is read incrementally (see httpx stream()).
+
+        Only failures before the body is read are retried.
+        """
+        response = await self._send(method, url, idempotent, kwargs, stream=True)
+        try:
+            yield response
+        except httpx.TransportError:
+            self.backend.record_failure()
+            metrics.count("forge_errors", status="unreachable")
+            raise
+        finally:
+            await response.aclose()
+            metrics.count("bytes_received", response.num_bytes_downloaded, endpoint=_endpoint(url))
+
+    async def _send(
+        self, method: str, url: str, idempotent: bool | None, kwargs: dict[str, Any], stream: bool
+    ) -> httpx.Response:
+        endpoint = _endpoint(url)
+        if idempotent is None:
+            idempotent = method in _IDEMPOTENT_METHODS
+        timeout = kwargs.pop("timeout", self.timeout)
+
+        for attempt in itertools.count():
+            client = self.backend.get_client()
+            # Each attempt only gets what is left of the call's deadline.
+            remaining = max(self.deadline - time.monotonic(), _MIN_ATTEMPT_TIMEOUT)
+            request = client.build_request(method, url, timeout=min(timeout, remaining), **kwargs)
+            started = time.monotonic()
+            try:
+                with metrics.span("request", endpoint=endpoint):
+                    response = await client.send(request, stream=stream)
+            except httpx.TransportError as exc:
+                self.backend.record_failure()
+                metrics.count("forge_errors", status="unreachable")
+                retry = idempotent and isinstance(exc, _RETRY_ERRORS)
+                delay = self._retry_delay(attempt, retry, started)
+                if delay is None:
+                    raise
+                logger.info("Retrying %s %s after %r.", method, endpoint, exc)
+            else:
+                self._record(response, endpoint)
+                retry = idempotent and response.status_code in _RETRY_STATUSES
+                delay = self._retry_delay(attempt, retry, started)
+                if delay is None:
+                    return response
+                logger.info("Retrying %s %s after HTTP %d.", method, endpoint, response.status_code)
+                await response.aclose()
+                metrics.count("bytes_received", response.num_bytes_downloaded, endpoint=endpoint)
+
+            metrics.count("forge_retries", endpoint=endpoint)
+            await asyncio.sleep(delay)
+
+    def _retry_delay(self, attempt: int, retryable: bool, started: float) -> float | None:
+        """Seconds to wait before retrying a failed attempt, or None to give up."""
+        if not retryable or attempt >= FORGE_RETRIES or not self.backend.available:
+            return None
+        # "Full jitter": concurrent callers hit by the same hiccup spread out.
+        delay = random.uniform(0, min(FORGE_RETRY_BACKOFF * 2 ** attempt, _MAX_RETRY_DELAY))
+        # Expect another attempt to take as long as the failed one, and don't
+        # start one the deadline would cut short.
+        now = time.monotonic()
+        if now + delay + (now - started) > self.deadline:
+            return None
+        return delay
+
+    def _record(self, response: httpx.Response, endpoint: str) -> None:
+        if response.status_code in _BACKEND_DOWN_STATUSES:
+            self.backend.record_failure()
+        else:
+            self.backend.record_success()
+        metrics.count(
+            "bytes_sent", int(response.request.headers.get("content-length", 0)), endpoint=endpoint
+        )
+
+
+def _endpoint(url: str) -> str:
+    return url.split("?", 1)[0]
 
 
 @asynccontextmanager
 async def forge_client(
     timeout: float = TIMEOUT_GENERATION,
-) -> AsyncGenerator[httpx.AsyncClient, None]:
+    backend: Backend | None = None,
+) -> AsyncGenerator[ForgeClient, None]:
+    """
+    Async context manager that yields a client bound to a backend's pool.
+
+    Connections are kept alive between tool calls, so repeated requests (e.g.
+    polling get_progress) reuse an open socket instead of reconnecting. HTTP
+    Basic Auth is applied automatically when FORGE_API_USER is set in the
+    environment, so individual tools never handle credentials directly.
+    Without *backend*, the primary healthy backend is used.
+    """
+    yield ForgeClient(backend or pool.primary(), timeout)
+
+
+async def fetch_json(
+    path: str,
+    timeout: float = TIMEOUT_INFO,
+    ttl: float = 0,
+    use_cache: bool = True,
+    backend: Backend | None = None,
+) -> tuple[Any, str | None]:
     """
-    Async context manager that yields a pre-configured httpx client.
+    GET *path* from Forge and return ``(data, error)``.
 
-    Automatically applies HTTP Basic Auth when FORGE_API_USER is set in
-    the environment, so individual tools never handle credentials directly.
+    On success *data* is the parsed JSON body and *error* is None; otherwise
+    *error* holds the format_error() text. When *ttl* is positive the parsed
+    body is kept in the listing cache for that many seconds. Pass
+    use_cache=False to skip the cached copy and fetch a fresh one.
+
+    Concurrent calls for the same path share one request to Forge, and the
+    returned *data* object is shared between them — do not mutate it.
+    Without *backend*, the primary healthy backend is asked.
     """
-    auth = (FORGE_API_USER, FORGE_API_PASSWORD) if FORGE_API_USER else None
-    async with httpx.AsyncClient(
-        base_url=FORGE_URL,
-        auth=auth,
-        timeout=timeout,
-    ) as client:
-        yield client
+    backend = backend or pool.primary()
+    key = (backend.url, path)
+    if ttl > 0 and use_cache:
+        data = listing_cache.get(key)
+        if data is not MISS:
+            return data, None
+
+    data, error = await inflight_gets.do(key, lambda: _get_json(backend, path, timeout))
+    if error is None:
+        listing_cache.set(key, data, ttl)
+    return data, error
 
 
-def encode_image(path: str) -> str:
-    """Read an image file and return it as a base64 string."""
-    return base64.b64encode(Path(path).read_bytes()).decode("utf-8")
+async def _get_json(backend: Backend, path: str, timeout: float) -> tuple[Any, str | None]:
+    async with forge_client(timeout, backend) as client:
+        response = await client.get(path)
+
+    if response.status_code != 200:
+        return None, format_error(response)
+    return response.json(), None
+
+
+async def run_io(fn: Callable[..., T], *args: Any) -> T:
+    """
+    Run blocking *fn* in the image I/O thread pool and await its result.
+
+    *fn* sees the caller's context variables, so its metrics spans are
+    attributed to the right tool.
+    """
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(_io_pool, context.run, fn, *args)
+
+
+async def encode_image(path: str, fit: tuple[int, int] | None = None) -> str:
+    """
+    Read an image file and return it as a base64 string.
+
+    Encodings are kept in the upload cache keyed by path, modification time
+    and size, so an unchanged file is only read and encoded once. With *fit*
+    (width, height), a source much larger than that size is first scaled down
+    to just cover it, when UPLOAD_DOWNSCALE is on and Pillow is installed.
+    """
+    return await run_io(_encode_file, path, fit if _CAN_DOWNSCALE else None)
 
 
-def decode_and_save(b64: str, path: str) -> None:
+async def decode_and_save(b64: str, path: str) -> None:
     """Decode a base64 string and write it to *path*."""
-    Path(path).write_bytes(base64.b64decode(b64))
+    await run_io(_decode_to_file, b64, path)
+
+
+async def save_images(images: list[str], paths: list[Path]) -> None:
+    """Decode and write several base64 images in parallel."""
+    await asyncio.gather(*(decode_and_save(b64, str(p)) for b64, p in zip(images, paths)))
+
+
+def _encode_file(path: str, fit: tuple[int, int] | None) -> str:
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size, fit)
+    b64 = upload_cache.get(key)
+    if b64 is MISS:
+        with metrics.span("encode"):
+            data = Path(path).read_bytes()
+            if fit is not None:
+                data = _downscale(data, fit)
+            b64 = base64.b64encode(data).decode("utf-8")
+        upload_cache.set(key, b64)
+    return b64
+
+
+def _downscale(data: bytes, fit: tuple[int, int]) -> bytes:
+    """Shrink an encoded image to the smallest size covering *fit*, as PNG."""
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as image:
+        scale = max(fit[0] / image.width, fit[1] / image.height)
+        if scale >= _DOWNSCALE_BELOW:
+            return data
+        size = (max(round(image.width * scale), 1), max(round(image.height * scale), 1))
+        # Palette and CMYK images can't be resampled smoothly or saved as PNG.
+        if image.mode not in ("RGB", "RGBA", "L", "LA"):
+            image = image.convert("RGBA")
+        out = io.BytesIO()
+        image.resize(size, Image.LANCZOS).save(out, "PNG")
+    return out.getvalue()
+
+
+def _decode_to_file(b64: str, path: str) -> None:
+    with metrics.span("decode"):
+        data = base64.b64decode(b64)
+    with metrics.span("save"):
+        tmp = temp_path_for(Path(path))
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+
+
+def temp_path_for(path: Path) -> Path:
+    """
+    Sibling temporary file for writing *path* atomically via os.replace().
+
+    Replacing rather than rewriting also keeps hardlinked copies of the old
+    file (e.g. in the result cache) intact.
+    """
+    return path.with_name(f".{path.name}.{uuid.uuid4().hex[:8]}.part")
 
 
 def format_error(response: httpx.Response) -> str:
@@ -47,4 +319,5 @@ def format_error(response: httpx.Response) -> str:
         detail = response.json().get("detail", response.text)
     except Exception:
         detail = response.text
+    metrics.count("forge_errors", status=str(response.status_code))
     return f"Forge error {response.status_code}: {detail}"